@@ -0,0 +1,138 @@
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional, Tuple
+
+from PIL import Image, ImageSequence
+
+from common import CONFIG
+from metrics import PRESSURE_TRIM
+from photo import Photo, draw_title
+
+# Browsers play frames with a duration of 10 ms or less at 100 ms, as many GIFs rely on it.
+MIN_FRAME_MS = 20
+DEFAULT_FRAME_MS = 100
+
+
+class Animation:
+    """ The decoded frames of an animated image, and how long to show each one for. """
+    def __init__(self, frames, durations):
+        self.frames = frames
+        self.durations = durations
+        self.nbytes = sum(f.width * f.height * len(f.getbands()) for f in frames)
+
+    def __len__(self):
+        return len(self.frames)
+
+
+def load_animation_cache() -> Optional['AnimationCache']:
+    """ Create an AnimationCache from the [animation] section, or None if animations are disabled. """
+    if not CONFIG.getboolean('animation', 'enabled', fallback=True):
+        return None
+    return AnimationCache(CONFIG.getint('animation', 'cache_mb', fallback=64) * 1024 * 1024,
+                          CONFIG.getint('animation', 'max_animation_mb', fallback=32) * 1024 * 1024)
+
+
+def decode_animation(photo: Photo, size: Optional[Tuple[int, int]] = None, with_title: bool = False,
+                     max_bytes: int = 32 * 1024 * 1024) -> Optional[Animation]:
+    """
+    Decode every frame of an animated image, fitted into size.
+
+    :param max_bytes: The most the decoded frames may take up.
+    :return: the Animation, or None if the image is not animated or its frames would exceed max_bytes.
+    """
+    with Image.open(photo.file_path) as image:
+        if not getattr(image, 'is_animated', False):
+            return None
+        width, height = image.size
+        if size:
+            scale = min(size[0] / width, size[1] / height, 1)
+            width, height = max(int(width * scale), 1), max(int(height * scale), 1)
+        # Estimated before decoding anything, so oversized animations cost nothing.
+        if image.n_frames * width * height * 3 > max_bytes:
+            return None
+
+        frames = []
+        durations = []
+        for frame in ImageSequence.Iterator(image):
+            # Seeking through the frames in order applies each frame's disposal to the previous one.
+            rendered = frame.convert('RGB')
+            if rendered.size != (width, height):
+                rendered = rendered.resize((width, height), Image.BILINEAR)
+            if with_title:
+                draw_title(rendered, photo.title)
+            frames.append(rendered)
+            duration = frame.info.get('duration') or DEFAULT_FRAME_MS
+            durations.append(duration if duration >= MIN_FRAME_MS else DEFAULT_FRAME_MS)
+    return Animation(frames, durations)
+
+
+class AnimationCache:
+    """
+    A byte-bounded LRU cache of decoded animations. Animations are decoded once, on a background thread, so the
+    display thread never waits on a decode.
+    """
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, max_animation_bytes: int = 32 * 1024 * 1024):
+        self.log = logging.getLogger('frame.AnimationCache')
+        self.max_bytes = max_bytes
+        self.max_animation_bytes = min(max_animation_bytes, max_bytes)
+        self.current_bytes = 0
+        self.entries = OrderedDict()
+        self.pending = {}
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='AnimationDecoder')
+        self._lock = threading.Lock()
+
+    def get(self, photo: Photo, size: Optional[Tuple[int, int]] = None, with_title: bool = False) -> Future:
+        """
+        Get the decoded animation for a photo, decoding it in the background if it is not cached.
+
+        :return: a Future of the Animation, or of None if the photo should be shown as a still.
+        """
+        key = (photo.file_path, size, with_title)
+        with self._lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                future = Future()
+                future.set_result(self.entries[key])
+                return future
+            future = self.pending.get(key)
+            if not future:
+                future = self.executor.submit(self._decode, key, photo, size, with_title)
+                self.pending[key] = future
+            return future
+
+    def _decode(self, key, photo, size, with_title):
+        try:
+            animation = decode_animation(photo, size, with_title, self.max_animation_bytes)
+        except Exception as e:
+            self.log.error('Could not decode the animation in %s: %s', photo.file_path, e)
+            animation = None
+        with self._lock:
+            self.pending.pop(key, None)
+            if animation is None:
+                self.log.debug('Showing %s as a still image', photo.file_path)
+                return None
+            self.entries[key] = animation
+            self.current_bytes += animation.nbytes
+            self._evict(self.max_bytes)
+        self.log.info('Decoded %d frames of %s', len(animation), photo.file_path)
+        return animation
+
+    def _evict(self, max_bytes):
+        while self.current_bytes > max_bytes and self.entries:
+            _, animation = self.entries.popitem(last=False)
+            self.current_bytes -= animation.nbytes
+
+    def shrink(self, level):
+        """ A MemoryGovernor hook. Keeps only the most recent animation, or none under heavier pressure. """
+        with self._lock:
+            before = self.current_bytes
+            if level == PRESSURE_TRIM and self.entries:
+                self._evict(next(reversed(self.entries.values())).nbytes)
+            else:
+                self._evict(0)
+            return before - self.current_bytes
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
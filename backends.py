@@ -0,0 +1,141 @@
+import heapq
+import itertools
+import logging
+import time
+import tkinter as tk
+from abc import ABC, abstractmethod
+from typing import Optional, Tuple, Union
+
+import numpy as np
+from PIL import Image, ImageTk
+
+
+class RenderBackend(ABC):
+    """ Where SlideShowFrame sends its output, and how it schedules work on its display thread. """
+    _stopped = False
+
+    @abstractmethod
+    def show(self, image: Union[Image.Image, np.ndarray], title: Optional[str] = None):
+        """
+        Display an image.
+
+        :param image: A Pillow Image or an RGB NumPy array.
+        :param title: The new window title, or None to keep the current title.
+        """
+        pass
+
+    @abstractmethod
+    def schedule(self, delay_ms: int, callback, *args):
+        pass
+
+    @abstractmethod
+    def run(self):
+        pass
+
+    @abstractmethod
+    def stop(self):
+        pass
+
+    @property
+    def stopped(self) -> bool:
+        """ Whether stop() has been called, so callbacks that are already running show nothing more. """
+        return self._stopped
+
+    @property
+    @abstractmethod
+    def screen_size(self) -> Tuple[int, int]:
+        pass
+
+
+class TkBackend(RenderBackend):
+    """Tk window/label adjusts to size of image"""
+    def __init__(self, x=0, y=0):
+        self.root = tk.Tk()
+        self.root.geometry(f'+{x}+{y}')
+        self.picture_display = tk.Label(self.root)
+        self.picture_display.pack()
+
+    def show(self, image, title=None):
+        if isinstance(image, np.ndarray):
+            image = Image.fromarray(image)
+        img_object = ImageTk.PhotoImage(image)
+        self.picture_display.config(image=img_object)
+        # Keep a reference, otherwise Tk displays nothing once the PhotoImage is garbage collected.
+        self.picture_display.image = img_object
+        if title is not None:
+            self.root.title(title)
+
+    def schedule(self, delay_ms, callback, *args):
+        self.root.after(delay_ms, callback, *args)
+
+    def run(self):
+        self.root.mainloop()
+
+    def stop(self):
+        self._stopped = True
+        self.root.destroy()
+
+    @property
+    def screen_size(self):
+        return self.root.winfo_screenwidth(), self.root.winfo_screenheight()
+
+
+class OffscreenBackend(RenderBackend):
+    """
+    Renders into memory rather than a window, so the feed and render path can run without an X display.
+
+    Scheduled callbacks run on the thread that calls run(), as soon as they are due. The backend stops itself after
+    max_slides titled images have been shown, if provided.
+    """
+    def __init__(self, size: Tuple[int, int] = (1920, 1080), max_slides: Optional[int] = None):
+        self.log = logging.getLogger('frame.OffscreenBackend')
+        self.size = size
+        self.max_slides = max_slides
+        self.frame = None
+        self.title = None
+        self.slides_shown = 0
+        self.frames_shown = 0
+        self.started = None
+        self.finished = None
+        self._queue = []
+        self._counter = itertools.count()
+        self._stopped = False
+
+    def show(self, image, title=None):
+        # Materialise the pixels, which is the work a real display would have to do with the buffer.
+        self.frame = np.asarray(image)
+        self.frames_shown += 1
+        if self.started is None:
+            self.started = time.monotonic()
+        if title is not None:
+            self.title = title
+            self.slides_shown += 1
+            if self.max_slides and self.slides_shown >= self.max_slides:
+                self.stop()
+
+    def schedule(self, delay_ms, callback, *args):
+        due = time.monotonic() + delay_ms / 1000
+        heapq.heappush(self._queue, (due, next(self._counter), callback, args))
+
+    def run(self):
+        if self.started is None:
+            self.started = time.monotonic()
+        while not self._stopped and self._queue:
+            due, _, callback, args = heapq.heappop(self._queue)
+            wait = due - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            callback(*args)
+        self.finished = time.monotonic()
+
+    def stop(self):
+        self._stopped = True
+
+    @property
+    def screen_size(self):
+        return self.size
+
+    @property
+    def slides_per_second(self) -> float:
+        elapsed = (self.finished or time.monotonic()) - (self.started or time.monotonic())
+        return self.slides_shown / elapsed if elapsed > 0 else 0.0
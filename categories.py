@@ -1,22 +1,27 @@
 import json
 import logging
 import logging.config
+import os
 import sqlite3
 import time
 from abc import ABC, abstractmethod
 from datetime import datetime
 from pathlib import Path
 from threading import RLock
-from typing import Union
+from typing import Optional, Union
 
 import boto3
 import botocore.exceptions
 
 from common import synchronized, DB_FILE_PATH, JSON_STORAGE_PATH, PHOTO_PATH, REKOGNITION_DATA_PATH
 from photo import Photo
+from query import QuerySyntaxError, compile_query, is_query
 
 MAX_FILE_SIZE = 5_242_880
 
+SEARCH_PREFIX = 'search:'
+""" Prefix of a categories setting that is resolved through the full-text search index. """
+
 
 class RekognitionService:
     def __init__(self, data_path: Path = None):
@@ -81,13 +86,34 @@ class RekognitionService:
 
 class CategoryService(ABC):
     @abstractmethod
-    def save_to_categories(self, file_path, tags: Union[str, list]):
+    def save_to_categories(self, file_path, tags: Union[str, list], source_name: str = None):
         pass
 
     @abstractmethod
     def load_from_categories(self, categories: Union[str, list]):
         pass
 
+    def save_all_to_categories(self, entries):
+        """
+        Save a batch of files to the category store, skipping any file that cannot be saved.
+
+        :param entries: An iterable of (file_path, tags) tuples, as accepted by save_to_categories.
+        :return: a list of the entries that were saved.
+        """
+        saved = []
+        for file_path, tags in entries:
+            try:
+                self.save_to_categories(file_path, tags)
+            except Exception as e:
+                self.log.error('Could not save %s to the category store: %s', file_path, e)
+            else:
+                saved.append((file_path, tags))
+        return saved
+
+    @abstractmethod
+    def remove_photos(self, file_paths):
+        pass
+
     @abstractmethod
     def shutdown(self):
         pass
@@ -115,14 +141,21 @@ class SqlDbCategoryService(CategoryService):
             requires_setup = True
         self.db = sqlite3.connect(data_path, check_same_thread=False)
         self._lock = RLock()
+        self._in_batch = False
         if requires_setup:
             self._setup()
+        self._setup_indexes()
+        self._setup_search_index()
+        self._setup_change_counter()
 
     def _sync(self):
         """
         Sync data from the JSON Category Storage into the Database.
         """
         json_path = JSON_STORAGE_PATH
+        if not json_path.is_dir():
+            self.log.info('No JSON categories found in %s to sync', json_path)
+            return
         for f in json_path.iterdir():
             if f.is_file() and f.suffix == '.json':
                 cat_name = f.stem.lower()
@@ -190,12 +223,135 @@ class SqlDbCategoryService(CategoryService):
             self.log.info('Setup complete')
 
     @synchronized
-    def save_to_categories(self, file_path, tags: Union[str, list]):
+    def _setup_indexes(self):
+        """
+        Set up the indexes on the join table, so that lookups by photo or by category never scan it.
+        """
+        cur = self.db.cursor()
+        # Used to keep the search index's tags column up to date and to load the tags of a photo.
+        cur.execute('CREATE INDEX IF NOT EXISTS categories_photos_photo_id ON categories_photos (photo_id)')
+        # Used by the compiled queries' tag checks, and when saving a mapping.
+        cur.execute("""CREATE INDEX IF NOT EXISTS categories_photos_category_photo
+                       ON categories_photos (category_id, photo_id)""")
+        self.db.commit()
+
+    @synchronized
+    def _setup_search_index(self):
+        """
+        Set up the FTS5 index over photo titles and tag names, and the triggers that keep it in sync.
+
+        The index is filled from the existing tables the first time it is created.
+        """
+        tags_for_photo = """(SELECT group_concat(c.tag, ' ') FROM categories c
+                             JOIN categories_photos cp ON cp.category_id = c.id
+                             WHERE cp.photo_id = {})"""
+        statements = [
+            """CREATE TRIGGER IF NOT EXISTS photos_fts_insert AFTER INSERT ON photos BEGIN
+                 INSERT INTO photos_fts (rowid, title, tags) VALUES (new.id, new.title, '');
+               END""",
+            """CREATE TRIGGER IF NOT EXISTS photos_fts_delete AFTER DELETE ON photos BEGIN
+                 DELETE FROM photos_fts WHERE rowid = old.id;
+               END""",
+            """CREATE TRIGGER IF NOT EXISTS photos_fts_update AFTER UPDATE OF title ON photos BEGIN
+                 UPDATE photos_fts SET title = new.title WHERE rowid = new.id;
+               END""",
+            f"""CREATE TRIGGER IF NOT EXISTS categories_photos_fts_insert AFTER INSERT ON categories_photos BEGIN
+                  UPDATE photos_fts SET tags = {tags_for_photo.format('new.photo_id')} WHERE rowid = new.photo_id;
+                END""",
+            f"""CREATE TRIGGER IF NOT EXISTS categories_photos_fts_delete AFTER DELETE ON categories_photos BEGIN
+                  UPDATE photos_fts SET tags = coalesce({tags_for_photo.format('old.photo_id')}, '')
+                  WHERE rowid = old.photo_id;
+                END""",
+        ]
+
+        cur = self.db.cursor()
+        try:
+            exists = cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'photos_fts'").fetchone()
+            if not exists:
+                self.log.info('Creating search index')
+                # The prefix indexes make queries such as 'flower*' index lookups rather than scans.
+                cur.execute("""CREATE VIRTUAL TABLE photos_fts USING fts5(title, tags, prefix='2 3')""")
+                cur.execute(f"""INSERT INTO photos_fts (rowid, title, tags)
+                                SELECT p.id, p.title, coalesce({tags_for_photo.format('p.id')}, '')
+                                FROM photos p""")
+            for stmt in statements:
+                cur.execute(stmt)
+            self.db.commit()
+        except sqlite3.OperationalError as e:
+            self.db.rollback()
+            self.log.error('Could not set up the search index. Is FTS5 available? %s', e)
+
+    @synchronized
+    def _setup_change_counter(self):
+        """
+        Set up the catalog change counter, and the triggers that increment it when photos are added, removed, enabled
+        or disabled, or their tags change. Display metrics are written on every slide and do not count as changes.
+        """
+        statements = [
+            """CREATE TABLE IF NOT EXISTS catalog_changes (id integer primary key check (id = 0), counter integer)""",
+            """INSERT OR IGNORE INTO catalog_changes (id, counter) VALUES (0, 0)""",
+        ]
+        for table, event in (('photos', 'INSERT'), ('photos', 'DELETE'), ('photos', 'UPDATE OF disabled'),
+                             ('categories_photos', 'INSERT'), ('categories_photos', 'DELETE')):
+            name = f"{table}_changes_{event.split()[0].lower()}"
+            statements.append(f"""CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON {table} BEGIN
+                                    UPDATE catalog_changes SET counter = counter + 1 WHERE id = 0;
+                                  END""")
+        cur = self.db.cursor()
+        for stmt in statements:
+            cur.execute(stmt)
+        self.db.commit()
+
+    def search(self, query: str, since_id: int = 0):
+        """
+        Search photo titles and tags through the FTS5 index.
+
+        :param query: An FTS5 query, e.g. 'flower*', 'beach OR sunset' or 'title:tulip'.
+        :param since_id: Only return photos with an id greater than this.
+        :return: a Generator of the matching Photos, best matches first.
+        """
+        stmt = """SELECT p.id, p.img_path, p.title
+                  FROM photos_fts f JOIN photos p ON p.id = f.rowid
+                  WHERE photos_fts MATCH ? AND coalesce(p.disabled, 0) = 0 AND p.id > ?
+                  ORDER BY f.rank"""
+        try:
+            with self._lock:
+                found = self.db.execute(stmt, [query, since_id]).fetchall()
+        except sqlite3.OperationalError as e:
+            self.log.error('Invalid search "%s": %s', query, e)
+            return iter([])
+        return (Photo(Path(p[1]), p[2], p[0]) for p in found)
+
+    def query(self, text: str, since_id: int = 0):
+        """
+        Select photos with the query language, e.g. 'beach AND sunset AND NOT people AND shown < 3'.
+
+        :param text: The query.
+        :param since_id: Only return photos with an id greater than this.
+        :return: a Generator of the matching Photos.
+        """
+        try:
+            stmt, params = compile_query(text)
+        except QuerySyntaxError as e:
+            self.log.error('Invalid query "%s": %s', text, e)
+            return iter([])
+        try:
+            with self._lock:
+                found = self.db.execute(stmt, (since_id,) + params).fetchall()
+        except sqlite3.OperationalError as e:
+            # Raised for a match() whose text is not a valid full-text query.
+            self.log.error('Invalid query "%s": %s', text, e)
+            return iter([])
+        return (Photo(Path(p[1]), p[2], p[0]) for p in found)
+
+    @synchronized
+    def save_to_categories(self, file_path, tags: Union[str, list], source_name: str = None):
         """
         Save a string representation of a Path to the category store using the provided tags.
 
         :param file_path: The Path we wish to save to the category store.
         :param tags: The tags used to represent this file.
+        :param source_name: The feed the file came from, recorded when the photo is first added.
         :return: None
         """
 
@@ -207,7 +363,7 @@ class SqlDbCategoryService(CategoryService):
         def add_category(cat_name):
             cur = self.db.cursor()
             resp = cur.execute("INSERT INTO categories (tag) values (?)", [cat_name])
-            self.db.commit()
+            self._commit()
             return resp.lastrowid
 
         def check_for_photo(photo_path):
@@ -219,13 +375,14 @@ class SqlDbCategoryService(CategoryService):
             photo = Photo(photo_path)
             im_w, im_h = photo.image.size
             dt_added = datetime.fromtimestamp(photo.file_path.stat().st_ctime).isoformat()
-            values = [str(photo.file_path), im_w, im_h, dt_added, photo.title]
+            values = [str(photo.file_path), im_w, im_h, dt_added, photo.title, source_name]
             cur = self.db.cursor()
             resp = cur.execute(
-                'INSERT INTO photos (img_path, img_width, img_height, date_added, title) values (?,?,?,?,?)',
+                """INSERT INTO photos (img_path, img_width, img_height, date_added, title, source_name)
+                   values (?,?,?,?,?,?)""",
                 values
             )
-            self.db.commit()
+            self._commit()
             return resp.lastrowid
 
         def check_for_categories_photos(cat_id, photo_id):
@@ -240,7 +397,7 @@ class SqlDbCategoryService(CategoryService):
             cur = self.db.cursor()
             resp = cur.execute("INSERT INTO categories_photos (category_id,photo_id) VALUES (?,?)",
                                [cat_id, photo_id])
-            self.db.commit()
+            self._commit()
             return resp.lastrowid
 
         def update_category(f_path, cat_name):
@@ -251,7 +408,7 @@ class SqlDbCategoryService(CategoryService):
                 category_id = add_category(cat_name)
                 self.log.info('Category %s added to the database with id %d', cat_name, category_id)
             else:
-                self.log.info('Category %s already exists with id %d', cat_name, category_id)
+                self.log.debug('Category %s already exists with id %d', cat_name, category_id)
 
             self.log.debug('update_category: After checking category')
             try:
@@ -260,14 +417,14 @@ class SqlDbCategoryService(CategoryService):
                 photo_id = add_photo(f_path)
                 self.log.info('Photo %s added to the database with id %d', f_path, photo_id)
             else:
-                self.log.info('Photo %s is already in the database with id %d', f_path, photo_id)
+                self.log.debug('Photo %s is already in the database with id %d', f_path, photo_id)
 
             self.log.debug('update_category: After checking photo')
             try:
                 check_for_categories_photos(category_id, photo_id)
             except TypeError:
                 cat_photo_id = add_category_photo_mapping(category_id, photo_id)
-                self.log.info(
+                self.log.debug(
                     'Category mapping added for category %s and photo %s at row: %d', cat_name, f_path, cat_photo_id)
             else:
                 self.log.warning('Category mapping for category %s and photo %s already exists', cat_name, f_path)
@@ -288,19 +445,65 @@ class SqlDbCategoryService(CategoryService):
             self.log.debug('After update_category')
         self.log.debug('After loop')
 
-    def load_from_categories(self, categories: Union[str, list]):
+    def _commit(self):
+        # Inside save_all_to_categories, the batch is committed once at its end.
+        if not self._in_batch:
+            self.db.commit()
+
+    @synchronized
+    def save_all_to_categories(self, entries):
+        """
+        Save a batch of files to the category store in a single transaction, while holding the lock so a batch is
+        never interleaved with other writers. A file that cannot be saved is rolled back and skipped.
+
+        :param entries: An iterable of (file_path, tags) tuples, as accepted by save_to_categories.
+        :return: a list of the entries that were saved.
+        """
+        saved = []
+        if self.db.in_transaction:
+            self.db.commit()
+        self.db.execute('BEGIN')
+        self._in_batch = True
+        try:
+            for file_path, tags in entries:
+                self.db.execute('SAVEPOINT save_entry')
+                try:
+                    self.save_to_categories(file_path, tags)
+                except Exception as e:
+                    self.db.execute('ROLLBACK TO save_entry')
+                    self.log.error('Could not save %s to the category store: %s', file_path, e)
+                else:
+                    saved.append((file_path, tags))
+                self.db.execute('RELEASE save_entry')
+            self.db.commit()
+        except BaseException:
+            self.db.rollback()
+            raise
+        finally:
+            self._in_batch = False
+        return saved
+
+    def load_from_categories(self, categories: Union[str, list], since_id: int = 0, ids: Optional[list] = None):
         """
         Load the images (as Photo objects) that represent the provided categories.
 
-        If 'all' is provided in categories, then all images are returned.
+        If 'all' is provided in categories, then all images are returned. Categories starting with 'search:' are
+        resolved through the search index instead, e.g. 'search: flower* OR title:tulip', and categories using the
+        query language are compiled to SQL, e.g. 'beach AND NOT people AND score >= 5'.
         :param categories: A comma-separated list of categories we wish to retrieve.
+        :param since_id: Only return photos with an id greater than this, e.g. those added since a snapshot was taken.
+        :param ids: Only return photos with these ids, e.g. those tagged since a snapshot was taken. Applies to plain
+                    lists of categories.
         :return: a Generator containing all of the images matching the provided categories.
         """
+        # The ids are passed as a single JSON array, so any number of them fits in one statement.
+        id_filter = 'AND p.id IN (SELECT value FROM json_each(?))' if ids is not None else ''
+        id_params = [json.dumps(ids)] if ids is not None else []
 
         def load_all_photos():
-            stmt = """SELECT * FROM photos p """
+            stmt = f"""SELECT * FROM photos p WHERE coalesce(p.disabled, 0) = 0 AND p.id > ? {id_filter}"""
             cur = self.db.cursor()
-            found = cur.execute(stmt)
+            found = cur.execute(stmt, [since_id] + id_params)
 
             return (Photo(Path(p[1]), p[8], p[0]) for p in found.fetchall())
 
@@ -314,13 +517,18 @@ class SqlDbCategoryService(CategoryService):
                            FROM categories c
                            WHERE c.tag in ({qmarks})
                          )
-                       )"""
+                       ) AND coalesce(p.disabled, 0) = 0 AND p.id > ? {id_filter}"""
             cur = self.db.cursor()
-            found = cur.execute(stmt, cat_names)
+            found = cur.execute(stmt, cat_names + [since_id] + id_params)
 
-            # TODO - need to verify the photo exists!
+            # Missing and corrupt files are disabled in the background by the PhotoReconciler.
             return (Photo(Path(p[1]), p[8], p[0]) for p in found.fetchall())
 
+        if is_search(categories):
+            return self.search(categories.strip()[len(SEARCH_PREFIX):].strip(), since_id)
+        if is_query(categories):
+            return self.query(categories, since_id)
+
         if isinstance(categories, str):
             parsed = [x.strip() for x in categories.split(',')]
         elif isinstance(categories, list):
@@ -334,6 +542,50 @@ class SqlDbCategoryService(CategoryService):
         else:
             return load_photos_with_categories(parsed)
 
+    @synchronized
+    def remove_photos(self, file_paths):
+        """
+        Remove photos, and their category mappings, from the category store in a single transaction.
+
+        :param file_paths: The Paths of the photos to remove.
+        :return: The number of photos removed.
+        """
+        paths = [str(p) for p in file_paths]
+        if not paths:
+            return 0
+        qmarks = ','.join(['?'] * len(paths))
+        with self.db:
+            cur = self.db.cursor()
+            cur.execute(f"""DELETE FROM categories_photos WHERE photo_id IN (
+                              SELECT id FROM photos WHERE img_path IN ({qmarks}))""", paths)
+            removed = cur.execute(f'DELETE FROM photos WHERE img_path IN ({qmarks})', paths).rowcount
+        self.log.info('Removed %d photos from the database', removed)
+        return removed
+
+    @synchronized
+    def least_valued_photos(self, directory: Path, limit: int, exclude=()) -> list:
+        """
+        The photos in a directory that are worth the least, lowest score first and then least recently displayed.
+
+        :param directory: Only photos stored directly in this directory are returned, whether their paths were saved
+                          relative or absolute.
+        :param exclude: The Paths of photos to leave out.
+        :return: A list of up to limit Paths.
+        """
+        prefixes = {os.path.join(str(directory), ''), os.path.join(str(directory.resolve()), '')}
+        # The path starts with the directory, and the rest of it is a file name rather than a subdirectory.
+        in_prefix = '(substr(img_path, 1, ?) = ? AND instr(substr(img_path, ?), ?) = 0)'
+        in_directory = ' OR '.join([in_prefix] * len(prefixes))
+        prefix_params = [value for prefix in prefixes for value in (len(prefix), prefix, len(prefix) + 1, os.sep)]
+        excluded = [str(p) for p in exclude]
+        qmarks = ','.join(['?'] * len(excluded))
+        stmt = f"""SELECT img_path FROM photos
+                   WHERE ({in_directory}) AND img_path NOT IN ({qmarks})
+                   ORDER BY coalesce(score, 0) ASC, coalesce(date_last_displayed, date_added) ASC
+                   LIMIT ?"""
+        rows = self.db.execute(stmt, prefix_params + excluded + [limit]).fetchall()
+        return [Path(r[0]) for r in rows]
+
     def shutdown(self):
         self.db.close()
 
@@ -347,12 +599,13 @@ class JsonCategoryService(CategoryService):
             self.data_path.mkdir(parents=True, exist_ok=True)
         self.log = logging.getLogger('frame.JsonCategoryService')
 
-    def save_to_categories(self, file_path, tags: Union[str, list]):
+    def save_to_categories(self, file_path, tags: Union[str, list], source_name: str = None):
         """
         Save a string representation of a Path to the category store using the provided tags.
 
         :param file_path: The Path we wish to save to the category store.
         :param tags: The tags used to represent this file.
+        :param source_name: Ignored, the JSON store does not record where files came from.
         :return: None
         """
 
@@ -367,7 +620,7 @@ class JsonCategoryService(CategoryService):
                         updated = True
                         self.log.info('Added image %s to category %s', f_path, category)
                     else:
-                        self.log.info('Image %s is already saved in category %s.', f_path, category)
+                        self.log.debug('Image %s is already saved in category %s.', f_path, category)
                 if updated:
                     with cat_path.open('w') as f:
                         json.dump(existing, f)
@@ -403,9 +656,12 @@ class JsonCategoryService(CategoryService):
             with cat_path.open('r') as f:
                 existing = json.load(f)
 
-            # This assumes the entry actually exists on the filesystem.
-            # Need to check that the file exists!
-            return [Path(entry) for entry in existing]
+            # The background reconciler only checks the database, so skip entries whose files have gone.
+            paths = [Path(entry) for entry in existing]
+            found = [p for p in paths if p.exists()]
+            if len(found) < len(paths):
+                self.log.warning('Skipping %d missing photos in category "%s"', len(paths) - len(found), category)
+            return found
 
         parsed = [x.strip() for x in categories.split(',')]
         if 'all' in parsed:
@@ -418,11 +674,41 @@ class JsonCategoryService(CategoryService):
 
         return (Photo(p) for p in all_paths)
 
+    def remove_photos(self, file_paths):
+        """
+        Remove photos from every category file.
+
+        :param file_paths: The Paths of the photos to remove.
+        :return: The number of category entries removed.
+        """
+        removed_paths = {str(p) for p in file_paths}
+        removed = 0
+        for cat_path in self.data_path.glob('*.json'):
+            with cat_path.open('r') as f:
+                existing = json.load(f)
+            kept = [entry for entry in existing if entry not in removed_paths]
+            if len(kept) != len(existing):
+                removed += len(existing) - len(kept)
+                with cat_path.open('w') as f:
+                    json.dump(kept, f)
+        self.log.info('Removed %d category entries', removed)
+        return removed
+
     def shutdown(self):
         """ Do Nothing. """
         pass
 
 
+def is_search(categories) -> bool:
+    """ Determines whether the categories setting is a search, e.g. 'search: flower*', rather than a list of tags. """
+    return isinstance(categories, str) and categories.strip().lower().startswith(SEARCH_PREFIX)
+
+
+def is_category_list(categories) -> bool:
+    """ Determines whether the categories setting is a plain list of tags, rather than a search or a query. """
+    return not is_search(categories) and not is_query(categories)
+
+
 def gather_photos(from_dir=None):
     if not from_dir:
         from_dir = PHOTO_PATH
@@ -1,6 +1,8 @@
 import logging
+import os
+import threading
 import tkinter as tk
-from configparser import ConfigParser
+from configparser import ConfigParser, Error as ConfigError
 from functools import wraps
 from pathlib import Path
 from typing import Optional
@@ -8,8 +10,8 @@ from typing import Optional
 CONFIGS_ROOT = Path(__file__).parent / 'configs'
 """ The root Path containing all configuration files, etc. """
 
-CONFIG_INI_PATH = CONFIGS_ROOT / 'config.ini'
-""" The Path to the config.ini file used by the frame and services. """
+CONFIG_INI_PATH = Path(os.environ.get('FRAME_CONFIG', CONFIGS_ROOT / 'config.ini'))
+""" The Path to the config.ini file used by the frame and services, which the FRAME_CONFIG variable overrides. """
 
 CONFIG = ConfigParser()
 """ The Config instance to contain all configuration details. """
@@ -57,6 +59,9 @@ LOGGING_FILE_PATH = Path(LOGGING_FILE_NAME)
 USE_REKOGNITION_SERVICE = CONFIG['service.rekognition'].getboolean('use_service')
 """ Should we use the AWS Rekognition service to collect additional tags/labels. """
 
+USE_LOCAL_LABELS = CONFIG.getboolean('service.labels', 'use_service', fallback=False)
+""" Should we label photos locally with their colours, brightness and orientation, which works offline. """
+
 
 # Yet another courtesy of Stack Overflow
 # https://stackoverflow.com/questions/3129322/how-do-i-get-monitor-resolution-in-python/56913005#56913005
@@ -72,11 +77,66 @@ def show_current_screen_geometry():
     print(f'Screen details: {geo}')
 
 
+def tags_from_file_name(file_path: Path) -> list:
+    """
+    Derive tags from a file name such as 'wave-sea-blue-beach-4162734.jpg', which is how downloaded files are named.
+
+    :param file_path: The Path of the photo.
+    :return: The list of tags, or ['all'] if none could be derived.
+    """
+    parts = [p.strip().lower() for p in file_path.stem.split('-')]
+    if parts and parts[-1].isdigit():
+        # The trailing id is not a tag
+        parts = parts[:-1]
+    tags = [p for p in parts if p and not p.isdigit()]
+    return tags if tags else ['all']
+
+
+def synchronized(item):
+    @wraps(item)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return item(self, *args, **kwargs)
+    return wrapper
+
+
+class ConfigChange:
+    """ An option that changed when the configuration file was reloaded. A value of None means it is not set. """
+    def __init__(self, section: str, name: str, old_value: Optional[str], new_value: Optional[str]):
+        self.section = section
+        self.name = name
+        self.old_value = old_value
+        self.new_value = new_value
+
+    def get(self, fallback: Optional[str] = None) -> Optional[str]:
+        return self.new_value if self.new_value is not None else fallback
+
+    def getint(self, fallback: Optional[int] = None) -> Optional[int]:
+        return int(self.new_value) if self.new_value is not None else fallback
+
+    def getfloat(self, fallback: Optional[float] = None) -> Optional[float]:
+        return float(self.new_value) if self.new_value is not None else fallback
+
+    def getboolean(self, fallback: Optional[bool] = None) -> Optional[bool]:
+        if self.new_value is None:
+            return fallback
+        if self.new_value.lower() not in ConfigParser.BOOLEAN_STATES:
+            raise ValueError(f'Not a boolean: {self.new_value}')
+        return ConfigParser.BOOLEAN_STATES[self.new_value.lower()]
+
+    def __repr__(self):
+        return f'[{self.section}] {self.name}: {self.old_value!r} -> {self.new_value!r}'
+
+
 class Configuration:
 
-    def __init__(self, config_dir: Optional[Path] = None, config_file_name: Optional[str] = None):
+    def __init__(self, config_dir: Optional[Path] = None, config_file_name: Optional[str] = None,
+                 cfg: Optional[ConfigParser] = None):
+        """
+        :param cfg: The ConfigParser to load into and keep up to date, e.g. CONFIG. Defaults to a new one.
+        """
         self.log = logging.getLogger('frame.Configuration')
-        self.cfg = ConfigParser()
+        self.cfg = cfg if cfg is not None else ConfigParser()
         if config_dir:
             self.config_dir = config_dir
         else:
@@ -93,14 +153,125 @@ class Configuration:
         # Initialized indicates whether or not the config data has been loaded
         # The config data is not loaded until load() is called.
         self.initialized = False
+        self.listeners = []
+        self.values = {}
+        self.file_state = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
 
     def load(self, reload=False):
         if not self.initialized or reload:
             self.log.info('Loading configuration')
             with self.config_file.open('r') as cf:
-                self.cfg.read(cf)
+                self.cfg.read_file(cf)
+            self.values = self.read_values()
+            self.file_state = self.stat()
             self.initialized = True
 
+    def add_listener(self, listener):
+        """ Register a callable that receives the list of ConfigChanges each time the file is reloaded. """
+        self.listeners.append(listener)
+
+    def stat(self):
+        try:
+            st = os.stat(self.config_file)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def read_values(self) -> dict:
+        """
+        Read the options set in the file, by (section, name). DEFAULT is read as an ordinary section, so that options
+        are not repeated in every section that inherits them.
+        """
+        parser = ConfigParser(default_section='\0', interpolation=None)
+        with self.config_file.open('r') as cf:
+            parser.read_file(cf)
+        return {(section, name): value for section in parser.sections() for name, value in parser.items(section)}
+
+    @synchronized
+    def reload(self) -> list:
+        """
+        Re-read the file, applying only the options that changed, and notify the listeners of the changes.
+
+        :return: the list of ConfigChanges, empty if nothing changed or the file could not be read.
+        """
+        self.file_state = self.stat()
+        try:
+            values = self.read_values()
+        except (OSError, ConfigError) as e:
+            self.log.error('Could not reload %s, keeping the current configuration: %s', self.config_file, e)
+            return []
+
+        candidates = [ConfigChange(section, name, self.values.get((section, name)), values.get((section, name)))
+                      for section, name in sorted(self.values.keys() | values.keys())
+                      if self.values.get((section, name)) != values.get((section, name))]
+        old_sections = {s for s, _ in self.values}
+        changes = []
+        for change in candidates:
+            key = (change.section, change.name)
+            try:
+                self.apply(change)
+            except (ConfigError, ValueError) as e:
+                # The option keeps its current value, and is applied again once it is fixed in the file.
+                self.log.error('Could not apply %s: %s', change, e)
+                continue
+            if change.new_value is None:
+                self.values.pop(key, None)
+            else:
+                self.values[key] = change.new_value
+            changes.append(change)
+        # Sections whose options were all removed, which keeps any with an option that could not be applied.
+        for section in old_sections - {s for s, _ in self.values}:
+            if section != self.cfg.default_section and self.cfg.has_section(section):
+                self.cfg.remove_section(section)
+
+        for change in changes:
+            self.log.info('Configuration changed: %s', change)
+        if changes:
+            for listener in self.listeners:
+                try:
+                    listener(changes)
+                except Exception as e:
+                    self.log.exception('Could not apply configuration changes: %s', e)
+        return changes
+
+    def apply(self, change: ConfigChange):
+        if change.new_value is None:
+            self.cfg.remove_option(change.section, change.name)
+            return
+        if change.section != self.cfg.default_section and not self.cfg.has_section(change.section):
+            self.cfg.add_section(change.section)
+        self.cfg.set(change.section, change.name, change.new_value)
+
+    def watch(self, interval: float = 2.0):
+        """ Reload the file whenever it changes, checking every interval seconds on a background thread. """
+        if self._thread:
+            return
+        self.load()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(interval,), name='ConfigurationWatcher', daemon=True)
+        self._thread.start()
+        self.log.info('Watching %s for changes', self.config_file)
+
+    def stop_watching(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, interval: float):
+        while not self._stop.wait(interval):
+            state = self.stat()
+            # A missing file is usually an editor part way through saving, so wait for it to reappear.
+            if state and state != self.file_state:
+                try:
+                    self.reload()
+                except Exception as e:
+                    # Keep watching, so the next save still applies.
+                    self.log.exception('Could not reload %s: %s', self.config_file, e)
+
     def add(self, section: str, name: str, value: str):
         if section not in self.cfg:
             self.cfg.add_section(section)
@@ -128,10 +299,3 @@ class Configuration:
         with self.config_file.open('w') as cf:
             self.cfg.write(cf)
 
-
-def synchronized(item):
-    @wraps(item)
-    def wrapper(self, *args, **kwargs):
-        with self._lock:
-            return item(self, *args, **kwargs)
-    return wrapper
@@ -0,0 +1,115 @@
+import logging
+import math
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from pathlib import Path
+from typing import Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from common import synchronized
+from metrics import PRESSURE_DROP
+from photo import Photo
+
+
+def decode_to_shared_memory(file_path: str, title: str, size: Optional[Tuple[int, int]], with_title: bool):
+    """
+    Decode and resize a photo in a worker process, leaving the RGB pixels in a new shared memory block.
+
+    Ownership of the block passes to the caller, which must unlink it. Spawned workers share the caller's resource
+    tracker, so the block stays registered until the caller unlinks it, and is not removed when the worker exits.
+
+    :return: a tuple of the shared memory name, width and height.
+    """
+    image = Photo(Path(file_path), title).as_image(with_title=with_title, size=size).convert('RGB')
+    pixels = np.asarray(image)
+    shm = SharedMemory(create=True, size=pixels.nbytes)
+    try:
+        np.ndarray(pixels.shape, dtype=np.uint8, buffer=shm.buf)[:] = pixels
+    finally:
+        shm.close()
+    return shm.name, image.width, image.height
+
+
+class BatchDecoder:
+    """ Decodes batches of photos in parallel on a process pool, which is only started when first needed. """
+    def __init__(self, workers: Optional[int] = None):
+        self.log = logging.getLogger('frame.BatchDecoder')
+        self.workers = workers
+        self.executor = None
+        # Held while decoding, so the memory governor cannot stop the pool part way through a batch.
+        self._lock = threading.RLock()
+
+    @synchronized
+    def decode(self, photos, size: Optional[Tuple[int, int]] = None, with_title: bool = False):
+        """
+        Decode the provided photos in parallel.
+
+        :param photos: The Photos to decode.
+        :param size: The (width, height) box to fit each image into.
+        :param with_title: Draw the title of each photo onto its image.
+        :return: a list of (Image, title) tuples, in the same order as photos. Photos that fail to decode are skipped.
+        """
+        if not self.executor:
+            # Spawned rather than forked, as forking a process that runs several threads can copy a held lock.
+            self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                mp_context=multiprocessing.get_context('spawn'))
+        futures = [(p, self.executor.submit(decode_to_shared_memory, str(p.file_path), p.title, size, with_title))
+                   for p in photos]
+        decoded = []
+        for photo, future in futures:
+            try:
+                name, width, height = future.result()
+            except Exception as e:
+                self.log.error('Could not decode %s: %s', photo.file_path, e)
+                continue
+            shm = SharedMemory(name=name)
+            try:
+                image = Image.frombuffer('RGB', (width, height), shm.buf, 'raw', 'RGB', 0, 1).copy()
+            finally:
+                shm.close()
+                shm.unlink()
+            decoded.append((image, photo.title))
+        return decoded
+
+    def shrink(self, level):
+        """
+        A MemoryGovernor hook. Under heavy pressure, stops the worker processes, which restart when next needed.
+        """
+        if level >= PRESSURE_DROP and self.executor:
+            self.log.info('Stopping the decoder processes to free memory')
+            self.shutdown()
+        return None
+
+    @synchronized
+    def shutdown(self):
+        if self.executor:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+
+
+def compose_mosaic(images, tile_size: Tuple[int, int] = (320, 240), columns: Optional[int] = None,
+                   background=(0, 0, 0)) -> Image.Image:
+    """
+    Composite images into a grid, each centred in a tile of tile_size.
+
+    :param images: The Images to composite.
+    :param tile_size: The (width, height) of each tile.
+    :param columns: The number of columns. Defaults to a roughly square grid.
+    :return: the mosaic Image.
+    """
+    if not columns:
+        columns = max(math.ceil(math.sqrt(len(images))), 1)
+    rows = max(math.ceil(len(images) / columns), 1)
+    tile_w, tile_h = tile_size
+    mosaic = Image.new('RGB', (columns * tile_w, rows * tile_h), background)
+    for i, image in enumerate(images):
+        if image.width > tile_w or image.height > tile_h:
+            image = image.copy()
+            image.thumbnail(tile_size)
+        col, row = i % columns, i // columns
+        mosaic.paste(image, (col * tile_w + (tile_w - image.width) // 2, row * tile_h + (tile_h - image.height) // 2))
+    return mosaic
@@ -1,14 +1,24 @@
 import logging
 import random
+import threading
 from concurrent.futures import ThreadPoolExecutor
 
-from categories import JsonCategoryService
+import numpy as np
+from PIL import ImageTk
+
+from categories import JsonCategoryService, SqlDbCategoryService, is_category_list
 from common import DB_FILE_PATH, JSON_STORAGE_PATH, PHOTO_PATH
+from decoding import BatchDecoder, compose_mosaic
 from photo import update_photo_metrics
+from snapshot import (CatalogSnapshot, SnapshotPhotoList, live_photo_ids, read_change_counter, retagged_photo_ids,
+                      write_snapshot)
 
 
 class PhotoFeed:
-    def __init__(self, categories=None, category_service=None):
+    show_titles = False
+
+    def __init__(self, categories=None, category_service=None, decode_workers=None, snapshot_path=None,
+                 sequencer=None, record_metrics=True, decoder=None):
         if not categories:
             categories = 'all'
         if not category_service:
@@ -20,17 +30,154 @@ class PhotoFeed:
             self.log.debug('Temp directory not found. Will attempt to create.')
             self.temp_dir.mkdir(parents=True, exist_ok=True)
         self.current_image = None
+        self.previous_image = None
         self.photo_list = []
         self.photo_count = 0
         self.categories = categories
         self.category_service = category_service
+        # A decoder shared between feeds is shut down by its owner rather than by each feed.
+        self.owns_decoder = decoder is None
+        self.decoder = decoder if decoder else BatchDecoder(decode_workers)
+        self.snapshot_path = snapshot_path
+        self.snapshot = None
+        self.seen_change_counter = None
+        self.sequencer = sequencer
+        # Benchmarks and soak runs turn this off, so they leave the display counts in the database untouched.
+        self.record_metrics = record_metrics
+        self._positions = {}
+        self._positions_list = None
+        self._lock = threading.RLock()
+        # Held for a whole refresh, so a refresh for old categories cannot finish after one for the new categories.
+        self._refresh_lock = threading.RLock()
+        if self.can_use_snapshot(categories):
+            self.open_snapshot()
         self.refresh()
 
+    def can_use_snapshot(self, categories) -> bool:
+        # The snapshot's tag index only resolves plain category lists, searches and queries go to the database.
+        return bool(self.snapshot_path and isinstance(self.category_service, SqlDbCategoryService)
+                    and is_category_list(categories))
+
+    def open_snapshot(self):
+        try:
+            self.snapshot = CatalogSnapshot(self.snapshot_path)
+        except (OSError, ValueError) as e:
+            self.log.warning('Could not use catalog snapshot %s: %s', self.snapshot_path, e)
+            self.snapshot = None
+        self.seen_change_counter = None
+
+    def save_snapshot(self):
+        """ Write a new catalog snapshot and use it for the next refresh, which keeps the catch-up small. """
+        if not self.snapshot_path:
+            return
+        count = write_snapshot(self.category_service.data_path, self.snapshot_path)
+        self.log.info('Saved catalog snapshot of %d photos to %s', count, self.snapshot_path)
+        self.open_snapshot()
+
     def refresh(self):
-        old_size = self.photo_count
-        self.photo_list = list(self.category_service.load_from_categories(self.categories))
-        self.photo_count = len(self.photo_list)
-        self.log.info('Feed photo count: %d -> %d', old_size, self.photo_count)
+        with self._refresh_lock:
+            old_size = self.photo_count
+            if self.snapshot:
+                photo_list = self.catch_up()
+            else:
+                photo_list = list(self.category_service.load_from_categories(self.categories))
+            # Queried without the selection lock, which is only held to swap the list in, so selection is never held up.
+            with self._lock:
+                self.photo_list = photo_list
+                self.photo_count = len(photo_list)
+            self.log.info('Feed photo count: %d -> %d', old_size, self.photo_count)
+            if self.sequencer:
+                self.sequencer.update()
+
+    def set_categories(self, categories):
+        """ Show different categories, querying the photos for them but keeping the snapshot, decoder and caches. """
+        with self._refresh_lock:
+            self.log.info('Changing categories from %s to %s', self.categories, categories)
+            self.categories = categories
+            if not self.can_use_snapshot(categories):
+                self.snapshot = None
+            elif not self.snapshot:
+                self.open_snapshot()
+            # Build the list from the snapshot even when the database has not changed since the last refresh.
+            self.seen_change_counter = None
+            self.refresh()
+
+    def catch_up(self):
+        """
+        Build the photo list from the snapshot, applying only what changed in the database since it was written.
+
+        Photos added since the snapshot are loaded by id, and disabled or deleted rows are dropped by id. Photos that
+        were re-enabled or given tags since the snapshot was written are reloaded from the database.
+        """
+        data_path = self.category_service.data_path
+        change_counter = read_change_counter(data_path)
+        if change_counter == self.seen_change_counter:
+            return self.photo_list
+
+        snapshot = self.snapshot
+        photos = SnapshotPhotoList(snapshot, snapshot.indexes_for(self.categories))
+        if change_counter != snapshot.change_counter:
+            live_ids = live_photo_ids(data_path, snapshot.max_photo_id)
+            changed = np.union1d(np.setdiff1d(live_ids, snapshot.records['id']),
+                                 retagged_photo_ids(data_path, snapshot.max_mapping_id, snapshot.max_photo_id))
+            photos = photos.without_ids(np.setdiff1d(live_ids, changed))
+            reloaded = []
+            if len(changed):
+                reloaded = list(self.category_service.load_from_categories(self.categories, ids=changed.tolist()))
+            added = list(self.category_service.load_from_categories(self.categories, since_id=snapshot.max_photo_id))
+            photos = photos + reloaded + added
+            self.log.info('Caught up with the database: %d photos added and %d reloaded since the snapshot',
+                          len(added), len(reloaded))
+        self.seen_change_counter = change_counter
+        return photos
+
+    def accepts(self, tags) -> bool:
+        """
+        Determine whether a photo with the provided tags belongs in this feed.
+
+        :param tags: The list of tags for the photo.
+        :return: True if the photo matches the categories of this feed.
+        """
+        if not is_category_list(self.categories):
+            # Searches and queries are resolved by the database, so these photos are picked up by the next refresh.
+            return False
+        if isinstance(self.categories, str):
+            wanted = {x.strip() for x in self.categories.split(',')}
+        else:
+            wanted = {x.strip() for x in self.categories}
+        return 'all' in wanted or not wanted.isdisjoint(tags)
+
+    def add_photos(self, photos):
+        """ Add newly discovered photos to the feed without a full refresh. """
+        if not photos:
+            return
+        with self._lock:
+            if isinstance(self.photo_list, SnapshotPhotoList):
+                new_photos = [p for p in photos if not self.photo_list.has_path(p.file_path)]
+            else:
+                known = {p.file_path for p in self.photo_list}
+                new_photos = [p for p in photos if p.file_path not in known]
+            # Build a new list and swap it in, so readers on other threads never see a partially updated list.
+            self.photo_list = self.photo_list + new_photos
+            self.photo_count = len(self.photo_list)
+        self.log.info('Added %d photos to the feed. Feed photo count: %d', len(new_photos), self.photo_count)
+        if self.sequencer:
+            self.sequencer.update()
+
+    def remove_photos(self, file_paths):
+        """ Remove the photos for the provided file paths from the feed without a full refresh. """
+        removed = set(file_paths)
+        if not removed:
+            return
+        with self._lock:
+            old_size = self.photo_count
+            if isinstance(self.photo_list, SnapshotPhotoList):
+                self.photo_list = self.photo_list.without_paths(removed)
+            else:
+                self.photo_list = [p for p in self.photo_list if p.file_path not in removed]
+            self.photo_count = len(self.photo_list)
+        self.log.info('Removed %d photos from the feed. Feed photo count: %d',
+                      old_size - self.photo_count, self.photo_count)
 
     @property
     def has_photos(self):
@@ -42,25 +189,112 @@ class PhotoFeed:
     def __next__(self):
         return self.next()
 
-    def next(self):
-        if self.has_photos:
-            selected = random.choice(self.photo_list)
+    def select(self):
+        """
+        Choose the next photo to display and record that it was displayed.
+
+        :return: the selected Photo.
+        """
+        with self._lock:
+            # The pick is made from this one list, as other threads swap in new lists.
+            photo_list = self.photo_list
+            if not photo_list:
+                raise StopIteration()
+            selected = self.choose_next(photo_list) if self.sequencer else None
+            if selected is None:
+                selected = random.choice(photo_list)
+            if self.sequencer:
+                self.sequencer.shown(selected.id)
+            # With a transition, the previous photo is still on screen while the selected one is prepared.
+            self.previous_image = self.current_image
+            self.current_image = selected
+        if self.record_metrics:
             with ThreadPoolExecutor(max_workers=1) as executor:
                 executor.submit(update_photo_metrics, DB_FILE_PATH, selected)
-            return selected.as_photo_image(), selected.title
-        else:
-            raise StopIteration()
+        return selected
 
-    def next_x(self, count=5):
+    def positions(self, photo_list) -> dict:
+        """ The position of each photo in the photo list by id, rebuilt whenever a new list is swapped in. """
+        if photo_list is not self._positions_list:
+            if isinstance(photo_list, SnapshotPhotoList):
+                ids = photo_list.ids()
+            else:
+                ids = [p.id for p in photo_list]
+            self._positions = {photo_id: i for i, photo_id in enumerate(ids) if photo_id is not None}
+            self._positions_list = photo_list
+        return self._positions
+
+    def choose_next(self, photo_list):
+        """
+        Ask the sequencer for a photo similar to the current one.
+
+        :param photo_list: The photo list to choose from, which the positions are built from and the pick read from.
+        :return: the Photo, or None to choose at random.
+        """
+        positions = self.positions(photo_list)
+        current_id = self.current_image.id if self.current_image else None
+        photo_id = self.sequencer.choose(current_id, positions)
+        if photo_id is None:
+            return None
+        return photo_list[positions[photo_id]]
+
+    def next(self):
+        selected = self.select()
+        return selected.as_photo_image(with_title=self.show_titles), selected.title
+
+    def next_image(self, size=None):
+        """ Like next, but returns a Pillow Image, which does not require a display. """
+        selected = self.select()
+        return selected.as_image(with_title=self.show_titles, size=size), selected.title
+
+    def sample(self, count):
         sample_size = count if count <= self.photo_count else self.photo_count
-        sample = random.sample(self.photo_list, sample_size)
-        return [(s.as_photo_image(), s.title) for s in sample]
+        return random.sample(self.photo_list, sample_size)
+
+    def next_x_images(self, count=5, size=None):
+        """
+        Decode a random sample of photos in parallel, on the decoder's process pool.
+
+        :return: a list of (Image, title) tuples.
+        """
+        return self.decoder.decode(self.sample(count), size=size, with_title=self.show_titles)
+
+    def next_x(self, count=5, size=None):
+        return [(ImageTk.PhotoImage(image), title) for image, title in self.next_x_images(count, size)]
+
+    def next_mosaic(self, count=9, tile_size=(320, 240), columns=None):
+        """
+        Composite a random sample of photos into a single contact sheet image.
+
+        :return: a tuple of the mosaic Image and the list of titles it contains.
+        """
+        decoded = self.decoder.decode(self.sample(count), size=tile_size)
+        mosaic = compose_mosaic([image for image, _ in decoded], tile_size=tile_size, columns=columns)
+        return mosaic, [title for _, title in decoded]
+
+    def shrink(self, level):
+        """
+        A MemoryGovernor hook. Releases the images held by photos that have been displayed, apart from the slide on
+        screen and the one being prepared, which the display and transition threads may still be using.
+        """
+        freed = 0
+        with self._lock:
+            in_use = (self.current_image, self.previous_image)
+            # Snapshot lists create their Photos on access, so only plain lists hold on to images.
+            if isinstance(self.photo_list, list):
+                for photo in self.photo_list:
+                    if not any(photo is p for p in in_use):
+                        freed += photo.release()
+        return freed
+
+    def shutdown(self):
+        if self.owns_decoder:
+            self.decoder.shutdown()
 
 
 class TitledPhotoFeed(PhotoFeed):
-    def next(self):
-        if self.has_photos:
-            selected = random.choice(self.photo_list)
-            return selected.as_photo_image(with_title=True), selected.title
-        else:
-            raise StopIteration()
+    show_titles = True
+
+    def __init__(self, *args, record_metrics=False, **kwargs):
+        # Titled feeds have never counted towards the display metrics.
+        super().__init__(*args, record_metrics=record_metrics, **kwargs)
@@ -1,46 +1,164 @@
 import logging
-import tkinter as tk
+import time
+from typing import Optional
 
-from common import CONFIG, LOGGING_FILE_PATH
+from PIL import UnidentifiedImageError
+
+from animation import AnimationCache
+from backends import RenderBackend, TkBackend
+from common import CONFIG
 from feeds import PhotoFeed, TitledPhotoFeed
+from remote import RemotePhotoFeed
+from transitions import CrossfadeRenderer
 
 
-class SlideShowFrame(tk.Tk):
-    """Tk window/label adjusts to size of image"""
-    def __init__(self, image_files, x, y, delay):
-        tk.Tk.__init__(self)
-        self.geometry(f'+{x}+{y}')
+class SlideShowFrame:
+    """Cycles through the images of a feed, sending them to a render backend (a Tk window by default)"""
+    def __init__(self, image_files, x, y, delay, transition: Optional[CrossfadeRenderer] = None,
+                 backend: Optional[RenderBackend] = None, animations: Optional[AnimationCache] = None):
+        if not backend:
+            backend = TkBackend(x, y)
+        self.backend = backend
         self.delay = delay
         self.log = logging.getLogger('frame.SlideShowFrame')
         self.pictures = image_files
-        self.picture_display = tk.Label(self)
-        self.picture_display.pack()
+        self.transition = transition
+        if transition and not transition.size:
+            transition.size = backend.screen_size
+        self.current_image = None
+        self.pending_transition = None
+        self.animations = animations
+
+    @classmethod
+    def for_server(cls, server_url, x, y, delay, client_name=None, size=None):
+        """
+        Create a thin client frame that displays slides rendered by a RenderServer.
+
+        If size is not provided, slides are requested at the size of the screen.
+        """
+        feed = RemotePhotoFeed(server_url, client_name=client_name, size=size)
+        frame = cls(feed, x, y, delay)
+        if not size and not client_name:
+            feed.size = frame.backend.screen_size
+        feed.start()
+        return frame
 
     def show_slides(self):
         """cycle through the images and show them"""
-        img_object, img_name = next(self.pictures)
-        self.picture_display.config(image=img_object)
-        self.picture_display.image = img_object
+        if self.backend.stopped:
+            return
+        if self.transition:
+            self.show_slides_with_transition()
+            return
+        try:
+            image, img_name = self.pictures.next_image()
+        except (OSError, UnidentifiedImageError) as e:
+            # A missing or corrupt file skips to the next photo rather than ending the slideshow.
+            self.log.error('Could not load the next slide: %s', e)
+            self.backend.schedule(self.delay, self.show_slides)
+            return
         # shows the image filename, but could be expanded
         # to show an associated description of the image
-        self.title(img_name)
-        self.after(self.delay, self.show_slides)
+        self.backend.show(image, img_name)
+        self.log.info('Displaying: %s', img_name)
+        # PhotoFeed keeps the selected Photo, which is needed to find animations.
+        photo = getattr(self.pictures, 'current_image', None)
+        if self.animations and photo is not None and photo.file_path.suffix.lower() == '.gif':
+            # The first frame is already showing, playback starts once the frames are decoded.
+            pending = self.animations.get(photo, self.backend.screen_size, self.pictures.show_titles)
+            self._play_animation(pending, 0, time.monotonic() + self.delay / 1000)
+            return
+        self.backend.schedule(self.delay, self.show_slides)
+
+    def _play_animation(self, pending, index, ends_at):
+        """ Show the frames of an animation until the slide's delay has passed, without waiting on the decode. """
+        if self.backend.stopped:
+            return
+        remaining_ms = int((ends_at - time.monotonic()) * 1000)
+        if remaining_ms <= 0:
+            # Scheduled rather than called, so consecutive animations with no delay do not recurse.
+            self.backend.schedule(0, self.show_slides)
+            return
+        animation = pending.result() if pending.done() else None
+        if not animation:
+            if pending.done():
+                # Not animated, or too large to decode, so the first frame stays up.
+                self.backend.schedule(remaining_ms, self.show_slides)
+            else:
+                self.backend.schedule(min(50, remaining_ms), self._play_animation, pending, index, ends_at)
+            return
+        index %= len(animation)
+        self.backend.show(animation.frames[index])
+        self.backend.schedule(min(animation.durations[index], remaining_ms), self._play_animation, pending,
+                              index + 1, ends_at)
+
+    def show_slides_with_transition(self):
+        """cycle through the images, crossfading between them with frames prepared by the transition renderer"""
+        if self.backend.stopped:
+            return
+        try:
+            image, img_name = self.pictures.next_image(size=self.transition.size)
+        except (OSError, UnidentifiedImageError) as e:
+            self.log.error('Could not load the first slide: %s', e)
+            self.backend.schedule(self.delay, self.show_slides_with_transition)
+            return
+        self._show_slide(self.transition.fit(image), img_name)
+
+    def _show_slide(self, image, img_name):
+        if self.backend.stopped:
+            return
+        self.backend.show(image, img_name)
         self.log.info('Displaying: %s', img_name)
+        self.current_image = image
+        self.pending_transition = self.transition.prepare(self.pictures, image)
+        self.backend.schedule(self.delay, self._start_transition)
+
+    def _start_transition(self):
+        if not self.pending_transition.done():
+            # The worker is still rendering. Check back shortly rather than blocking the main loop.
+            self.backend.schedule(50, self._start_transition)
+            return
+        try:
+            frames, upcoming, img_name = self.pending_transition.result()
+        except Exception:
+            self.log.exception('Could not prepare the next slide')
+            self.pending_transition = self.transition.prepare(self.pictures, self.current_image)
+            self.backend.schedule(self.delay, self._start_transition)
+            return
+        self._play_transition(frames, 0, 0, upcoming, img_name, time.monotonic())
+
+    def _play_transition(self, frames, index, shown, upcoming, img_name, due):
+        """
+        Show a frame of the transition, dropping frames when the display is behind.
+
+        :param due: The monotonic time the frame was scheduled for, so a main loop running late counts as lateness.
+        """
+        if index >= len(frames):
+            self.transition.report(shown, len(frames))
+            self._show_slide(upcoming, img_name)
+            return
+        if self.backend.stopped:
+            return
+        self.backend.show(frames[index])
+        now = time.monotonic()
+        skip = self.transition.frames_to_skip((now - due) * 1000)
+        next_due = due + (1 + skip) * self.transition.frame_budget_ms / 1000
+        wait_ms = max(int((next_due - now) * 1000), 1)
+        self.backend.schedule(wait_ms, self._play_transition, frames, index + 1 + skip, shown + 1, upcoming, img_name,
+                              next_due)
 
     def run(self):
-        self.mainloop()
+        self.backend.run()
 
 
 if __name__ == '__main__':
 
-    import json
-    import logging.config
     from categories import CategoryService
+    from logs import configure_logging
 
     # Demo only the frame, assuming there are some existing images.
 
-    with LOGGING_FILE_PATH.open('r') as lc:
-        logging.config.dictConfig(json.load(lc))
+    configure_logging()
 
     frame_config = CONFIG['DEFAULT']
     _delay = frame_config.getint('delay_ms')
@@ -0,0 +1,192 @@
+"""
+Local, CPU-only labelling of photos, for frames that cannot use Rekognition.
+
+Labels are derived from a small thumbnail, so they describe the look of a photo rather than what is in it:
+its dominant colours, brightness, orientation and colourfulness.
+"""
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Optional, Tuple, Union
+
+import numpy as np
+from PIL import Image
+
+from categories import CategoryService, is_image_file
+from common import PHOTO_PATH
+from photo import Photo
+
+THUMBNAIL_SIZE = (128, 128)
+
+# The upper bound of each hue range in degrees. Red appears twice because it wraps around 0.
+HUES = [
+    (15, 'red'),
+    (40, 'orange'),
+    (70, 'yellow'),
+    (165, 'green'),
+    (195, 'cyan'),
+    (255, 'blue'),
+    (290, 'purple'),
+    (345, 'pink'),
+    (360, 'red'),
+]
+HUE_EDGES = np.array([0] + [edge for edge, _ in HUES], dtype=np.float32)
+
+# Pixels less saturated or darker than these have no meaningful hue.
+MIN_SATURATION = 0.25
+MIN_VALUE = 0.2
+
+DARK_LUMA = 0.25
+BRIGHT_LUMA = 0.7
+
+# Hasler and Suesstrunk's colourfulness metric: below 15 is 'not colourful', above 59 is 'quite colourful'.
+MUTED_COLOURFULNESS = 15
+COLOURFUL_COLOURFULNESS = 59
+MONOCHROME_COLOURFULNESS = 3
+
+SQUARE_TOLERANCE = 0.05
+PANORAMA_RATIO = 2.0
+
+
+def hue_fractions(pixels: np.ndarray) -> dict:
+    """
+    The fraction of all pixels that fall into each named hue.
+
+    :param pixels: An (N, 3) array of RGB values scaled to 0-1.
+    :return: a dict of colour name to fraction.
+    """
+    r, g, b = pixels[:, 0], pixels[:, 1], pixels[:, 2]
+    max_c = pixels.max(axis=1)
+    min_c = pixels.min(axis=1)
+    delta = max_c - min_c
+    saturation = np.divide(delta, max_c, out=np.zeros_like(delta), where=max_c > 0)
+    chromatic = (saturation >= MIN_SATURATION) & (max_c >= MIN_VALUE)
+
+    safe_delta = np.where(delta > 0, delta, 1)
+    hue = np.select([max_c == r, max_c == g],
+                    [((g - b) / safe_delta) % 6, (b - r) / safe_delta + 2],
+                    (r - g) / safe_delta + 4) * 60
+
+    counts, _ = np.histogram(hue[chromatic], bins=HUE_EDGES)
+    fractions = {}
+    for (_, name), count in zip(HUES, counts):
+        fractions[name] = fractions.get(name, 0.0) + count / len(pixels)
+    return fractions
+
+
+def colourfulness(pixels: np.ndarray) -> float:
+    """ Hasler and Suesstrunk's colourfulness metric, for RGB values scaled to 0-255. """
+    rg = pixels[:, 0] - pixels[:, 1]
+    yb = 0.5 * (pixels[:, 0] + pixels[:, 1]) - pixels[:, 2]
+    return float(np.hypot(rg.std(), yb.std()) + 0.3 * np.hypot(rg.mean(), yb.mean()))
+
+
+def orientation(size: Tuple[int, int]) -> str:
+    width, height = size
+    ratio = width / height
+    if abs(ratio - 1) <= SQUARE_TOLERANCE:
+        return 'square'
+    if ratio >= PANORAMA_RATIO or ratio <= 1 / PANORAMA_RATIO:
+        return 'panorama'
+    return 'landscape' if ratio > 1 else 'portrait'
+
+
+def compute_labels(file_path: Union[str, Path], min_coverage: float = 20.0) -> list:
+    """
+    Label a photo from a thumbnail of it. Runs in worker processes, so it only takes and returns plain values.
+
+    :param file_path: The photo to label.
+    :param min_coverage: The percentage of the photo a colour must cover to be labelled as a dominant colour.
+    :return: the list of labels.
+    """
+    with Image.open(file_path) as original:
+        size = original.size
+        original.draft('RGB', THUMBNAIL_SIZE)
+        image = original.convert('RGB')
+    image.thumbnail(THUMBNAIL_SIZE)
+    pixels = np.asarray(image, dtype=np.float32).reshape(-1, 3)
+
+    labels = [orientation(size)]
+
+    luma = float((pixels @ np.array([0.299, 0.587, 0.114], dtype=np.float32)).mean()) / 255
+    if luma < DARK_LUMA:
+        labels.append('dark')
+    elif luma > BRIGHT_LUMA:
+        labels.append('bright')
+
+    score = colourfulness(pixels)
+    if score < MONOCHROME_COLOURFULNESS:
+        labels.append('monochrome')
+    elif score < MUTED_COLOURFULNESS:
+        labels.append('muted')
+    elif score > COLOURFUL_COLOURFULNESS:
+        labels.append('colorful')
+
+    fractions = hue_fractions(pixels / 255)
+    labels.extend(name for name, fraction in fractions.items() if fraction * 100 >= min_coverage)
+    return labels
+
+
+class LocalLabelService:
+    """ Labels photos locally, offering the same interface as RekognitionService. """
+    def __init__(self, workers: Optional[int] = None):
+        self.log = logging.getLogger('frame.LocalLabelService')
+        self.workers = workers
+
+    def load_categories_for_photo(self, photo: Union[Photo, Path], confidence=None):
+        """
+        Label a single photo.
+
+        :param confidence: The percentage of the photo a colour must cover to be labelled as a dominant colour.
+        """
+        if not confidence:
+            confidence = 20.0
+        file_path = photo.file_path if isinstance(photo, Photo) else photo
+        try:
+            labels = compute_labels(file_path, confidence)
+        except Exception as e:
+            self.log.error('Could not label %s: %s', file_path, e)
+            return []
+        self.log.info('Labelled %s as %s', file_path, labels)
+        return labels
+
+    def label_directory(self, category_service: CategoryService, directory: Path = None, confidence=None):
+        """
+        Label every photo in a directory in parallel, on a process pool, and save the labels as categories.
+
+        :return: the number of photos labelled.
+        """
+        if not directory:
+            directory = PHOTO_PATH
+        if not confidence:
+            confidence = 20.0
+        files = [entry for entry in directory.iterdir() if is_image_file(entry)]
+        entries = []
+        # Spawned rather than forked, as the logging listener threads are already running.
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = [(f, executor.submit(compute_labels, str(f), confidence)) for f in files]
+            for file_path, future in futures:
+                try:
+                    entries.append((file_path, future.result()))
+                except Exception as e:
+                    self.log.error('Could not label %s: %s', file_path, e)
+        saved = category_service.save_all_to_categories(entries)
+        self.log.info('Labelled %d photos in %s', len(saved), directory)
+        return len(saved)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Label every photo in a directory and save the labels as categories.')
+    parser.add_argument('directory', nargs='?', type=Path, default=PHOTO_PATH)
+    parser.add_argument('--workers', type=int, help='the number of worker processes, defaults to one per CPU')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    service = CategoryService.load('sql')
+    try:
+        print(LocalLabelService(args.workers).label_directory(service, args.directory))
+    finally:
+        service.shutdown()
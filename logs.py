@@ -0,0 +1,148 @@
+"""
+Logging set up. Records are handed to a queue and written by a background thread, so formatting and I/O never happen
+on the slide or ingest threads.
+"""
+import atexit
+import json
+import logging
+import logging.config
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+from pathlib import Path
+
+from common import CONFIG, LOGGING_FILE_PATH
+
+_listeners = []
+
+
+class JsonFormatter(logging.Formatter):
+    """ Formats each record as a single line JSON object, for collection by log shippers. """
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            entry['suppressed'] = suppressed
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Limits how often each message is logged, so per-item messages cannot flood the log.
+
+    Each message template, e.g. 'Saved %s', gets a bucket of burst records that refills at per_second. Records that
+    find their bucket empty are dropped, and the count of dropped records is set as the suppressed attribute of the
+    next one that is logged. Warnings and errors are never dropped. At most max_buckets are kept; buckets that have
+    refilled are the first to go, as forgetting them changes nothing.
+    """
+    def __init__(self, per_second: float = 5.0, burst: int = 20, max_buckets: int = 1024):
+        super().__init__()
+        self.per_second = per_second
+        self.burst = burst
+        self.max_buckets = max_buckets
+        self.buckets = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated, suppressed = self.buckets.get(key, (self.burst, now, 0))
+            tokens = min(self.burst, tokens + (now - updated) * self.per_second)
+            if tokens < 1:
+                self.buckets[key] = (tokens, now, suppressed + 1)
+                return False
+            self.buckets[key] = (tokens - 1, now, 0)
+            if len(self.buckets) > self.max_buckets:
+                self._prune(now)
+        if suppressed:
+            # The message is left alone, so it is still the bucket key for the filters of parent loggers.
+            record.suppressed = suppressed
+        return True
+
+    def _prune(self, now):
+        full = [key for key, (tokens, updated, suppressed) in self.buckets.items()
+                if not suppressed and tokens + (now - updated) * self.per_second >= self.burst]
+        for key in full:
+            del self.buckets[key]
+        if len(self.buckets) > self.max_buckets:
+            # Still too many, so forget the least recently updated, losing their suppressed counts.
+            oldest = sorted(self.buckets, key=lambda k: self.buckets[k][1])
+            for key in oldest[:len(self.buckets) - self.max_buckets // 2]:
+                del self.buckets[key]
+
+
+class SuppressedCountQueueHandler(QueueHandler):
+    """ Appends the count of suppressed messages to the queued copy of a record, for text log formats. """
+    def prepare(self, record):
+        record = super().prepare(record)
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            record.msg = record.message = f'{record.msg} ({suppressed} similar messages suppressed)'
+        return record
+
+
+def queue_handlers(logger: logging.Logger, log_filter: logging.Filter = None, json_format: bool = False):
+    """
+    Move the handlers of a logger behind a queue, and start a listener thread that writes to them.
+
+    :param log_filter: A filter applied before records are queued, so dropped records cost almost nothing.
+    """
+    handlers = list(logger.handlers)
+    if not handlers:
+        return
+    if json_format:
+        for handler in handlers:
+            handler.setFormatter(JsonFormatter())
+    log_queue = queue.SimpleQueue()
+    # The JSON format has its own field for the suppressed count.
+    queue_handler = QueueHandler(log_queue) if json_format else SuppressedCountQueueHandler(log_queue)
+    if log_filter:
+        queue_handler.addFilter(log_filter)
+    for handler in handlers:
+        logger.removeHandler(handler)
+    logger.addHandler(queue_handler)
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    _listeners.append(listener)
+
+
+def configure_logging(config_path: Path = None):
+    """
+    Configure logging from the logging configuration file, and then, unless disabled in the [logging] section, move
+    every configured handler behind a queue.
+    """
+    if not config_path:
+        config_path = LOGGING_FILE_PATH
+    with config_path.open('r') as lc:
+        logging.config.dictConfig(json.load(lc))
+
+    if not CONFIG.getboolean('logging', 'use_queue', fallback=True):
+        return
+    json_format = CONFIG.get('logging', 'format', fallback='text').lower() == 'json'
+    per_second = CONFIG.getfloat('logging', 'rate_limit_per_second', fallback=0)
+    burst = CONFIG.getint('logging', 'rate_limit_burst', fallback=20)
+
+    loggers = [logging.getLogger()] + [logger for logger in logging.root.manager.loggerDict.values()
+                                       if isinstance(logger, logging.Logger)]
+    for logger in loggers:
+        # Each logger gets its own filter, as a record that propagates is filtered by the handlers of every logger.
+        queue_handlers(logger, RateLimitFilter(per_second, burst) if per_second else None, json_format)
+
+
+@atexit.register
+def stop_logging():
+    """ Write out any queued records. Called automatically at exit. """
+    while _listeners:
+        _listeners.pop().stop()
@@ -1,55 +1,294 @@
-import json
+import argparse
 import logging
-import logging.config
+from functools import partial
 
+from animation import load_animation_cache
+from backends import OffscreenBackend
 from categories import CategoryService
-from common import CONFIG, LOGGING_FILE_PATH, PHOTO_PATH
+from common import CONFIG, CONFIG_INI_PATH, PHOTO_PATH, Configuration
 from feeds import PhotoFeed, TitledPhotoFeed
 from frame import SlideShowFrame
+from logs import configure_logging
 # from metrics import MemoryMonitor, log_mem_usage
+from reconcile import PhotoReconciler
+from sequencing import load_sequencer
+from server import DEFAULT_PORT, RenderServer, RenditionCache
+from snapshot import SNAPSHOT_PATH
+from metrics import MemoryGovernor
+from profiling import load_profiler
+from storage import StorageManager
 from timers import RepeatedTimer
-from services import PixabayPhotoFeedService, PhotoDownloader
+from transitions import CrossfadeRenderer
+from services import FeedAggregator, PixabayPhotoFeedService, PhotoDownloader, load_feed_sources
+from watcher import LibraryWatcher
 
 
 def update(downloader, feed):
     print('Updating...')
-    downloader.download_feed()
+    # Downloads are left to the FeedAggregator when it is in use.
+    if downloader:
+        downloader.download_feed()
     feed.refresh()
 
 
-def run():
-    with LOGGING_FILE_PATH.open('r') as lc:
-        logging.config.dictConfig(json.load(lc))
-    feed_service = PixabayPhotoFeedService(CONFIG['service.pixabay'])
-    category_service = CategoryService.load('sql')
-    downloader = PhotoDownloader(feed_service, PHOTO_PATH, category_service=category_service)
-    downloader.download_feed()
+def create_governor():
+    """ Create a MemoryGovernor from the [memory] section, or None if no budget is configured. """
+    budget_mb = CONFIG.getint('memory', 'budget_mb', fallback=0)
+    if not budget_mb:
+        return None
+    memory_config = CONFIG['memory']
+    return MemoryGovernor(budget_mb * 1024 * 1024,
+                          min_available_bytes=memory_config.getint('min_available_mb', 64) * 1024 * 1024,
+                          soft_limit=memory_config.getfloat('soft_limit', 0.8),
+                          interval=memory_config.getfloat('interval', 30))
 
-    frame_config = CONFIG['DEFAULT']
-    _delay = frame_config.getint('delay_ms')
 
-    _x = 0
-    _y = 0
+def run_client(frame_config, profiler):
+    """ Run as a thin client, displaying slides rendered by a RenderServer. """
+    client_config = CONFIG['client']
+    size = None
+    if 'width' in client_config and 'height' in client_config:
+        size = (client_config.getint('width'), client_config.getint('height'))
+    app = SlideShowFrame.for_server(client_config.get('server_url', f'http://127.0.0.1:{DEFAULT_PORT}'), 0, 0,
+                                    frame_config.getint('delay_ms'),
+                                    client_name=client_config.get('client_name'), size=size)
+    governor = create_governor()
+    if governor:
+        governor.register('prefetched slides', app.pictures.shrink)
+        governor.start()
+    profiler.attach(app.backend)
+    try:
+        app.show_slides()
+        app.run()
+    finally:
+        if governor:
+            governor.stop()
+        app.pictures.stop()
+
 
-    show_titles = frame_config.getboolean('show_titles')
+def run_headless(frame_config, slides, delay, profiler):
+    """
+    Drive the real feed and render path through the offscreen backend, without downloading or an X display, and
+    report the slides per second achieved.
+    """
+    category_service = CategoryService.load('sql')
     categories = frame_config.get('categories', 'all')
-    if show_titles:
-        _feed = TitledPhotoFeed(categories=categories, category_service=category_service)
-    else:
-        _feed = PhotoFeed(categories=categories, category_service=category_service)
-
-    # mem_thread = RepeatedTimer(60, log_mem_usage)
-    update_interval = frame_config.getint('update_interval', 300)
-    thread = RepeatedTimer(update_interval, update, downloader, _feed)
+    sequencer = load_sequencer()
+    feed_type = TitledPhotoFeed if frame_config.getboolean('show_titles') else PhotoFeed
+    # A benchmark must not count as the photos having been displayed.
+    _feed = feed_type(categories=categories, category_service=category_service, sequencer=sequencer,
+                      record_metrics=False)
+    backend = OffscreenBackend(max_slides=slides)
+    animations = load_animation_cache()
     try:
-        app = SlideShowFrame(_feed, _x, _y, _delay)
+        app = SlideShowFrame(_feed, 0, 0, delay, backend=backend, animations=animations)
+        profiler.attach(backend)
         app.show_slides()
         app.run()
     finally:
-        thread.stop()
+        if animations:
+            animations.shutdown()
+        category_service.shutdown()
+    log = logging.getLogger('frame.main')
+    log.info('Displayed %d slides at %.1f slides/s', backend.slides_shown, backend.slides_per_second)
+    print(f'{backend.slides_shown} slides, {backend.slides_per_second:.1f} slides/s')
+
+
+def apply_config_changes(app, feed, update_timer, changes):
+    """
+    Apply changes to config.ini to the running frame, without restarting it and dropping its caches.
+
+    :param changes: The list of ConfigChanges from Configuration.reload.
+    """
+    log = logging.getLogger('frame.main')
+    for change in changes:
+        # Each change is applied on its own, so one bad value does not hold up the others.
+        try:
+            if change.section != 'DEFAULT':
+                log.warning('Restart the frame to apply %s', change)
+            elif change.name == 'delay_ms':
+                app.delay = change.getint(6000)
+            elif change.name == 'categories':
+                feed.set_categories(change.get('all'))
+            elif change.name == 'show_titles':
+                # The same as swapping between PhotoFeed and TitledPhotoFeed, keeping the loaded photo list.
+                feed.show_titles = change.getboolean(False)
+                feed.record_metrics = not feed.show_titles
+            elif change.name == 'update_interval':
+                update_timer.reschedule(change.getint(300))
+            else:
+                log.warning('Restart the frame to apply %s', change)
+        except Exception as e:
+            log.error('Could not apply %s: %s', change, e)
+
+
+def run_frame(frame_config, mode, profiler):
+    """ Run as a frame, or as a render server for thin clients, downloading and ingesting photos. """
+    source_names = frame_config.get('sources', '')
+    feed_service = None if source_names else PixabayPhotoFeedService(CONFIG['service.pixabay'])
+    category_service = CategoryService.load('sql')
+    # Everything started below is stopped in the finally, however far start up got.
+    _feed = None
+    aggregator = governor = watcher = reconciler = configuration = None
+    thread = snapshot_thread = transition = animations = None
+    try:
+        storage_manager = None
+        quota_mb = CONFIG.getint('storage.quota', 'max_mb', fallback=0)
+        if quota_mb:
+            storage_manager = StorageManager(quota_mb * 1024 * 1024, category_service,
+                                             low_water=CONFIG.getfloat('storage.quota', 'low_water', fallback=0.9))
+        downloader = PhotoDownloader(feed_service, PHOTO_PATH, category_service=category_service,
+                                     storage_manager=storage_manager)
+        if source_names:
+            aggregator = FeedAggregator(downloader, load_feed_sources(source_names, CONFIG),
+                                        download_workers=frame_config.getint('download_workers', 4))
+            aggregator.start()
+        else:
+            downloader.download_feed()
+
+        _delay = frame_config.getint('delay_ms')
+
+        _x = 0
+        _y = 0
+
+        show_titles = frame_config.getboolean('show_titles')
+        categories = frame_config.get('categories', 'all')
+        # 0 uses one worker per CPU
+        decode_workers = frame_config.getint('decode_workers', 0) or None
+        use_snapshot = CONFIG.getboolean('storage.db', 'use_snapshot', fallback=False)
+        snapshot_path = SNAPSHOT_PATH if use_snapshot else None
+        if mode == 'server':
+            server_config = CONFIG['server']
+            _feed = RenderServer(category_service,
+                                 cache=RenditionCache(server_config.getint('cache_mb', 64) * 1024 * 1024),
+                                 host=server_config.get('host', '127.0.0.1'),
+                                 port=server_config.getint('port', DEFAULT_PORT),
+                                 decode_workers=decode_workers, storage_manager=storage_manager)
+        elif show_titles:
+            _feed = TitledPhotoFeed(categories=categories, category_service=category_service,
+                                    decode_workers=decode_workers, snapshot_path=snapshot_path,
+                                    sequencer=load_sequencer())
+        else:
+            _feed = PhotoFeed(categories=categories, category_service=category_service,
+                              decode_workers=decode_workers, snapshot_path=snapshot_path, sequencer=load_sequencer())
+
+        if storage_manager and mode != 'server':
+            storage_manager.add_listener(_feed.remove_photos)
+
+        # Animations are played when there is no transition, which renders each slide as a still.
+        use_crossfade = frame_config.get('transition', 'none').lower() == 'crossfade'
+        animations = load_animation_cache() if mode != 'server' and not use_crossfade else None
+
+        governor = create_governor()
+        if governor:
+            if mode == 'server':
+                governor.register('rendition cache', _feed.cache.shrink)
+            else:
+                governor.register('photo feed', _feed.shrink)
+            governor.register('decoder', _feed.decoder.shrink)
+            if animations:
+                governor.register('animations', animations.shrink)
+            governor.start()
+
+        # mem_thread = RepeatedTimer(60, log_mem_usage)
+        update_interval = frame_config.getint('update_interval', 300)
+        thread = RepeatedTimer(update_interval, update, None if aggregator else downloader, _feed)
+
+        if use_snapshot and mode != 'server':
+            snapshot_interval = CONFIG.getint('storage.db', 'snapshot_interval', fallback=3600)
+            snapshot_thread = RepeatedTimer(snapshot_interval, _feed.save_snapshot)
+
+        if frame_config.getboolean('watch_photos', False):
+            # The render server refreshes its feeds on update, rather than applying deltas.
+            watcher = LibraryWatcher(category_service, _feed if mode != 'server' else None, PHOTO_PATH,
+                                     debounce_ms=frame_config.getint('watch_debounce_ms', 1500))
+            watcher.start()
+
+        if mode != 'server' and frame_config.getboolean('watch_config', False):
+            configuration = Configuration(CONFIG_INI_PATH.parent, CONFIG_INI_PATH.name, cfg=CONFIG)
+            configuration.watch(frame_config.getfloat('watch_config_seconds', 2.0))
+
+        if CONFIG.getboolean('service.reconcile', 'use_service', fallback=False):
+            reconcile_config = CONFIG['service.reconcile']
+            reconciler = PhotoReconciler(chunk_size=reconcile_config.getint('chunk_size', 200),
+                                         pause_seconds=reconcile_config.getfloat('pause_seconds', 1.0))
+            reconciler.start(reconcile_config.getint('interval', 3600))
+
+        if mode == 'server':
+            _feed.serve_forever()
+        else:
+            if use_crossfade:
+                size = None
+                if 'transition_width' in frame_config and 'transition_height' in frame_config:
+                    size = (frame_config.getint('transition_width'), frame_config.getint('transition_height'))
+                transition = CrossfadeRenderer(size, steps=frame_config.getint('transition_steps', 12),
+                                               duration_ms=frame_config.getint('transition_ms', 800))
+            app = SlideShowFrame(_feed, _x, _y, _delay, transition=transition, animations=animations)
+            if governor and transition:
+                # Registered once the frame has set the transition's size from the screen.
+                governor.register('crossfade frames', transition.shrink)
+            if configuration:
+                configuration.add_listener(partial(apply_config_changes, app, _feed, thread))
+            profiler.attach(app.backend)
+            app.show_slides()
+            app.run()
+    finally:
+        if thread:
+            thread.stop()
+        if configuration:
+            configuration.stop_watching()
+        if aggregator:
+            aggregator.stop()
+        if governor:
+            governor.stop()
+        if watcher:
+            watcher.stop()
+        if reconciler:
+            reconciler.stop()
+        if transition:
+            transition.shutdown()
+        if animations:
+            animations.shutdown()
+        if snapshot_thread:
+            snapshot_thread.stop()
+            _feed.save_snapshot()
+        if _feed and mode == 'server':
+            _feed.stop()
+        elif _feed:
+            _feed.shutdown()
         # mem_thread.stop()
         category_service.shutdown()
 
 
+def run(headless=False, slides=None, delay=None, profile=False):
+    configure_logging()
+
+    profiler = load_profiler()
+    if CONFIG.getboolean('profiling', 'use_signal', fallback=True):
+        # Toggle profiling at runtime with: kill -USR1 <pid>
+        profiler.install_signal_handler()
+    if profile:
+        profiler.start()
+
+    frame_config = CONFIG['DEFAULT']
+    mode = frame_config.get('mode', 'frame').lower()
+    try:
+        if headless:
+            run_headless(frame_config, slides, delay if delay is not None else frame_config.getint('delay_ms'),
+                         profiler)
+        elif mode == 'client':
+            run_client(frame_config, profiler)
+        else:
+            run_frame(frame_config, mode, profiler)
+    finally:
+        profiler.stop()
+
+
 if __name__ == '__main__':
-    run()
+    parser = argparse.ArgumentParser(description='Run the photo frame.')
+    parser.add_argument('--headless', action='store_true', help='render offscreen, without a display')
+    parser.add_argument('--slides', type=int, help='stop after this many slides (headless only)')
+    parser.add_argument('--delay', type=int, help='override delay_ms (headless only)')
+    parser.add_argument('--profile', action='store_true', help='profile for the configured window after starting')
+    args = parser.parse_args()
+    run(headless=args.headless, slides=args.slides, delay=args.delay, profile=args.profile)
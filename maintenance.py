@@ -0,0 +1,286 @@
+"""
+Offline maintenance of the photo database: backfills of derived data, and database upkeep.
+
+Backfills walk the photos table in chunks, doing the per-photo work on a process pool and applying each chunk's
+results in a single transaction along with a checkpoint, so an interrupted run resumes where it left off.
+
+    python maintenance.py dimensions
+    python maintenance.py --workers 4 labels
+    python maintenance.py check
+"""
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from functools import partial
+from pathlib import Path
+from typing import Optional, Tuple
+
+from PIL import Image
+
+from categories import SqlDbCategoryService
+from common import DB_STORAGE_PATH, JSON_STORAGE_PATH
+from labels import compute_labels
+from photo import create_title
+from reconcile import ensure_checkpoint_table, load_checkpoint, save_checkpoint
+
+THUMBNAIL_PATH = DB_STORAGE_PATH.parent / 'thumbnails'
+""" The directory that thumbnails are written to, named after their photo, as cached labels are. """
+
+THUMBNAIL_SIZE = (320, 240)
+
+CHUNK_SIZE = 1000
+
+
+# Tasks run in worker processes, so they take and return plain values and report failures by returning None.
+def run_task(task, img_path: str):
+    """ Run a task for one photo, so a photo that fails in any way is counted as failed rather than ending a chunk. """
+    try:
+        return task(img_path)
+    except Exception as e:
+        logging.getLogger('frame.Maintenance').error('Could not process %s: %s', img_path, e)
+        return None
+
+
+def read_dimensions(img_path: str) -> Optional[Tuple[int, int]]:
+    try:
+        with Image.open(img_path) as image:
+            return image.size
+    except OSError:
+        return None
+
+
+def hash_file(img_path: str) -> Optional[str]:
+    try:
+        with open(img_path, 'rb') as f:
+            return hashlib.file_digest(f, 'sha256').hexdigest()
+    except OSError:
+        return None
+
+
+def make_thumbnail(img_path: str, thumbnail_path: Path, size: Tuple[int, int]) -> Optional[str]:
+    thumbnail_file = (thumbnail_path / Path(img_path).name).with_suffix('.jpg')
+    if thumbnail_file.exists():
+        return str(thumbnail_file)
+    try:
+        with Image.open(img_path) as image:
+            image.draft('RGB', size)
+            thumbnail = image.convert('RGB')
+        thumbnail.thumbnail(size)
+        thumbnail.save(thumbnail_file, 'JPEG', quality=80)
+        return str(thumbnail_file)
+    except OSError:
+        return None
+
+
+def label_photo(img_path: str, min_coverage: float) -> Optional[list]:
+    try:
+        return compute_labels(img_path, min_coverage)
+    except OSError:
+        return None
+
+
+def photo_metadata(img_path: str) -> Optional[tuple]:
+    """ The values needed to add a photo to the photos table, as SqlDbCategoryService does. """
+    size = read_dimensions(img_path)
+    if not size:
+        return None
+    path = Path(img_path)
+    return img_path, size[0], size[1], datetime.fromtimestamp(path.stat().st_ctime).isoformat(), create_title(path)
+
+
+class Maintenance:
+    def __init__(self, data_path: Path = None, workers: Optional[int] = None, chunk_size: int = CHUNK_SIZE,
+                 restart: bool = False):
+        self.log = logging.getLogger('frame.Maintenance')
+        self.service = SqlDbCategoryService(data_path)
+        self.db = self.service.db
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.restart = restart
+        self.executor = None
+        ensure_checkpoint_table(self.db)
+
+    def map(self, task, values):
+        """ Run a task over the values on the process pool, which is only started when first needed. """
+        if not self.executor:
+            # Spawned rather than forked, as the logging listener threads are already running.
+            self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                mp_context=multiprocessing.get_context('spawn'))
+        chunksize = max(len(values) // ((self.workers or os.cpu_count() or 1) * 4), 1)
+        return list(self.executor.map(partial(run_task, task), values, chunksize=chunksize))
+
+    def backfill(self, name: str, condition: str, task, apply) -> int:
+        """
+        Run a task for every photo matching the condition, in chunks, applying each chunk's results together.
+
+        :param name: The name of the backfill, used for its checkpoint.
+        :param condition: A SQL condition on the photos table, p, selecting the photos still to process.
+        :param task: A picklable callable taking the photo's path and returning its result, or None on failure.
+        :param apply: A callable taking a list of (photo id, result) tuples, which writes the results.
+        :return: the number of photos processed.
+        """
+        checkpoint_name = f'maintenance.{name}'
+        state = {} if self.restart else load_checkpoint(self.db, checkpoint_name)
+        cursor = state.get('cursor', 0)
+        processed = state.get('processed', 0)
+        failed = state.get('failed', 0)
+        if cursor:
+            self.log.info('Resuming %s after photo %d', name, cursor)
+        while True:
+            rows = self.db.execute(f"""SELECT p.id, p.img_path FROM photos p WHERE p.id > ? AND ({condition})
+                                       ORDER BY p.id LIMIT ?""", [cursor, self.chunk_size]).fetchall()
+            if not rows:
+                break
+            results = self.map(task, [img_path for _, img_path in rows])
+            done = [(photo_id, result) for (photo_id, _), result in zip(rows, results) if result is not None]
+            cursor = rows[-1][0]
+            processed += len(done)
+            failed += len(rows) - len(done)
+            with self.service._lock, self.db:
+                apply(done)
+                save_checkpoint(self.db, checkpoint_name, {'cursor': cursor, 'processed': processed, 'failed': failed})
+            self.log.info('%s: %d photos processed, %d failed, up to photo %d', name, processed, failed, cursor)
+
+        with self.db:
+            save_checkpoint(self.db, checkpoint_name, {'cursor': 0, 'completed': datetime.now().isoformat(),
+                                                       'processed': processed, 'failed': failed})
+        self.log.info('%s complete: %d photos processed, %d failed', name, processed, failed)
+        return processed
+
+    def dimensions(self):
+        def apply(done):
+            self.db.executemany('UPDATE photos SET img_width = ?, img_height = ? WHERE id = ?',
+                                [(w, h, photo_id) for photo_id, (w, h) in done])
+        return self.backfill('dimensions', 'p.img_width IS NULL OR p.img_height IS NULL', read_dimensions, apply)
+
+    def hashes(self):
+        columns = {row[1] for row in self.db.execute('PRAGMA table_info(photos)')}
+        if 'content_hash' not in columns:
+            with self.db:
+                self.db.execute('ALTER TABLE photos ADD COLUMN content_hash text')
+
+        def apply(done):
+            self.db.executemany('UPDATE photos SET content_hash = ? WHERE id = ?',
+                                [(digest, photo_id) for photo_id, digest in done])
+        return self.backfill('hashes', 'p.content_hash IS NULL', hash_file, apply)
+
+    def thumbnails(self, thumbnail_path: Path = None, size: Tuple[int, int] = THUMBNAIL_SIZE):
+        if not thumbnail_path:
+            thumbnail_path = THUMBNAIL_PATH
+        thumbnail_path.mkdir(parents=True, exist_ok=True)
+        # The files are the only output, and existing thumbnails are skipped by the task.
+        return self.backfill('thumbnails', 'coalesce(p.disabled, 0) = 0',
+                             partial(make_thumbnail, thumbnail_path=thumbnail_path, size=size), lambda done: None)
+
+    def labels(self, min_coverage: float = 20.0):
+        return self.backfill('labels', 'coalesce(p.disabled, 0) = 0', partial(label_photo, min_coverage=min_coverage),
+                             self._save_labels)
+
+    def _save_labels(self, done):
+        """
+        Map photos to categories in bulk, creating the categories as needed.
+
+        :param done: A list of (photo id, list of tags) tuples.
+        """
+        tags = {tag for _, labels in done for tag in labels}
+        self.db.executemany('INSERT OR IGNORE INTO categories (tag) VALUES (?)', [(t,) for t in tags])
+        self.db.executemany("""INSERT INTO categories_photos (category_id, photo_id)
+                               SELECT c.id, ? FROM categories c WHERE c.tag = ? AND NOT EXISTS
+                                 (SELECT 1 FROM categories_photos cp
+                                  WHERE cp.category_id = c.id AND cp.photo_id = ?)""",
+                            [(photo_id, tag, photo_id) for photo_id, labels in done for tag in labels])
+
+    def sync_json(self, json_path: Path = None) -> int:
+        """
+        Add the photos and categories from the JSON category files to the database, in bulk.
+
+        :return: the number of photos added.
+        """
+        if not json_path:
+            json_path = JSON_STORAGE_PATH
+        tags_by_path = {}
+        for cat_path in sorted(json_path.glob('*.json')):
+            with cat_path.open('r') as f:
+                for entry in json.load(f):
+                    tags_by_path.setdefault(entry, set()).add(cat_path.stem.lower())
+
+        known = dict(self.db.execute('SELECT img_path, id FROM photos'))
+        missing = sorted(p for p in tags_by_path if p not in known)
+        added = 0
+        for start in range(0, len(missing), self.chunk_size):
+            chunk = [m for m in self.map(photo_metadata, missing[start:start + self.chunk_size]) if m]
+            with self.service._lock, self.db:
+                self.db.executemany("""INSERT INTO photos (img_path, img_width, img_height, date_added, title)
+                                       VALUES (?,?,?,?,?)""", chunk)
+            added += len(chunk)
+            self.log.info('sync-json: %d of %d photos added', added, len(missing))
+
+        known = dict(self.db.execute('SELECT img_path, id FROM photos'))
+        mappings = [(known[p], sorted(tags)) for p, tags in tags_by_path.items() if p in known]
+        for start in range(0, len(mappings), self.chunk_size):
+            with self.service._lock, self.db:
+                self._save_labels(mappings[start:start + self.chunk_size])
+        self.log.info('sync-json complete: %d photos added, %d photos mapped to categories', added, len(mappings))
+        return added
+
+    def vacuum(self):
+        self.log.info('Vacuuming %s', self.service.data_path)
+        with self.service._lock:
+            self.db.execute('VACUUM')
+
+    def analyze(self):
+        with self.service._lock:
+            self.db.execute('ANALYZE')
+            self.db.execute('PRAGMA optimize')
+        self.log.info('Analyzed %s', self.service.data_path)
+
+    def check(self) -> list:
+        """
+        Check the integrity of the database, its foreign keys and its search index.
+
+        :return: a list of the problems found, empty if there were none.
+        """
+        problems = [row[0] for row in self.db.execute('PRAGMA integrity_check') if row[0] != 'ok']
+        problems += [f'Foreign key violation in {row[0]} row {row[1]}'
+                     for row in self.db.execute('PRAGMA foreign_key_check')]
+        try:
+            with self.db:
+                self.db.execute("INSERT INTO photos_fts (photos_fts) VALUES ('integrity-check')")
+        except sqlite3.DatabaseError as e:
+            problems.append(f'Search index: {e}')
+        for problem in problems:
+            self.log.error('Integrity check: %s', problem)
+        self.log.info('Integrity check found %d problems', len(problems))
+        return problems
+
+    def shutdown(self):
+        if self.executor:
+            self.executor.shutdown()
+        self.service.shutdown()
+
+
+if __name__ == '__main__':
+    import argparse
+    from logs import configure_logging
+
+    parser = argparse.ArgumentParser(description='Backfill derived data and maintain the photo database.')
+    parser.add_argument('--workers', type=int, help='the number of worker processes, defaults to one per CPU')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='the number of photos per checkpoint')
+    parser.add_argument('--restart', action='store_true', help='ignore the checkpoint and start from the beginning')
+    parser.add_argument('command', choices=['sync-json', 'dimensions', 'hashes', 'thumbnails', 'labels',
+                                            'vacuum', 'analyze', 'check'])
+    args = parser.parse_args()
+
+    configure_logging()
+    maintenance = Maintenance(workers=args.workers, chunk_size=args.chunk_size, restart=args.restart)
+    try:
+        result = getattr(maintenance, args.command.replace('-', '_'))()
+        if args.command == 'check' and result:
+            raise SystemExit(1)
+    finally:
+        maintenance.shutdown()
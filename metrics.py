@@ -1,7 +1,11 @@
+import ctypes
+import ctypes.util
+import gc
 import logging
 import resource
-
+import threading
 import time
+from typing import Callable, Optional
 
 LOG = logging.getLogger('frame.metrics')
 
@@ -31,4 +35,143 @@ def log_mem_usage():
     # with how I'm using it, but I'll come back to it later.
     # macOS Activity Monitor shows ~240 MB usage.
     usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
-    LOG.info('Current memory usage: %s', usage)
+    LOG.info('Current memory usage: %s, peak: %s', current_rss(), usage)
+
+
+# Memory pressure levels, in increasing order of severity, passed to the shrink hooks.
+PRESSURE_NONE = 0
+PRESSURE_TRIM = 1
+""" Over the soft budget: trim caches back, e.g. to half their size. """
+PRESSURE_DROP = 2
+""" Over the budget: drop caches and prefetched images entirely. """
+PRESSURE_CRITICAL = 3
+""" The system is nearly out of memory: also release anything that can be recreated later, such as worker pools. """
+
+PRESSURE_NAMES = {PRESSURE_NONE: 'none', PRESSURE_TRIM: 'trim', PRESSURE_DROP: 'drop', PRESSURE_CRITICAL: 'critical'}
+
+
+def read_proc_kb(path: str, field: str) -> Optional[int]:
+    """
+    Read a value reported in kB from a /proc file such as /proc/self/status or /proc/meminfo.
+
+    :return: the value in bytes, or None if the file or field is not available, e.g. on macOS.
+    """
+    try:
+        with open(path) as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def current_rss() -> Optional[int]:
+    """ The current resident set size of this process in bytes, unlike ru_maxrss which is the peak. """
+    return read_proc_kb('/proc/self/status', 'VmRSS')
+
+
+def available_memory() -> Optional[int]:
+    """ The memory available to start new work without swapping, in bytes. """
+    return read_proc_kb('/proc/meminfo', 'MemAvailable')
+
+
+def malloc_trim():
+    """ Ask glibc to hand freed heap memory back to the system, which it otherwise keeps for reuse. """
+    name = ctypes.util.find_library('c')
+    if not name:
+        return
+    try:
+        ctypes.CDLL(name).malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+class MemoryGovernor:
+    """
+    Keeps the process within a memory budget by shrinking registered caches and queues under pressure.
+
+    The governor samples the current RSS and the system's available memory on an interval. When either crosses a
+    threshold, each registered shrink hook is called with the pressure level, and is expected to free what it can
+    for that level and return the approximate number of bytes it freed, if known.
+    """
+    def __init__(self, budget_bytes: int, min_available_bytes: int = 64 * 1024 * 1024, soft_limit: float = 0.8,
+                 interval: float = 30):
+        self.log = logging.getLogger('frame.MemoryGovernor')
+        self.budget_bytes = budget_bytes
+        self.soft_bytes = int(budget_bytes * soft_limit)
+        self.min_available_bytes = min_available_bytes
+        self.interval = interval
+        self.hooks = []
+        self.level = PRESSURE_NONE
+        self._stop = threading.Event()
+        self._thread = None
+
+    def register(self, name: str, shrink: Callable[[int], Optional[int]]):
+        """
+        Register a shrink hook.
+
+        :param name: The name of the cache or queue, used when logging.
+        :param shrink: A callable that takes the pressure level and returns the approximate bytes freed, or None.
+        """
+        self.hooks.append((name, shrink))
+
+    def pressure(self, rss: Optional[int], available: Optional[int]) -> int:
+        level = PRESSURE_NONE
+        if rss is not None and self.budget_bytes:
+            if rss > self.budget_bytes:
+                level = PRESSURE_DROP
+            elif rss > self.soft_bytes:
+                level = PRESSURE_TRIM
+        if available is not None and self.min_available_bytes:
+            if available < self.min_available_bytes // 2:
+                level = PRESSURE_CRITICAL
+            elif available < self.min_available_bytes:
+                level = max(level, PRESSURE_DROP)
+            elif available < self.min_available_bytes * 2:
+                level = max(level, PRESSURE_TRIM)
+        return level
+
+    def check(self) -> int:
+        """
+        Sample memory usage and shrink the registered hooks if needed.
+
+        :return: the pressure level.
+        """
+        rss = current_rss()
+        available = available_memory()
+        level = self.pressure(rss, available)
+        if level != self.level:
+            self.log.info('Memory pressure changed from %s to %s (rss: %s, available: %s)',
+                          PRESSURE_NAMES[self.level], PRESSURE_NAMES[level], rss, available)
+            self.level = level
+        if level == PRESSURE_NONE:
+            return level
+
+        for name, shrink in self.hooks:
+            try:
+                freed = shrink(level)
+            except Exception as e:
+                self.log.error('Shrinking %s failed: %s', name, e)
+                continue
+            self.log.info('Shrank %s at pressure %s, freeing about %s bytes', name, PRESSURE_NAMES[level], freed)
+        if level >= PRESSURE_DROP:
+            gc.collect()
+            malloc_trim()
+        self.log.info('Memory after shrinking at pressure %s: rss: %s, available: %s',
+                      PRESSURE_NAMES[level], current_rss(), available_memory())
+        return level
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='MemoryGovernor', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.check()
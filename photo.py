@@ -1,6 +1,8 @@
 import sqlite3
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
+from typing import Optional, Tuple
 
 import inflection
 from PIL import Image, ImageTk, ImageDraw, ImageFont
@@ -9,28 +11,79 @@ from PIL import Image, ImageTk, ImageDraw, ImageFont
 class Photo:
     def __init__(self, file_path: Path, title=None, photo_id=None):
         self.file_path = file_path
-        self.image = Image.open(self.file_path)
+        self._image = None
         self.title = title if title else create_title(file_path)
         self.id = photo_id
 
-    def as_photo_image(self, with_title: bool = False):
+    @property
+    def image(self):
+        """ The image is opened on first use, so that creating a Photo never touches the file. """
+        if self._image is None:
+            self._image = Image.open(self.file_path)
+        return self._image
+
+    def release(self) -> int:
+        """
+        Close the opened image, if any, so its decoded pixels can be freed. It is reopened on next use.
+
+        :return: the approximate number of bytes released.
+        """
+        image, self._image = self._image, None
+        if image is None:
+            return 0
+        # Images that were opened but never drawn still have their tiles to decode, and hold no pixels.
+        size = 0 if image.tile else image.width * image.height * len(image.getbands())
+        image.close()
+        return size
+
+    def as_image(self, with_title: bool = False, size: Optional[Tuple[int, int]] = None):
+        """
+        Render this photo as a Pillow Image, leaving the original image untouched. The original image itself is returned
+        when there is nothing to render, so callers must not modify the result.
+
+        :param with_title: Draw the title onto the rendered image.
+        :param size: The (width, height) box to fit the image into. The original size is kept if not provided.
+        :return: the rendered Image.
+        """
+        if size:
+            with Image.open(self.file_path) as original:
+                # Let the JPEG decoder scale down while decoding, which is much cheaper than resizing afterwards.
+                original.draft('RGB', size)
+                image = original.convert('RGB')
+            image.thumbnail(size)
+        elif not with_title:
+            return self.image
+        else:
+            image = self.image.copy()
 
-        def image_with_title():
-            im_x, im_y = self.image.size
-            draw = ImageDraw.Draw(self.image)
-            font = ImageFont.truetype('/Library/Fonts/Georgia.ttf',
-                                      48)  # TODO - will need a better way to look up a font!
-            draw.text((5, im_y - 60), self.title, (255, 255, 255), font=font)
-            return ImageTk.PhotoImage(self.image)
+        if with_title:
+            draw_title(image, self.title)
+        return image
 
+    def as_photo_image(self, with_title: bool = False):
         if with_title:
-            return image_with_title()
+            return ImageTk.PhotoImage(self.as_image(with_title=True))
         return ImageTk.PhotoImage(self.image)
 
     def __repr__(self):
         return f'{self.id}: {self.title} at {self.file_path}'
 
 
+def draw_title(image: Image.Image, title: str):
+    """ Draw a title onto the bottom left of an image, in place. """
+    im_x, im_y = image.size
+    draw = ImageDraw.Draw(image)
+    draw.text((5, im_y - 60), title, (255, 255, 255), font=title_font())
+
+
+@lru_cache(maxsize=1)
+def title_font():
+    try:
+        return ImageFont.truetype('/Library/Fonts/Georgia.ttf', 48)  # TODO - will need a better way to look up a font!
+    except OSError:
+        return ImageFont.load_default()
+
+
 def create_title(image_file: Path):
     file_name = image_file.stem
     # Intended to remove the trailing digits
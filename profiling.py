@@ -0,0 +1,237 @@
+"""
+On-demand profiling for frames in the field.
+
+A profiling window samples the stacks of every thread, profiles the main (Tk) thread with cProfile and diffs
+tracemalloc snapshots, writing a report for each interval. Nothing is installed until a window starts, so there is
+no overhead when profiling is off.
+"""
+import cProfile
+import io
+import logging
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from pathlib import Path
+from typing import Optional
+
+from common import CONFIG
+
+PROFILE_PATH = Path(CONFIG.get('profiling', 'data_directory', fallback='__photo_frame/profiles'))
+""" The directory that profiling reports are written to. """
+
+
+def take_alloc_snapshot():
+    return tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap*>'),
+    ])
+
+
+class _ProfileSnapshot:
+    """ Lets pstats read the stats of a running profile without disabling it, as pstats.Stats(profile) would. """
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class Profiler:
+    """
+    Profiles the running frame for a time window, writing a report every interval and keeping the newest reports.
+
+    Each report contains the most common sampled stacks of every thread, the cProfile top functions of the main
+    thread, and the allocation sites that grew the most since the previous interval.
+    """
+    def __init__(self, output_path: Path = None, interval: float = 60, window: float = 600, top: int = 25,
+                 keep: int = 20, sample_ms: float = 10, trace_frames: int = 5):
+        if not output_path:
+            output_path = PROFILE_PATH
+        self.log = logging.getLogger('frame.Profiler')
+        self.output_path = output_path
+        self.interval = interval
+        self.window = window
+        self.top = top
+        self.keep = keep
+        self.sample_seconds = sample_ms / 1000
+        self.trace_frames = trace_frames
+        self.signum = None
+        self.backend = None
+        self.reports = 0
+        self.profile = None
+        self.stacks = Counter()
+        self.samples = 0
+        self.alloc_snapshot = None
+        self.started_tracing = False
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.RLock()
+
+    @property
+    def active(self):
+        return self._thread is not None
+
+    def install_signal_handler(self, signum=signal.SIGUSR1):
+        """
+        Toggle profiling whenever the signal is received, e.g. kill -USR1 <pid>. Must be called on the main thread.
+        """
+        self.signum = signum
+        signal.signal(signum, self._handle_signal)
+
+    def attach(self, backend):
+        """
+        Stop the main thread's profile from the display loop when a window ends, for when no signal handler is
+        installed to do it. The check is only scheduled while the main thread is being profiled.
+
+        :param backend: The RenderBackend of the frame, which runs its scheduled callbacks on the main thread.
+        """
+        self.backend = backend
+        if self.profile:
+            self._schedule_check()
+
+    def _schedule_check(self):
+        if self.backend and not self.signum:
+            self.backend.schedule(1000, self._check_main_profile)
+
+    def _check_main_profile(self):
+        if not self.profile:
+            return
+        if self.active:
+            self._schedule_check()
+        else:
+            self._stop_main_profile()
+
+    def _handle_signal(self, signum, frame):
+        if self.active:
+            self.stop()
+        elif self.profile:
+            # The window ended on the sampler thread, which signals the main thread to stop its profiler.
+            self._stop_main_profile()
+        else:
+            self.start()
+
+    def start(self, window: Optional[float] = None):
+        """
+        Start a profiling window. The main thread is only profiled with cProfile if this is called on it.
+
+        :param window: The length of the window in seconds, defaults to the configured window.
+        """
+        with self._lock:
+            if self.active:
+                return
+            self.log.info('Profiling for %.0f seconds, writing reports to %s', window or self.window, self.output_path)
+            self.output_path.mkdir(parents=True, exist_ok=True)
+            self.stacks = Counter()
+            self.samples = 0
+            if threading.current_thread() is threading.main_thread():
+                self.profile = cProfile.Profile()
+                self.profile.enable()
+                self._schedule_check()
+            self.started_tracing = not tracemalloc.is_tracing()
+            if self.started_tracing:
+                tracemalloc.start(self.trace_frames)
+            self.alloc_snapshot = take_alloc_snapshot()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, args=(window or self.window,), name='Profiler',
+                                            daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """ End the profiling window early, writing a final report. """
+        with self._lock:
+            thread = self._thread
+            self._stop.set()
+        if thread and thread is not threading.current_thread():
+            thread.join()
+        if threading.current_thread() is threading.main_thread():
+            self._stop_main_profile()
+
+    def _stop_main_profile(self):
+        if self.profile:
+            self.profile.disable()
+            self.profile = None
+
+    def _run(self, window: float):
+        end = time.monotonic() + window
+        next_report = time.monotonic() + self.interval
+        own_ident = threading.get_ident()
+        while not self._stop.wait(self.sample_seconds):
+            self.sample(own_ident)
+            now = time.monotonic()
+            if now >= end:
+                break
+            if now >= next_report:
+                self.report()
+                next_report = now + self.interval
+        self.report()
+        if self.started_tracing:
+            tracemalloc.stop()
+        self.alloc_snapshot = None
+        with self._lock:
+            self._thread = None
+        self.log.info('Profiling stopped')
+        # Without a signal handler, the check attached to the display loop stops the main thread's profile.
+        if self.profile and not self._stop.is_set() and self.signum:
+            signal.pthread_kill(threading.main_thread().ident, self.signum)
+
+    def sample(self, own_ident=None):
+        """ Record the current stack of every thread other than the sampler. """
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            stack = []
+            while frame:
+                code = frame.f_code
+                stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                frame = frame.f_back
+            self.stacks[names.get(ident, str(ident)) + ';' + ';'.join(reversed(stack))] += 1
+        self.samples += 1
+
+    def report(self) -> Path:
+        """ Write a report for the interval so far, and remove the oldest reports beyond the number to keep. """
+        out = io.StringIO()
+        out.write(f'# {self.samples} samples every {self.sample_seconds * 1000:.0f} ms\n')
+        out.write('\n## Most common stacks\n')
+        for stack, count in self.stacks.most_common(self.top):
+            out.write(f'{count} {stack}\n')
+
+        profile = self.profile
+        if profile:
+            out.write('\n## Main thread profile\n')
+            profile.snapshot_stats()
+            pstats.Stats(_ProfileSnapshot(profile.stats), stream=out).sort_stats('cumulative').print_stats(self.top)
+
+        if tracemalloc.is_tracing():
+            snapshot = take_alloc_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            out.write(f'\n## Allocations: {current} bytes traced, {peak} peak. Growth since the last report\n')
+            if self.alloc_snapshot:
+                for stat in snapshot.compare_to(self.alloc_snapshot, 'lineno')[:self.top]:
+                    out.write(f'{stat}\n')
+            self.alloc_snapshot = snapshot
+
+        self.reports += 1
+        report_path = self.output_path / f'profile-{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}-{self.reports}.txt'
+        report_path.write_text(out.getvalue())
+        self.stacks = Counter()
+        self.samples = 0
+        self.log.info('Wrote profiling report %s', report_path)
+
+        for old in sorted(self.output_path.glob('profile-*.txt'), key=lambda p: p.stat().st_mtime)[:-self.keep]:
+            old.unlink(missing_ok=True)
+        return report_path
+
+
+def load_profiler() -> Profiler:
+    """ Create a Profiler from the [profiling] section. """
+    return Profiler(interval=CONFIG.getfloat('profiling', 'interval', fallback=60),
+                    window=CONFIG.getfloat('profiling', 'window', fallback=600),
+                    top=CONFIG.getint('profiling', 'top', fallback=25),
+                    keep=CONFIG.getint('profiling', 'keep', fallback=20),
+                    sample_ms=CONFIG.getfloat('profiling', 'sample_ms', fallback=10))
@@ -0,0 +1,246 @@
+"""
+A small query language for selecting photos, compiled into a single parameterised SQL statement.
+
+    beach AND sunset AND NOT people AND shown < 3 AND score >= 5
+    (tulip, daisy) AND days_since_shown > 7
+    match("flower*") OR "sea life"
+
+Bare words and quoted strings are tags, and a comma is shorthand for OR. The operators AND, OR and NOT must be
+upper case, so existing tags such as 'black and white' keep their meaning. match() searches titles and tags through
+the full-text index. 'all' matches every photo.
+"""
+import re
+import sqlite3
+from functools import lru_cache
+
+FIELDS = {
+    'score': 'coalesce(p.score, 0)',
+    'shown': 'coalesce(p.times_displayed, 0)',
+    'times_displayed': 'coalesce(p.times_displayed, 0)',
+    # Photos that were never shown count as shown a very long time ago.
+    'days_since_shown': "coalesce(julianday('now', 'localtime') - julianday(p.date_last_displayed), 1e9)",
+    'days_since_added': "julianday('now', 'localtime') - julianday(p.date_added)",
+    'width': 'p.img_width',
+    'height': 'p.img_height',
+}
+
+NORMALISED_OPERATORS = {'≥': '>=', '≤': '<='}
+
+TOKEN_PATTERN = re.compile(r'''
+    \s*(?:
+        (?P<string>"(?:[^"\\]|\\.)*")
+      | (?P<op><=|>=|!=|[<>=≥≤])
+      | (?P<punct>[(),])
+      | (?P<number>-?\d+(?:\.\d+)?(?![\w-]))
+      | (?P<word>[^\s(),<>=!"≥≤]+)
+    )''', re.VERBOSE)
+
+
+class QuerySyntaxError(ValueError):
+    pass
+
+
+# AST nodes
+class Tag:
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return f'Tag({self.name!r})'
+
+
+class Match:
+    def __init__(self, query):
+        self.query = query
+
+    def __repr__(self):
+        return f'Match({self.query!r})'
+
+
+class Compare:
+    def __init__(self, field, op, value):
+        self.field = field
+        self.op = op
+        self.value = value
+
+    def __repr__(self):
+        return f'Compare({self.field!r}, {self.op!r}, {self.value!r})'
+
+
+class Not:
+    def __init__(self, operand):
+        self.operand = operand
+
+    def __repr__(self):
+        return f'Not({self.operand!r})'
+
+
+class BoolOp:
+    def __init__(self, op, operands):
+        self.op = op
+        self.operands = operands
+
+    def __repr__(self):
+        return f'BoolOp({self.op!r}, {self.operands!r})'
+
+
+class All:
+    def __repr__(self):
+        return 'All()'
+
+
+def is_query(categories) -> bool:
+    """
+    Determines whether the categories setting uses the query language rather than being a plain list of tags.
+
+    Only operators that stand as tokens of their own count, so a tag such as forget-me-not is still a tag.
+    """
+    if not isinstance(categories, str):
+        return False
+    try:
+        tokens = tokenize(categories)
+    except QuerySyntaxError:
+        # Nothing in a plain tag list fails to tokenize, so report the error when the query is compiled.
+        return True
+    return any(kind in ('keyword', 'op') or value in ('(', ')') for kind, value in tokens)
+
+
+def tokenize(text: str):
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        m = TOKEN_PATTERN.match(text, pos)
+        if not m or m.end() == pos:
+            raise QuerySyntaxError(f'Unexpected character at position {pos}: {text[pos:pos + 10]!r}')
+        pos = m.end()
+        kind = m.lastgroup
+        value = m.group(kind)
+        if kind == 'string':
+            value = re.sub(r'\\(.)', r'\1', value[1:-1])
+        elif kind == 'word' and value in ('AND', 'OR', 'NOT'):
+            kind = 'keyword'
+        tokens.append((kind, value))
+    return tokens
+
+
+class Parser:
+    """ A recursive descent parser. NOT binds tighter than AND, which binds tighter than OR and commas. """
+    def __init__(self, text: str):
+        self.tokens = tokenize(text)
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def take(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def expect(self, kind, value=None):
+        token = self.take()
+        if token[0] != kind or (value is not None and token[1] != value):
+            raise QuerySyntaxError(f'Expected {value or kind} but found {token[1]!r}')
+        return token[1]
+
+    def parse(self):
+        if not self.tokens:
+            return All()
+        node = self.parse_or()
+        if self.pos < len(self.tokens):
+            raise QuerySyntaxError(f'Unexpected {self.peek()[1]!r}')
+        return node
+
+    def parse_or(self):
+        operands = [self.parse_and()]
+        while self.peek() in (('keyword', 'OR'), ('punct', ',')):
+            self.take()
+            operands.append(self.parse_and())
+        return operands[0] if len(operands) == 1 else BoolOp('OR', operands)
+
+    def parse_and(self):
+        operands = [self.parse_not()]
+        while self.peek() == ('keyword', 'AND'):
+            self.take()
+            operands.append(self.parse_not())
+        return operands[0] if len(operands) == 1 else BoolOp('AND', operands)
+
+    def parse_not(self):
+        if self.peek() == ('keyword', 'NOT'):
+            self.take()
+            return Not(self.parse_not())
+        return self.parse_atom()
+
+    def parse_atom(self):
+        kind, value = self.take()
+        if (kind, value) == ('punct', '('):
+            node = self.parse_or()
+            self.expect('punct', ')')
+            return node
+        if kind == 'word' and value.lower() == 'match' and self.peek() == ('punct', '('):
+            self.take()
+            query = self.expect('string')
+            self.expect('punct', ')')
+            return Match(query)
+        if kind == 'word' and value.lower() in FIELDS and self.peek()[0] == 'op':
+            _, op = self.take()
+            value_kind, operand = self.take()
+            if value_kind != 'number':
+                raise QuerySyntaxError(f'Expected a number after {value} {op}')
+            return Compare(value.lower(), NORMALISED_OPERATORS.get(op, op), float(operand))
+        if kind in ('word', 'string', 'number'):
+            return All() if kind == 'word' and value.lower() == 'all' else Tag(value)
+        raise QuerySyntaxError(f'Unexpected {value!r}' if value else 'Unexpected end of query')
+
+
+def parse(text: str):
+    return Parser(text).parse()
+
+
+def compile_node(node, params: list) -> str:
+    if isinstance(node, All):
+        return '1'
+    if isinstance(node, Tag):
+        params.append(node.name)
+        return """EXISTS (SELECT 1 FROM categories_photos cp JOIN categories c ON c.id = cp.category_id
+                          WHERE cp.photo_id = p.id AND c.tag = ?)"""
+    if isinstance(node, Match):
+        params.append(node.query)
+        return 'p.id IN (SELECT rowid FROM photos_fts WHERE photos_fts MATCH ?)'
+    if isinstance(node, Compare):
+        params.append(node.value)
+        return f'{FIELDS[node.field]} {node.op} ?'
+    if isinstance(node, Not):
+        return f'NOT ({compile_node(node.operand, params)})'
+    if isinstance(node, BoolOp):
+        return '(' + f' {node.op} '.join(compile_node(o, params) for o in node.operands) + ')'
+    raise TypeError(f'Unknown node {node!r}')
+
+
+@lru_cache(maxsize=64)
+def compile_query(text: str):
+    """
+    Compile a query into a single SQL statement selecting the id, path and title of the matching, enabled photos.
+
+    Compiled statements are cached, since the same categories setting is used on every refresh.
+
+    :return: a tuple of the statement and its parameters. The statement's first placeholder is the since_id, which
+             must be passed ahead of the parameters.
+    """
+    params = []
+    condition = compile_node(parse(text), params)
+    stmt = f"""SELECT p.id, p.img_path, p.title FROM photos p
+               WHERE coalesce(p.disabled, 0) = 0 AND p.id > ? AND {condition}"""
+    return stmt, tuple(params)
+
+
+def explain(db: sqlite3.Connection, text: str):
+    """
+    Run EXPLAIN QUERY PLAN for a compiled query.
+
+    :return: the list of plan details, e.g. 'SEARCH cp USING INDEX categories_photos_photo_id (photo_id=?)'.
+    """
+    stmt, params = compile_query(text)
+    return [row[3] for row in db.execute(f'EXPLAIN QUERY PLAN {stmt}', (0,) + params).fetchall()]
+
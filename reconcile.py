@@ -0,0 +1,181 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+from common import DB_FILE_PATH
+
+DISABLED_MISSING = 2
+""" Value of photos.disabled for rows disabled by the reconciler, so they can be re-enabled if the file comes back. """
+
+HEADER_BYTES = 16
+TRAILER_BYTES = 64
+SCAN_CHUNK_BYTES = 1024 * 1024
+
+JPEG_MAGIC = b'\xff\xd8\xff'
+
+SIGNATURES = {
+    JPEG_MAGIC: b'\xff\xd9',  # JPEG, ends with the EOI marker
+    b'GIF87a': b'\x3b',  # GIF, ends with the trailer byte
+    b'GIF89a': b'\x3b',
+    b'\x89PNG\r\n\x1a\n': b'IEND\xaeB`\x82',
+}
+
+
+def ensure_checkpoint_table(db: sqlite3.Connection):
+    db.execute("""CREATE TABLE IF NOT EXISTS checkpoints
+                  (name text primary key, value text, date_updated text)""")
+    db.commit()
+
+
+def load_checkpoint(db: sqlite3.Connection, name: str) -> dict:
+    row = db.execute('SELECT value FROM checkpoints WHERE name = ?', [name]).fetchone()
+    return json.loads(row[0]) if row else {}
+
+
+def save_checkpoint(db: sqlite3.Connection, name: str, value: dict):
+    db.execute('INSERT OR REPLACE INTO checkpoints (name, value, date_updated) VALUES (?,?,?)',
+               [name, json.dumps(value), datetime.now().isoformat()])
+
+
+def check_photo_file(file_path: Path) -> Optional[str]:
+    """
+    Cheaply verify that a photo file exists and looks complete, without decoding it.
+
+    :param file_path: The Path of the photo to check.
+    :return: None if the file looks valid, otherwise a short description of the problem.
+    """
+    try:
+        size = file_path.stat().st_size
+    except OSError:
+        return 'missing'
+    if size < HEADER_BYTES:
+        return 'truncated'
+    try:
+        with file_path.open('rb') as f:
+            header = f.read(HEADER_BYTES)
+            f.seek(max(size - TRAILER_BYTES, 0))
+            trailer = f.read(TRAILER_BYTES)
+    except OSError:
+        return 'unreadable'
+
+    for magic, end_marker in SIGNATURES.items():
+        if header.startswith(magic):
+            if end_marker in trailer:
+                return None
+            if magic == JPEG_MAGIC and contains(file_path, end_marker):
+                # Valid JPEGs can have data after the EOI marker, such as MPF images or other appended metadata.
+                return None
+            return 'truncated'
+    return 'unknown format'
+
+
+def contains(file_path: Path, marker: bytes) -> bool:
+    """ Search a whole file for a marker, a chunk at a time. Only needed for files that fail the cheap check. """
+    try:
+        with file_path.open('rb') as f:
+            tail = b''
+            while chunk := f.read(SCAN_CHUNK_BYTES):
+                if marker in tail + chunk:
+                    return True
+                tail = chunk[-(len(marker) - 1):]
+    except OSError:
+        return False
+    return False
+
+
+class PhotoReconciler:
+    """
+    Walks the photos table in chunks, in the background, marking rows whose files are missing or corrupt as disabled.
+
+    The position in the table is persisted after every chunk, so a pass resumes where it left off after a restart.
+    """
+    CHECKPOINT_NAME = 'reconcile'
+
+    def __init__(self, data_path: Path = None, chunk_size: int = 200, pause_seconds: float = 1.0):
+        if not data_path:
+            data_path = DB_FILE_PATH
+        self.data_path = data_path
+        self.chunk_size = chunk_size
+        self.pause_seconds = pause_seconds
+        self.log = logging.getLogger('frame.PhotoReconciler')
+        self._stop = threading.Event()
+        self._thread = None
+
+    def reconcile_chunk(self, db: sqlite3.Connection) -> bool:
+        """
+        Check the next chunk of photos.
+
+        :return: True if a full pass over the table completed with this chunk.
+        """
+        state = load_checkpoint(db, self.CHECKPOINT_NAME)
+        cursor = state.get('cursor', 0)
+        rows = db.execute('SELECT id, img_path, disabled FROM photos WHERE id > ? ORDER BY id LIMIT ?',
+                          [cursor, self.chunk_size]).fetchall()
+
+        updates = []
+        for photo_id, img_path, disabled in rows:
+            problem = check_photo_file(Path(img_path))
+            if problem and not disabled:
+                self.log.warning('Disabling photo %d (%s): %s', photo_id, img_path, problem)
+                updates.append((DISABLED_MISSING, photo_id))
+            elif not problem and disabled == DISABLED_MISSING:
+                self.log.info('Re-enabling photo %d (%s)', photo_id, img_path)
+                updates.append((0, photo_id))
+
+        completed = len(rows) < self.chunk_size
+        state['checked'] = state.get('checked', 0) + len(rows)
+        state['changed'] = state.get('changed', 0) + len(updates)
+        if completed:
+            self.log.info('Reconciliation pass complete. Checked %d photos, changed %d',
+                          state['checked'], state['changed'])
+            state = {'cursor': 0, 'passes': state.get('passes', 0) + 1, 'last_pass': datetime.now().isoformat()}
+        else:
+            state['cursor'] = rows[-1][0]
+
+        with db:
+            db.executemany('UPDATE photos SET disabled = ? WHERE id = ?', updates)
+            save_checkpoint(db, self.CHECKPOINT_NAME, state)
+        return completed
+
+    def run_pass(self):
+        """ Run a full pass in the calling thread, resuming from the persisted cursor. """
+        db = sqlite3.connect(self.data_path)
+        try:
+            ensure_checkpoint_table(db)
+            while not self._stop.is_set():
+                if self.reconcile_chunk(db):
+                    break
+                self._stop.wait(self.pause_seconds)
+        finally:
+            db.close()
+
+    def start(self, interval: float = 3600):
+        """
+        Start reconciling in a low priority background thread, starting a new pass every interval seconds.
+        """
+        def run():
+            try:
+                # Linux applies nice values per thread, so this only lowers the priority of this thread.
+                os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+            except (AttributeError, OSError):
+                self.log.debug('Could not lower reconciler thread priority')
+            while not self._stop.is_set():
+                try:
+                    self.run_pass()
+                except sqlite3.Error:
+                    self.log.exception('Reconciliation failed')
+                self._stop.wait(interval)
+
+        self._thread = threading.Thread(target=run, name='PhotoReconciler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
@@ -0,0 +1,113 @@
+import io
+import logging
+import queue
+import threading
+from typing import Optional, Tuple
+from urllib.parse import unquote
+
+import requests
+from PIL import Image, ImageTk
+
+from metrics import PRESSURE_DROP
+
+
+class RemotePhotoFeed:
+    """
+    A feed that fetches pre-rendered slides from a RenderServer, prefetching the next slides in the background.
+
+    Behaves like PhotoFeed for SlideShowFrame, but needs no category service, database or downloader.
+    """
+    def __init__(self, server_url: str, client_name: Optional[str] = None, size: Optional[Tuple[int, int]] = None,
+                 prefetch: int = 2, timeout: float = 10.0, retry_seconds: float = 5.0):
+        self.log = logging.getLogger('frame.RemotePhotoFeed')
+        self.server_url = server_url.rstrip('/')
+        self.client_name = client_name
+        self.size = size
+        self.timeout = timeout
+        self.retry_seconds = retry_seconds
+        self.slides = queue.Queue(maxsize=prefetch)
+        self.last_slide = None
+        self.waited = False
+        self.session = requests.Session()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._prefetch, name='RemotePhotoFeed', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def fetch(self):
+        """
+        Fetch a single slide from the server.
+
+        :return: a tuple of the Pillow Image and the title.
+        """
+        params = {}
+        if self.client_name:
+            params['client'] = self.client_name
+        if self.size:
+            params['width'], params['height'] = self.size
+        resp = self.session.get(f'{self.server_url}/slide', params=params, timeout=self.timeout)
+        resp.raise_for_status()
+        image = Image.open(io.BytesIO(resp.content))
+        # Decode now, on the prefetch thread, rather than when the image is first drawn.
+        image.load()
+        return image, unquote(resp.headers.get('X-Photo-Title', ''))
+
+    def _prefetch(self):
+        while not self._stop.is_set():
+            try:
+                slide = self.fetch()
+            except (requests.RequestException, OSError) as e:
+                self.log.warning('Could not fetch a slide from %s: %s', self.server_url, e)
+                self._stop.wait(self.retry_seconds)
+                continue
+            while not self._stop.is_set():
+                try:
+                    self.slides.put(slide, timeout=1.0)
+                    break
+                except queue.Full:
+                    continue
+
+    def shrink(self, level):
+        """ A MemoryGovernor hook. Drops the prefetched slides under heavy pressure; they are fetched again. """
+        if level < PRESSURE_DROP:
+            return 0
+        freed = 0
+        while True:
+            try:
+                image, _ = self.slides.get_nowait()
+            except queue.Empty:
+                return freed
+            freed += image.width * image.height * len(image.getbands())
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.next()
+
+    def next_image(self, size=None):
+        """
+        Return the next prefetched slide, or the previous slide again if the server has not delivered one in time.
+
+        Until the server delivers a first slide, a blank placeholder is shown while the prefetch thread keeps retrying.
+        """
+        # Only the first slide is worth waiting for, and only once; never hold up the display thread after that.
+        wait = 0 if self.waited else self.timeout
+        self.waited = True
+        try:
+            self.last_slide = self.slides.get(timeout=wait)
+        except queue.Empty:
+            if not self.last_slide:
+                self.log.warning('Waiting for %s to deliver a slide', self.server_url)
+                return Image.new('RGB', self.size or (640, 480)), ''
+            self.log.warning('No slide was prefetched in time. Showing the previous slide again.')
+        return self.last_slide
+
+    def next(self):
+        image, title = self.next_image()
+        return ImageTk.PhotoImage(image), title
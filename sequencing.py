@@ -0,0 +1,238 @@
+import json
+import logging
+import random
+import sqlite3
+import threading
+from collections import deque
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from common import CONFIG, DB_FILE_PATH, REKOGNITION_DATA_PATH, synchronized
+
+
+class GrowableArray:
+    """ A NumPy array that can be appended to in amortised constant time. """
+    def __init__(self, dtype, capacity: int = 1024):
+        self.data = np.zeros(capacity, dtype=dtype)
+        self.size = 0
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=self.data.dtype)
+        needed = self.size + len(values)
+        if needed > len(self.data):
+            grown = np.zeros(max(needed, len(self.data) * 2), dtype=self.data.dtype)
+            grown[:self.size] = self.data[:self.size]
+            self.data = grown
+        self.data[self.size:needed] = values
+        self.size = needed
+
+    @property
+    def values(self) -> np.ndarray:
+        return self.data[:self.size]
+
+
+class TagSequencer:
+    """
+    Orders slides so that each one is similar to the last, by the cosine similarity of IDF-weighted tag vectors.
+
+    Tag vectors are sparse, stored as (photo, tag, weight) entries with an inverted index from each tag to its entries,
+    so scoring the neighbours of a photo only touches the photos that share one of its tags. Tags from Rekognition are
+    weighted by their confidence. Tags are added incrementally as their rows arrive in categories_photos, including
+    labels saved after a photo was first indexed; IDF weights and vector norms are derived from the entries when next
+    needed rather than rebuilt. The index is updated on the refresh thread and read on the display thread, so access to
+    it is locked.
+
+    To keep the slideshow varied, recently shown photos are never picked again, the next photo is drawn at random from
+    the nearest neighbours weighted by similarity, and after max_run similar slides the sequence jumps to a random
+    photo.
+    """
+    def __init__(self, data_path: Path = None, label_path: Path = None, neighbours: int = 20, history: int = 50,
+                 max_run: int = 10, min_similarity: float = 0.05):
+        if not data_path:
+            data_path = DB_FILE_PATH
+        if not label_path:
+            label_path = REKOGNITION_DATA_PATH
+        self.log = logging.getLogger('frame.TagSequencer')
+        self.data_path = data_path
+        self.label_path = label_path
+        self.neighbours = neighbours
+        self.recent = deque(maxlen=history)
+        self.max_run = max_run
+        self.min_similarity = min_similarity
+        self.run_length = 0
+        self.max_mapping_id = 0
+        self.rows = {}
+        self.row_ids = GrowableArray(np.int64)
+        self.row_entries = []
+        self.row_columns = []
+        self.tag_columns = {}
+        self.entry_rows = GrowableArray(np.int32)
+        self.entry_columns = GrowableArray(np.int32)
+        self.entry_weights = GrowableArray(np.float32)
+        self.postings = {}
+        self._posting_arrays = {}
+        self._idf = None
+        self._norms = None
+        self._lock = threading.RLock()
+
+    def update(self) -> int:
+        """
+        Add the tags mapped to photos in the database since the last update, whether the photos are new or not.
+
+        :return: the number of photos updated.
+        """
+        with sqlite3.connect(self.data_path) as db:
+            rows = db.execute("""SELECT cp.rowid, cp.photo_id, p.img_path, c.tag FROM categories_photos cp
+                                 JOIN photos p ON p.id = cp.photo_id
+                                 JOIN categories c ON c.id = cp.category_id
+                                 WHERE cp.rowid > ? ORDER BY cp.rowid""", [self.max_mapping_id]).fetchall()
+        db.close()
+        if not rows:
+            return 0
+        tags_by_photo = {}
+        for _, photo_id, img_path, tag in rows:
+            tags_by_photo.setdefault((photo_id, img_path), []).append(tag)
+        # Read the cached labels before taking the lock, so the display thread does not wait on the files.
+        confidences = {key: self.label_confidences(Path(key[1])) for key in tags_by_photo}
+        with self._lock:
+            for (photo_id, img_path), tags in tags_by_photo.items():
+                self.add_tags(photo_id, tags, confidences[(photo_id, img_path)])
+            self.max_mapping_id = rows[-1][0]
+        self.log.info('Added the tags of %d photos to the tag index', len(tags_by_photo))
+        return len(tags_by_photo)
+
+    def label_confidences(self, file_path: Path) -> dict:
+        """ The confidence of each label in the cached Rekognition response for a photo, from 0 to 1. """
+        local_data = (self.label_path / file_path.name).with_suffix('.json')
+        try:
+            with local_data.open('r') as f:
+                resp = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return {label['Name'].lower(): label.get('Confidence', 100.0) / 100 for label in resp.get('Labels', [])}
+
+    @synchronized
+    def add_tags(self, photo_id: int, tags, confidences: Optional[dict] = None):
+        """
+        Add tags for a photo to the index, adding the photo if it is new. Tags it already has are ignored.
+
+        :param confidences: The confidence of tags from a labelling service, from 0 to 1. Other tags have a weight of 1.
+        """
+        row = self.rows.get(photo_id)
+        if row is None:
+            row = len(self.rows)
+            self.rows[photo_id] = row
+            self.row_ids.extend([photo_id])
+            self.row_entries.append([])
+            self.row_columns.append(set())
+
+        columns = []
+        weights = []
+        for tag in set(tags):
+            column = self.tag_columns.setdefault(tag, len(self.tag_columns))
+            if column in self.row_columns[row]:
+                continue
+            entry = self.entry_rows.size + len(columns)
+            self.row_columns[row].add(column)
+            self.row_entries[row].append(entry)
+            self.postings.setdefault(column, []).append(entry)
+            self._posting_arrays.pop(column, None)
+            columns.append(column)
+            weights.append(confidences.get(tag, 1.0) if confidences else 1.0)
+        self.entry_rows.extend([row] * len(columns))
+        self.entry_columns.extend(columns)
+        self.entry_weights.extend(weights)
+        self._idf = None
+        self._norms = None
+
+    def _weights(self):
+        """ Derive the IDF of each tag and the norm of each photo's vector, once per batch of additions. """
+        if self._idf is None:
+            counts = np.bincount(self.entry_columns.values, minlength=len(self.tag_columns))
+            self._idf = np.log((1 + len(self.rows)) / (1 + counts)).astype(np.float32) + 1
+            weighted = self.entry_weights.values * self._idf[self.entry_columns.values]
+            self._norms = np.sqrt(np.bincount(self.entry_rows.values, weights=weighted ** 2, minlength=len(self.rows)))
+        return self._idf, self._norms
+
+    def _posting(self, column) -> np.ndarray:
+        posting = self._posting_arrays.get(column)
+        if posting is None:
+            posting = np.array(self.postings[column], dtype=np.int64)
+            self._posting_arrays[column] = posting
+        return posting
+
+    @synchronized
+    def similar(self, photo_id: int, count: int):
+        """
+        Find the photos most similar to the provided photo.
+
+        :return: a tuple of the arrays of photo ids and similarities, most similar first.
+        """
+        row = self.rows.get(photo_id)
+        if row is None:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        idf, norms = self._weights()
+        entry_rows = self.entry_rows.values
+        entry_columns = self.entry_columns.values
+        entry_weights = self.entry_weights.values
+
+        candidates = []
+        contributions = []
+        for entry in self.row_entries[row]:
+            column = entry_columns[entry]
+            posting = self._posting(column)
+            candidates.append(entry_rows[posting])
+            contributions.append(entry_weights[posting] * entry_weights[entry] * idf[column] ** 2)
+        if not candidates:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+        # Sum the contributions of the shared tags for each candidate, which is the sparse dot product.
+        candidate_rows, inverse = np.unique(np.concatenate(candidates), return_inverse=True)
+        dots = np.bincount(inverse, weights=np.concatenate(contributions))
+        similarity = dots / (norms[candidate_rows] * norms[row])
+        keep = candidate_rows != row
+        candidate_rows, similarity = candidate_rows[keep], similarity[keep]
+        if len(similarity) > count:
+            top = np.argpartition(-similarity, count)[:count]
+            candidate_rows, similarity = candidate_rows[top], similarity[top]
+        order = np.argsort(-similarity)
+        return self.row_ids.values[candidate_rows[order]], similarity[order]
+
+    @synchronized
+    def choose(self, current_id: Optional[int], allowed) -> Optional[int]:
+        """
+        Choose the next photo to show after the current one.
+
+        :param current_id: The id of the photo being shown, or None at the start.
+        :param allowed: A container of the ids that may be chosen, i.e. the photos in the feed.
+        :return: the id of the next photo, or None to let the caller choose at random.
+        """
+        if current_id is None or self.run_length >= self.max_run:
+            self.run_length = 0
+            return None
+        ids, similarity = self.similar(current_id, self.neighbours * 2)
+        recent = set(self.recent)
+        mask = np.array([i in allowed and i not in recent for i in ids.tolist()], dtype=bool)
+        mask &= similarity >= self.min_similarity
+        ids, similarity = ids[mask][:self.neighbours], similarity[mask][:self.neighbours]
+        if not len(ids):
+            self.run_length = 0
+            return None
+        self.run_length += 1
+        return int(random.choices(ids, weights=similarity)[0])
+
+    @synchronized
+    def shown(self, photo_id: int):
+        self.recent.append(photo_id)
+
+
+def load_sequencer() -> Optional[TagSequencer]:
+    """ Create a TagSequencer from the [sequence] section, or None if slides are shown in random order. """
+    if not CONFIG.getboolean('sequence', 'enabled', fallback=False):
+        return None
+    return TagSequencer(neighbours=CONFIG.getint('sequence', 'neighbours', fallback=20),
+                        history=CONFIG.getint('sequence', 'history', fallback=50),
+                        max_run=CONFIG.getint('sequence', 'max_run', fallback=10),
+                        min_similarity=CONFIG.getfloat('sequence', 'min_similarity', fallback=0.05))
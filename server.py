@@ -0,0 +1,366 @@
+import io
+import json
+import logging
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import parse_qs, quote, urlparse
+
+from categories import CategoryService
+from common import CONFIG
+from decoding import BatchDecoder
+from feeds import PhotoFeed
+from metrics import PRESSURE_TRIM
+
+DEFAULT_PORT = 8610
+JPEG_QUALITY = 85
+MAX_DIMENSION = 8192
+MAX_FEEDS = 8
+MAX_MOSAIC_TILES = 64
+MAX_TILE_DIMENSION = 1024
+
+
+class RenditionCache:
+    """ A byte-bounded LRU cache of encoded renditions, shared by every client of the server. """
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            data = self.entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, data: bytes):
+        with self._lock:
+            if key in self.entries:
+                self.current_bytes -= len(self.entries.pop(key))
+            self.entries[key] = data
+            self.current_bytes += len(data)
+            self._evict(self.max_bytes)
+
+    def discard(self, file_path):
+        """ Remove every rendition of the provided file. """
+        with self._lock:
+            for key in [k for k in self.entries if k[0] == file_path]:
+                self.current_bytes -= len(self.entries.pop(key))
+
+    def shrink(self, level):
+        """ A MemoryGovernor hook. Trims the cache to half its budget, or empties it under heavier pressure. """
+        with self._lock:
+            before = self.current_bytes
+            self._evict(self.max_bytes // 2 if level == PRESSURE_TRIM else 0)
+            return before - self.current_bytes
+
+    def _evict(self, max_bytes):
+        while self.current_bytes > max_bytes and self.entries:
+            _, data = self.entries.popitem(last=False)
+            self.current_bytes -= len(data)
+
+
+class ClientProfile:
+    """ The display size, categories and title setting used when rendering slides for a client. """
+    def __init__(self, name, width=1920, height=1080, categories='all', show_titles=False):
+        self.name = name
+        self.width = width
+        self.height = height
+        self.categories = categories
+        self.show_titles = show_titles
+
+    @classmethod
+    def from_config(cls, name, section):
+        return cls(name,
+                   width=section.getint('width', 1920),
+                   height=section.getint('height', 1080),
+                   categories=section.get('categories', 'all'),
+                   show_titles=section.getboolean('show_titles', False))
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'width': self.width,
+            'height': self.height,
+            'categories': self.categories,
+            'show_titles': self.show_titles,
+        }
+
+    def __repr__(self):
+        return f'{self.name}: {self.width}x{self.height} {self.categories}'
+
+
+def load_client_profiles(config=None):
+    """
+    Read the client profiles from every [server.client.NAME] section of the config.
+
+    :return: a dict of profile name to ClientProfile.
+    """
+    if not config:
+        config = CONFIG
+    prefix = 'server.client.'
+    return {s[len(prefix):]: ClientProfile.from_config(s[len(prefix):], config[s])
+            for s in config.sections() if s.startswith(prefix)}
+
+
+class RenderServer:
+    """
+    Serves pre-rendered, display-sized JPEG slides over HTTP so that many frames can share one ingest node.
+
+    GET /slide?client=NAME returns the next slide for a configured client profile. The width, height, categories and
+    titles query parameters override the profile. The title is returned in the X-Photo-Title header.
+
+    GET /mosaic?count=9&tile_width=320&tile_height=240 returns a contact sheet of a random sample of photos, decoded
+    in parallel on the feed's process pool. The client and categories parameters select the photos as for /slide, and
+    the titles are returned in the X-Photo-Titles header, separated by commas.
+
+    Each distinct categories value loads a feed, so at most max_feeds are kept, evicting the least recently used.
+    The feeds share one process pool of decode_workers for their mosaics.
+    """
+    def __init__(self, category_service: CategoryService, profiles: Optional[dict] = None,
+                 cache: Optional[RenditionCache] = None, host: str = '127.0.0.1', port: int = DEFAULT_PORT,
+                 max_feeds: int = MAX_FEEDS, decode_workers: Optional[int] = None, storage_manager=None):
+        self.log = logging.getLogger('frame.RenderServer')
+        self.category_service = category_service
+        self.profiles = profiles if profiles is not None else load_client_profiles()
+        self.cache = cache if cache else RenditionCache()
+        self.max_feeds = max_feeds
+        # Evicted photos are removed from every feed, so they are never selected once their files are gone.
+        self.storage_manager = storage_manager
+        if storage_manager:
+            storage_manager.rendition_cache = self.cache
+        self.decoder = BatchDecoder(decode_workers)
+        self.feeds = OrderedDict()
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._create_handler())
+        self._thread = None
+        self._serving = False
+        self.log.info('Render server listening on %s:%d with profiles %s', host, self.port, self.profiles)
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    def feed_for(self, categories) -> PhotoFeed:
+        """ Feeds are shared between all clients that ask for the same categories. """
+        with self._lock:
+            feed = self.feeds.get(categories)
+            if feed:
+                self.feeds.move_to_end(categories)
+                return feed
+        # Loaded without the lock, so a new profile's query does not hold up every other request.
+        new_feed = PhotoFeed(categories=categories, category_service=self.category_service, decoder=self.decoder)
+        with self._lock:
+            feed = self.feeds.get(categories)
+            if feed:
+                # Another request loaded the same feed first.
+                self.feeds.move_to_end(categories)
+                new_feed.shutdown()
+                return feed
+            feed = new_feed
+            self.feeds[categories] = feed
+            if self.storage_manager:
+                self.storage_manager.add_listener(feed.remove_photos)
+            while len(self.feeds) > self.max_feeds:
+                evicted, old_feed = self.feeds.popitem(last=False)
+                self.log.info('Dropping the feed for %s', evicted)
+                if self.storage_manager:
+                    self.storage_manager.remove_listener(old_feed.remove_photos)
+                old_feed.shutdown()
+            return feed
+
+    def feed_counts(self) -> dict:
+        with self._lock:
+            return {c: f.photo_count for c, f in self.feeds.items()}
+
+    def refresh(self):
+        with self._lock:
+            feeds = list(self.feeds.values())
+        for feed in feeds:
+            feed.refresh()
+
+    def render(self, profile: ClientProfile):
+        """
+        Select and render the next slide for the provided profile.
+
+        :return: a tuple of the JPEG bytes and the title.
+        """
+        photo = self.feed_for(profile.categories).select()
+        key = (photo.file_path, profile.width, profile.height, profile.show_titles)
+        data = self.cache.get(key)
+        if data is None:
+            image = photo.as_image(with_title=profile.show_titles, size=(profile.width, profile.height))
+            buffer = io.BytesIO()
+            image.save(buffer, 'JPEG', quality=JPEG_QUALITY)
+            data = buffer.getvalue()
+            self.cache.put(key, data)
+        return data, photo.title
+
+    def render_mosaic(self, categories, count: int, tile_size):
+        """
+        Composite a random sample of the photos in the provided categories into a contact sheet.
+
+        :return: a tuple of the JPEG bytes and the list of titles.
+        """
+        feed = self.feed_for(categories)
+        if not feed.photo_count:
+            raise StopIteration()
+        image, titles = feed.next_mosaic(count, tile_size=tile_size)
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', quality=JPEG_QUALITY)
+        return buffer.getvalue(), titles
+
+    def resolve_profile(self, params) -> Optional[ClientProfile]:
+        """
+        Build the profile for a request from the named client profile and the query parameters.
+
+        :return: the ClientProfile, or None if the request names an unknown client.
+        :raises ValueError: if the width or height is not a whole number from 1 to MAX_DIMENSION.
+        """
+        def param(name, default):
+            return params[name][0] if name in params else default
+
+        name = param('client', 'default')
+        base = self.profiles.get(name)
+        if not base:
+            if 'client' in params:
+                return None
+            base = ClientProfile(name)
+        profile = ClientProfile(name,
+                                width=int(param('width', base.width)),
+                                height=int(param('height', base.height)),
+                                categories=param('categories', base.categories),
+                                show_titles=param('titles', str(base.show_titles)).lower() in ('1', 'true', 'yes'))
+        if not (0 < profile.width <= MAX_DIMENSION and 0 < profile.height <= MAX_DIMENSION):
+            raise ValueError(f'Size {profile.width}x{profile.height} is out of range')
+        return profile
+
+    def _create_handler(self):
+        server = self
+
+        class RenderRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == '/slide':
+                    self.send_slide(parse_qs(url.query))
+                elif url.path == '/mosaic':
+                    self.send_mosaic(parse_qs(url.query))
+                elif url.path == '/profiles':
+                    body = json.dumps({n: p.as_dict() for n, p in server.profiles.items()}).encode()
+                    self.send_body(200, 'application/json', body)
+                elif url.path == '/health':
+                    body = json.dumps({'feeds': server.feed_counts(),
+                                       'cache_bytes': server.cache.current_bytes,
+                                       'cache_hits': server.cache.hits,
+                                       'cache_misses': server.cache.misses}).encode()
+                    self.send_body(200, 'application/json', body)
+                else:
+                    self.send_error(404)
+
+            def send_slide(self, params):
+                try:
+                    profile = server.resolve_profile(params)
+                except ValueError:
+                    self.send_error(400, 'Invalid width or height')
+                    return
+                if not profile:
+                    self.send_error(404, 'Unknown client profile')
+                    return
+                try:
+                    data, title = server.render(profile)
+                except StopIteration:
+                    self.send_error(503, 'No photos available')
+                    return
+                except Exception:
+                    server.log.exception('Could not render a slide for %s', profile)
+                    self.send_error(500, 'Could not render a slide')
+                    return
+                self.send_body(200, 'image/jpeg', data, {'X-Photo-Title': quote(title)})
+
+            def send_mosaic(self, params):
+                def param(name, default):
+                    return int(params[name][0]) if name in params else default
+
+                try:
+                    profile = server.resolve_profile(params)
+                    count = param('count', 9)
+                    tile_size = (param('tile_width', 320), param('tile_height', 240))
+                except ValueError:
+                    self.send_error(400, 'Invalid count or size')
+                    return
+                if not (0 < count <= MAX_MOSAIC_TILES and all(0 < d <= MAX_TILE_DIMENSION for d in tile_size)):
+                    self.send_error(400, 'Count or tile size is out of range')
+                    return
+                if not profile:
+                    self.send_error(404, 'Unknown client profile')
+                    return
+                try:
+                    data, titles = server.render_mosaic(profile.categories, count, tile_size)
+                except StopIteration:
+                    self.send_error(503, 'No photos available')
+                    return
+                except Exception:
+                    server.log.exception('Could not render a mosaic for %s', profile)
+                    self.send_error(500, 'Could not render a mosaic')
+                    return
+                self.send_body(200, 'image/jpeg', data, {'X-Photo-Titles': ','.join(quote(t) for t in titles)})
+
+            def send_body(self, status, content_type, body, headers=None):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, fmt, *args):
+                server.log.debug(fmt, *args)
+
+        return RenderRequestHandler
+
+    def start(self):
+        """ Serve requests from a background thread. """
+        self._serving = True
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='RenderServer', daemon=True)
+        self._thread.start()
+
+    def serve_forever(self):
+        self._serving = True
+        self.httpd.serve_forever()
+
+    def stop(self):
+        # shutdown waits for serve_forever to return, so it would never return if serving had not started.
+        if self._serving:
+            self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread:
+            self._thread.join()
+        with self._lock:
+            for feed in self.feeds.values():
+                feed.shutdown()
+        self.decoder.shutdown()
+
+
+if __name__ == '__main__':
+    from logs import configure_logging
+
+    # Serve the existing library on localhost, e.g. curl -D - 'http://127.0.0.1:8610/slide?width=800&height=480'
+    configure_logging()
+
+    _category_service = CategoryService.load('sql')
+    _server = RenderServer(_category_service,
+                           host=CONFIG.get('server', 'host', fallback='127.0.0.1'),
+                           port=CONFIG.getint('server', 'port', fallback=DEFAULT_PORT))
+    try:
+        _server.serve_forever()
+    finally:
+        _category_service.shutdown()
@@ -1,27 +1,76 @@
 import logging
+import shutil
+import threading
 import time
 
 from abc import ABC, abstractmethod
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Executor, ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
+from typing import List, Optional, Union
 
 import requests
 
-from categories import CategoryService, JsonCategoryService, RekognitionService
-from common import JSON_STORAGE_PATH, USE_REKOGNITION_SERVICE
+from categories import CategoryService, JsonCategoryService, RekognitionService, is_image_file
+from common import CONFIG, JSON_STORAGE_PATH, USE_LOCAL_LABELS, USE_REKOGNITION_SERVICE, tags_from_file_name
+from labels import LocalLabelService
+
+DOWNLOAD_TIMEOUT = 60
+""" Seconds to wait for a photo download when the source does not set its own timeout. """
+
+
+class FeedItem:
+    """
+    A photo from any feed, normalised so the downloader does not need to know each service's response format.
+
+    Items either have an image_url to download or, for local sources, a source_path to copy.
+    """
+    def __init__(self, source_name: str, file_name: str, tags: Union[str, list], image_url: Optional[str] = None,
+                 page_url: Optional[str] = None, source_path: Optional[Path] = None):
+        self.source_name = source_name
+        self.file_name = file_name
+        self.tags = tags
+        self.image_url = image_url
+        self.page_url = page_url
+        self.source_path = source_path
+
+    def __repr__(self):
+        return f'{self.source_name}: {self.file_name} from {self.image_url or self.source_path}'
 
 
 class PhotoFeedService(ABC):
     SOURCE_NAME = 'NONE'
+    source_name = SOURCE_NAME
+    """ The name recorded as the provenance of this service's photos, the configured source name if it has one. """
+    is_downloaded = None
+    """ Set to PhotoDownloader.has_file by the FeedAggregator, so services can leave out items already downloaded. """
 
     @abstractmethod
     def retrieve_feed(self):
         pass
 
+    @abstractmethod
+    def retrieve_items(self) -> List[FeedItem]:
+        """ Get the latest feed as a list of FeedItems. """
+        pass
+
+    @classmethod
+    def load(cls, service_type, args, source_name: Optional[str] = None):
+        if service_type.lower() == 'pixabay':
+            service = PixabayPhotoFeedService(args)
+        elif service_type.lower() == 'local':
+            service = LocalDirectoryPhotoFeedService(args)
+        else:
+            raise ValueError(f'Unknown feed service type: {service_type}')
+        if source_name:
+            service.source_name = source_name
+        return service
+
 
 class PixabayPhotoFeedService(PhotoFeedService):
 
     SOURCE_NAME = 'PIXABAY'
+    source_name = SOURCE_NAME
 
     def __init__(self, args):
         self.log = logging.getLogger('frame.PixabayPhotoFeedService')
@@ -33,11 +82,9 @@ class PixabayPhotoFeedService(PhotoFeedService):
         self.image_type = args.get('image_type', 'photo')
         self.category = args.get('category', None)
         self.editors_choice = args.get('editors_choice', 'false')
+        self.timeout = args.getfloat('timeout', 30)
         self.current_feed = None
 
-    # TODO - refactor to return a 'common' feed object
-    # or create a new method that parses the feed to return
-    # that 'common' object/response.
     def retrieve_feed(self):
         """ Get latest photo feed """
         data = {
@@ -53,7 +100,7 @@ class PixabayPhotoFeedService(PhotoFeedService):
         headers = {'Content-Type': 'application/json'}
 
         self.log.info('Downloading feed from %s', self.base_url)
-        response = requests.get(self.base_url, params=data, headers=headers)
+        response = requests.get(self.base_url, params=data, headers=headers, timeout=self.timeout)
         if response.status_code == 200:
             self.current_feed = response.json()['hits']
         else:
@@ -61,65 +108,231 @@ class PixabayPhotoFeedService(PhotoFeedService):
 
         return self.current_feed
 
+    def retrieve_items(self):
+        feed = self.retrieve_feed()
+        if not feed:
+            return []
+        return [FeedItem(self.source_name,
+                         create_file_name(hit[self.image_key], hit['pageURL']),
+                         hit.get('tags', 'all'),
+                         image_url=hit[self.image_key],
+                         page_url=hit['pageURL']) for hit in feed]
+
+
+class LocalDirectoryPhotoFeedService(PhotoFeedService):
+    """ Picks up photos dropped into a local directory, such as a USB stick or a network share. """
+
+    SOURCE_NAME = 'LOCAL'
+    source_name = SOURCE_NAME
+
+    def __init__(self, args):
+        self.log = logging.getLogger('frame.LocalDirectoryPhotoFeedService')
+        self.directory = Path(args['directory'])
+        self.max_photos = args.getint('max_photos', 100)
+
+    def retrieve_feed(self):
+        if not self.directory.is_dir():
+            self.log.warning('Directory %s does not exist', self.directory)
+            return []
+        entries = sorted(entry for entry in self.directory.iterdir() if is_image_file(entry))
+        if self.is_downloaded:
+            # Left out before truncating, so each poll picks up the next max_photos rather than the same ones.
+            entries = [entry for entry in entries if not self.is_downloaded(entry.name)]
+        return entries[:self.max_photos]
+
+    def retrieve_items(self):
+        return [FeedItem(self.source_name, entry.name, tags_from_file_name(entry), source_path=entry)
+                for entry in self.retrieve_feed()]
+
 
 class PhotoDownloader:
-    def __init__(self, service: PhotoFeedService, download_path: Path, category_service: CategoryService = None):
+    def __init__(self, service: Optional[PhotoFeedService], download_path: Path,
+                 category_service: CategoryService = None, storage_manager=None):
         if not category_service:
             category_service = JsonCategoryService(JSON_STORAGE_PATH)
         self.log = logging.getLogger('frame.PhotoDownloader')
         self.photo_service = service
         self.download_path = download_path
         self.category_service = category_service
-        self.rek = RekognitionService()
+        self.rek = RekognitionService() if USE_REKOGNITION_SERVICE else None
+        self.labeller = LocalLabelService() if USE_LOCAL_LABELS else None
+        self.label_coverage = CONFIG.getfloat('service.labels', 'min_coverage', fallback=20.0)
+        self.storage_manager = storage_manager
         self.log.info('Using category service of type %s', type(category_service))
 
+    def has_file(self, file_name):
+        return (self.download_path / file_name).exists()
+
+    def download_item(self, item: FeedItem, timeout: float = DOWNLOAD_TIMEOUT):
+        """
+        Download, or copy, a single item into the download path and save its tags.
+
+        :param timeout: Seconds to wait for the server, so a slow source cannot hold a download thread indefinitely.
+        """
+        if self.has_file(item.file_name):
+            self.log.debug('File %s was found in the cache. Skipping download.', item.file_name)
+            return
+
+        new_file = self.download_path / item.file_name
+        if item.source_path:
+            self.log.info('Copying: %s as %s', item.source_path, item.file_name)
+            shutil.copyfile(item.source_path, new_file)
+        else:
+            self.log.info('Caching: %s as %s', item.image_url, item.file_name)
+            resp = requests.get(item.image_url, timeout=timeout)
+            data = resp.content if resp.status_code == 200 else None
+            if not data:
+                return
+            with new_file.open('wb') as f:
+                f.write(data)
+        self.log.info('Saved %s', item.file_name)
+
+        self.log.info('Saving tags: %s', item.tags)
+        self.category_service.save_to_categories(new_file, item.tags, source_name=item.source_name)
+
+        if self.rek:
+            rek_tags = self.rek.load_categories_for_photo(new_file)
+            if rek_tags:
+                self.log.info('Saving Rekognition tags: %s', rek_tags)
+                self.category_service.save_to_categories(new_file, rek_tags, source_name=item.source_name)
+
+        if self.labeller:
+            local_tags = self.labeller.load_categories_for_photo(new_file, self.label_coverage)
+            if local_tags:
+                self.log.info('Saving local labels: %s', local_tags)
+                self.category_service.save_to_categories(new_file, local_tags, source_name=item.source_name)
+
+        if self.storage_manager:
+            self.storage_manager.photo_added(new_file)
+
+    def download_items(self, items, executor: Optional[Executor] = None, timeout: float = DOWNLOAD_TIMEOUT):
+        """
+        Download the provided items, on the provided executor if given, otherwise on a private pool of four threads.
+        """
+        if executor:
+            return [executor.submit(self.download_item, item, timeout) for item in items]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            executor.map(lambda item: self.download_item(item, timeout), items)
+
     def download_feed(self):
-        def has_file(file_name):
-            f = Path(f'{self.download_path}/{file_name}')
-            return f.exists()
-
-        def create_file_name(image_url, page_url):
-            """
-            create a file name for use by the system for saving and
-            loading pictures to and from the cache
-            """
-            file_name = determine_file_name_from_url(page_url)
-            file_extension = determine_file_extension(image_url)
-            return file_name + file_extension
-
-        def download_photo(item):
-            # TODO - things like 'largeImageURL', 'tags', etc will
-            # need to be factored out back to the 'service' class
-            # and then this can be updated to handle a uniform object
-            image_url = item['largeImageURL']
-            page_url = item['pageURL']
-            file_name = create_file_name(image_url, page_url)
-            if not has_file(file_name):
-                self.log.info('Caching: %s as %s', image_url, file_name)
-                resp = requests.get(image_url)
-                data = resp.content if resp.status_code == 200 else None
-                if data:
-                    new_file = self.download_path / file_name
-                    with new_file.open('wb') as f:
-                        f.write(data)
-                    self.log.info('Saved %s', file_name)
-
-                    tags = item.get('tags', 'all')
-                    self.log.info('Saving tags: %s', tags)
-                    self.category_service.save_to_categories(new_file, tags)
-
-                    if USE_REKOGNITION_SERVICE:
-                        rek_tags = self.rek.load_categories_for_photo(new_file)
-                        if rek_tags:
-                            self.log.info('Saving Rekognition tags: %s', tags)
-                            self.category_service.save_to_categories(new_file, rek_tags)
-            else:
-                self.log.debug('File %s was found in the cache. Skipping download.', file_name)
-
-        feed = self.photo_service.retrieve_feed()
-        if feed:
-            with ThreadPoolExecutor(max_workers=4) as executor:
-                executor.map(download_photo, feed)
+        items = self.photo_service.retrieve_items()
+        if items:
+            self.download_items(items)
+
+
+class FeedSource:
+    """ A feed service polled by the FeedAggregator, with its own interval and timeout. """
+    def __init__(self, name: str, service: PhotoFeedService, interval: float = 300, timeout: float = 60):
+        self.name = name
+        self.service = service
+        self.interval = interval
+        self.timeout = timeout
+        # Each source polls on its own thread, so a hung source only ever blocks itself.
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'FeedSource-{name}')
+        # Set by the FeedAggregator. Downloads are also per source, so slow downloads only delay their own source.
+        self.download_executor = None
+        self.next_poll = 0.0
+        self.polling = None
+        self.poll_started = 0.0
+        self.timed_out = False
+        self.failures = 0
+
+
+class FeedAggregator:
+    """
+    Polls several feed services concurrently, each on its own interval, and downloads their items on a pool per
+    source of download_workers threads.
+
+    A failing source backs off exponentially and a source that exceeds its timeout is skipped until its poll
+    returns, neither of which delays ingest from the other sources.
+    """
+    def __init__(self, downloader: PhotoDownloader, sources: List[FeedSource], download_workers: int = 4,
+                 max_backoff: float = 3600):
+        self.log = logging.getLogger('frame.FeedAggregator')
+        self.downloader = downloader
+        self.sources = sources
+        self.max_backoff = max_backoff
+        for source in sources:
+            source.download_executor = ThreadPoolExecutor(max_workers=download_workers,
+                                                          thread_name_prefix=f'Download-{source.name}')
+            source.service.is_downloaded = downloader.has_file
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='FeedAggregator', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        for source in self.sources:
+            source.executor.shutdown(wait=False, cancel_futures=True)
+            source.download_executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            now = time.monotonic()
+            for source in self.sources:
+                # The future is kept once done, and never reset from the poll itself, so it cannot race with submit.
+                if source.polling and not source.polling.done():
+                    if not source.timed_out and now - source.poll_started > source.timeout:
+                        source.timed_out = True
+                        self.log.warning('Source %s has not responded in %.0f seconds. Skipping it until it does.',
+                                         source.name, source.timeout)
+                elif now >= source.next_poll:
+                    source.poll_started = now
+                    source.timed_out = False
+                    source.polling = source.executor.submit(self._poll, source)
+            self._stop.wait(1.0)
+
+    def _poll(self, source: FeedSource):
+        try:
+            items = source.service.retrieve_items()
+        except Exception as e:
+            source.failures += 1
+            backoff = min(source.interval * 2 ** source.failures, self.max_backoff)
+            self.log.error('Polling source %s failed (%d in a row), retrying in %.0f seconds: %s',
+                           source.name, source.failures, backoff, e)
+            source.next_poll = time.monotonic() + backoff
+        else:
+            source.failures = 0
+            source.next_poll = time.monotonic() + source.interval
+            self.log.info('Source %s returned %d items', source.name, len(items))
+            if not self._stop.is_set():
+                futures = self.downloader.download_items(items, source.download_executor, source.timeout)
+                for item, future in zip(items, futures):
+                    future.add_done_callback(partial(self._downloaded, source, item))
+
+    def _downloaded(self, source: FeedSource, item: FeedItem, future):
+        if not future.cancelled() and future.exception():
+            self.log.error('Source %s could not download %s: %s', source.name, item.file_name, future.exception())
+
+
+def load_feed_sources(names, config) -> List[FeedSource]:
+    """
+    Create a FeedSource for each name, configured from its [service.NAME] section.
+
+    :param names: A comma-separated list of source names, e.g. 'pixabay, local'.
+    """
+    sources = []
+    for name in [x.strip() for x in names.split(',') if x.strip()]:
+        args = config[f'service.{name}']
+        sources.append(FeedSource(name, PhotoFeedService.load(args.get('type', name), args, source_name=name),
+                                  interval=args.getfloat('interval', 300),
+                                  timeout=args.getfloat('timeout', 60)))
+    return sources
+
+
+def create_file_name(image_url, page_url):
+    """
+    create a file name for use by the system for saving and
+    loading pictures to and from the cache
+    """
+    file_name = determine_file_name_from_url(page_url)
+    file_extension = determine_file_extension(image_url)
+    return file_name + file_extension
 
 
 def determine_file_name_from_url(url):
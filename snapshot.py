@@ -0,0 +1,261 @@
+import logging
+import mmap
+import os
+import sqlite3
+import struct
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+
+from common import DB_FILE_PATH, DB_STORAGE_PATH
+from photo import Photo
+
+SNAPSHOT_PATH = DB_STORAGE_PATH / 'catalog.snapshot'
+""" The default path of the catalog snapshot, next to the database it was taken from. """
+
+MAGIC = b'PFSNAP01'
+VERSION = 3
+
+# magic, version, catalog change counter, max photo id, max categories_photos rowid, record count, tag count,
+# then the offsets of the records, tag table, postings and string blob.
+HEADER = struct.Struct('<8sIIqqIIQQQQ')
+
+RECORD_DTYPE = np.dtype([('id', '<i8'), ('path_offset', '<u4'), ('path_length', '<u4'),
+                         ('title_offset', '<u4'), ('title_length', '<u4')])
+TAG_DTYPE = np.dtype([('name_offset', '<u4'), ('name_length', '<u4'),
+                      ('postings_start', '<u4'), ('postings_count', '<u4')])
+POSTING_DTYPE = np.dtype('<u4')
+
+
+def catalog_change_counter(db: sqlite3.Connection) -> int:
+    """
+    The catalog change counter kept by SqlDbCategoryService, which counts the photos and tags added or removed and
+    the photos enabled or disabled. Display metrics, written on every slide, leave it unchanged.
+    """
+    return db.execute('SELECT counter FROM catalog_changes WHERE id = 0').fetchone()[0] & 0xFFFFFFFF
+
+
+def read_change_counter(data_path: Path = None) -> int:
+    """ Read the catalog change counter, which only moves when the catalog changes. """
+    if not data_path:
+        data_path = DB_FILE_PATH
+    with sqlite3.connect(data_path) as db:
+        change_counter = catalog_change_counter(db)
+    db.close()
+    return change_counter
+
+
+def write_snapshot(data_path: Path = None, snapshot_path: Path = None) -> int:
+    """
+    Write a compact binary snapshot of the enabled photos and their tags.
+
+    The file is written next to the target and renamed into place, so readers never see a partial snapshot.
+
+    :return: the number of photos in the snapshot.
+    """
+    if not data_path:
+        data_path = DB_FILE_PATH
+    if not snapshot_path:
+        snapshot_path = SNAPSHOT_PATH
+
+    with sqlite3.connect(data_path) as db:
+        db.execute('BEGIN')
+        photos = db.execute("""SELECT id, img_path, title FROM photos
+                               WHERE coalesce(disabled, 0) = 0 ORDER BY id""").fetchall()
+        # The read transaction holds a shared lock, so no write can be committed between the query and this read.
+        change_counter = catalog_change_counter(db)
+        max_mapping_id = db.execute('SELECT coalesce(max(rowid), 0) FROM categories_photos').fetchone()[0]
+        tags = db.execute("""SELECT c.tag, cp.photo_id FROM categories c
+                             JOIN categories_photos cp ON cp.category_id = c.id
+                             ORDER BY c.tag""").fetchall()
+        db.execute('COMMIT')
+    db.close()
+
+    blob = bytearray()
+
+    def add_string(value):
+        encoded = (value or '').encode('utf-8')
+        offset = len(blob)
+        blob.extend(encoded)
+        return offset, len(encoded)
+
+    records = np.zeros(len(photos), dtype=RECORD_DTYPE)
+    index_of = {}
+    for i, (photo_id, img_path, title) in enumerate(photos):
+        path_offset, path_length = add_string(img_path)
+        title_offset, title_length = add_string(title)
+        records[i] = (photo_id, path_offset, path_length, title_offset, title_length)
+        index_of[photo_id] = i
+
+    postings_by_tag = {}
+    for tag, photo_id in tags:
+        if photo_id in index_of:
+            postings_by_tag.setdefault(tag, set()).add(index_of[photo_id])
+
+    tag_table = np.zeros(len(postings_by_tag), dtype=TAG_DTYPE)
+    postings = []
+    for i, (tag, indexes) in enumerate(postings_by_tag.items()):
+        name_offset, name_length = add_string(tag)
+        tag_table[i] = (name_offset, name_length, len(postings), len(indexes))
+        postings.extend(sorted(indexes))
+    postings = np.array(postings, dtype=POSTING_DTYPE)
+
+    records_offset = HEADER.size
+    tags_offset = records_offset + records.nbytes
+    postings_offset = tags_offset + tag_table.nbytes
+    blob_offset = postings_offset + postings.nbytes
+    max_id = int(records['id'].max()) if len(records) else 0
+    header = HEADER.pack(MAGIC, VERSION, change_counter, max_id, max_mapping_id, len(records), len(tag_table),
+                         records_offset, tags_offset, postings_offset, blob_offset)
+
+    snapshot_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = snapshot_path.with_suffix('.tmp')
+    with temp_path.open('wb') as f:
+        for part in (header, records.tobytes(), tag_table.tobytes(), postings.tobytes(), bytes(blob)):
+            f.write(part)
+    os.replace(temp_path, snapshot_path)
+    return len(records)
+
+
+class CatalogSnapshot:
+    """
+    A memory-mapped catalog snapshot. Opening one costs the same regardless of library size, and records are only
+    decoded when a Photo is requested.
+    """
+    def __init__(self, snapshot_path: Path = None):
+        if not snapshot_path:
+            snapshot_path = SNAPSHOT_PATH
+        self.log = logging.getLogger('frame.CatalogSnapshot')
+        with snapshot_path.open('rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.mm) < HEADER.size:
+            raise ValueError(f'Snapshot {snapshot_path} is truncated')
+        (magic, version, self.change_counter, self.max_photo_id, self.max_mapping_id, record_count, tag_count,
+         records_offset, tags_offset, postings_offset, blob_offset) = HEADER.unpack_from(self.mm)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'Snapshot {snapshot_path} has an unsupported format')
+        self.records = np.frombuffer(self.mm, dtype=RECORD_DTYPE, count=record_count, offset=records_offset)
+        self.tags = np.frombuffer(self.mm, dtype=TAG_DTYPE, count=tag_count, offset=tags_offset)
+        self.postings = np.frombuffer(self.mm, dtype=POSTING_DTYPE, count=(blob_offset - postings_offset) // 4,
+                                      offset=postings_offset)
+        self.blob_offset = blob_offset
+        self._tag_lookup = None
+        self._path_lookup = None
+
+    def __len__(self):
+        return len(self.records)
+
+    def _string(self, offset, length) -> str:
+        start = self.blob_offset + int(offset)
+        return self.mm[start:start + int(length)].decode('utf-8')
+
+    def photo(self, index: int) -> Photo:
+        record = self.records[index]
+        return Photo(Path(self._string(record['path_offset'], record['path_length'])),
+                     self._string(record['title_offset'], record['title_length']) or None,
+                     int(record['id']))
+
+    def index_of_path(self, file_path) -> Optional[int]:
+        """ The record index of the photo at file_path, or None if the snapshot does not contain it. """
+        if self._path_lookup is None:
+            # Built on first use from the path strings alone, without creating Photos.
+            self._path_lookup = {self._string(offset, length): i for i, (offset, length) in enumerate(
+                zip(self.records['path_offset'].tolist(), self.records['path_length'].tolist()))}
+        return self._path_lookup.get(str(file_path))
+
+    def indexes_for(self, categories: Union[str, list]) -> np.ndarray:
+        """
+        Resolve categories to record indexes using the tag index.
+
+        :param categories: A comma-separated list of categories, as used by the category services.
+        :return: a sorted array of record indexes.
+        """
+        if isinstance(categories, str):
+            parsed = [x.strip() for x in categories.split(',')]
+        else:
+            parsed = [x.strip() for x in categories]
+        if 'all' in parsed or not parsed:
+            return np.arange(len(self.records), dtype=np.int64)
+
+        if self._tag_lookup is None:
+            # Built on first use, it only touches the tag table, not the records.
+            self._tag_lookup = {self._string(t['name_offset'], t['name_length']): i for i, t in enumerate(self.tags)}
+        slices = []
+        for name in parsed:
+            i = self._tag_lookup.get(name)
+            if i is not None:
+                start = int(self.tags[i]['postings_start'])
+                slices.append(self.postings[start:start + int(self.tags[i]['postings_count'])])
+        if not slices:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate(slices)).astype(np.int64)
+
+    def close(self):
+        # The arrays must be released before the map can be closed.
+        self.records = self.tags = self.postings = None
+        self.mm.close()
+
+
+class SnapshotPhotoList(Sequence):
+    """ A read-only view of selected snapshot records, plus any photos added after the snapshot was taken. """
+    def __init__(self, snapshot: CatalogSnapshot, indexes: np.ndarray, extra: Optional[list] = None):
+        self.snapshot = snapshot
+        self.indexes = indexes
+        self.extra = extra if extra else []
+
+    def __len__(self):
+        return len(self.indexes) + len(self.extra)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if i < len(self.indexes):
+            return self.snapshot.photo(self.indexes[i])
+        return self.extra[i - len(self.indexes)]
+
+    def __add__(self, other):
+        return SnapshotPhotoList(self.snapshot, self.indexes, self.extra + list(other))
+
+    def ids(self) -> list:
+        """ The photo ids in list order, read from the records without creating Photos. """
+        return self.snapshot.records['id'][self.indexes].tolist() + [p.id for p in self.extra]
+
+    def has_path(self, file_path) -> bool:
+        """ Whether the list contains the photo at file_path, checked without creating Photos. """
+        index = self.snapshot.index_of_path(file_path)
+        if index is not None and np.any(self.indexes == index):
+            return True
+        return any(p.file_path == Path(file_path) for p in self.extra)
+
+    def without_paths(self, file_paths):
+        """ Drop the photos at the provided file paths, found by path rather than by creating every Photo. """
+        paths = {Path(p) for p in file_paths}
+        found = [i for i in (self.snapshot.index_of_path(p) for p in paths) if i is not None]
+        indexes = self.indexes[np.isin(self.indexes, found, invert=True)] if found else self.indexes
+        return SnapshotPhotoList(self.snapshot, indexes, [p for p in self.extra if p.file_path not in paths])
+
+    def without_ids(self, live_ids: np.ndarray):
+        """ Keep only the snapshot records whose ids are in live_ids, e.g. after rows were disabled or deleted. """
+        ids = self.snapshot.records['id'][self.indexes]
+        return SnapshotPhotoList(self.snapshot, self.indexes[np.isin(ids, live_ids)], self.extra)
+
+
+def live_photo_ids(data_path: Path, max_id: int) -> np.ndarray:
+    """ The ids of enabled photos up to max_id. Reads only the ids, so it is cheap even for large libraries. """
+    with sqlite3.connect(data_path) as db:
+        rows = db.execute('SELECT id FROM photos WHERE coalesce(disabled, 0) = 0 AND id <= ?', [max_id]).fetchall()
+    db.close()
+    return np.fromiter((r[0] for r in rows), dtype=np.int64, count=len(rows))
+
+
+def retagged_photo_ids(data_path: Path, max_mapping_id: int, max_id: int) -> np.ndarray:
+    """ The ids up to max_id of photos given tags after max_mapping_id, found by a range scan of the mapping rowids. """
+    with sqlite3.connect(data_path) as db:
+        rows = db.execute('SELECT DISTINCT photo_id FROM categories_photos WHERE rowid > ? AND photo_id <= ?',
+                          [max_mapping_id, max_id]).fetchall()
+    db.close()
+    return np.fromiter((r[0] for r in rows), dtype=np.int64, count=len(rows))
@@ -0,0 +1,130 @@
+import logging
+import os
+from pathlib import Path
+from threading import RLock
+from typing import Optional
+
+from categories import CategoryService, SqlDbCategoryService
+from common import PHOTO_PATH, REKOGNITION_DATA_PATH, synchronized
+
+
+def directory_size(path: Path) -> int:
+    if not path.exists():
+        return 0
+    with os.scandir(path) as it:
+        return sum(entry.stat().st_size for entry in it if entry.is_file())
+
+
+class StorageManager:
+    """
+    Keeps downloaded photos, and their cached labels, within a byte quota.
+
+    Usage is counted once at start up and then updated incrementally as downloads land. When the quota is exceeded,
+    the lowest scoring, least recently displayed photos are evicted until usage drops below the low water mark.
+    """
+    def __init__(self, quota_bytes: int, category_service: CategoryService, photo_path: Optional[Path] = None,
+                 label_path: Optional[Path] = None, rendition_cache=None, low_water: float = 0.9,
+                 batch_size: int = 20):
+        if not photo_path:
+            photo_path = PHOTO_PATH
+        if not label_path:
+            label_path = REKOGNITION_DATA_PATH
+        self.log = logging.getLogger('frame.StorageManager')
+        self.quota_bytes = quota_bytes
+        self.low_water_bytes = int(quota_bytes * low_water)
+        self.category_service = category_service
+        self.photo_path = photo_path
+        self.label_path = label_path
+        self.rendition_cache = rendition_cache
+        self.batch_size = batch_size
+        self.listeners = []
+        self._lock = RLock()
+        self.used_bytes = 0
+        self.rescan()
+
+    def add_listener(self, listener):
+        """ Register a callable that receives the list of evicted Paths, e.g. PhotoFeed.remove_photos. """
+        # A new list is swapped in, so an eviction on another thread never iterates a list being changed.
+        self.listeners = self.listeners + [listener]
+
+    def remove_listener(self, listener):
+        self.listeners = [registered for registered in self.listeners if registered != listener]
+
+    @synchronized
+    def rescan(self):
+        self.used_bytes = directory_size(self.photo_path) + directory_size(self.label_path)
+        self.log.info('Storage in use: %d of %d bytes', self.used_bytes, self.quota_bytes)
+
+    def label_file(self, file_path: Path) -> Path:
+        """ The cached Rekognition response for a photo, as written by RekognitionService. """
+        return (self.label_path / file_path.name).with_suffix('.json')
+
+    @synchronized
+    def photo_added(self, file_path: Path):
+        """
+        Account for a newly downloaded photo, and its labels, evicting older photos if the quota is now exceeded.
+        """
+        for path in (file_path, self.label_file(file_path)):
+            try:
+                self.used_bytes += path.stat().st_size
+            except OSError:
+                pass
+        if self.used_bytes > self.quota_bytes:
+            self.evict(protect=file_path)
+
+    def candidates(self, limit: int, exclude):
+        """
+        The next photos to evict, lowest score first and then least recently displayed.
+
+        Falls back to least recently accessed files when the category service has no database.
+        """
+        if isinstance(self.category_service, SqlDbCategoryService):
+            # Only photos under photo_path are ours to delete, whatever else the database catalogues.
+            return self.category_service.least_valued_photos(self.photo_path, limit, exclude)
+
+        with os.scandir(self.photo_path) as it:
+            entries = [e for e in it if e.is_file() and Path(e.path) not in exclude]
+        entries.sort(key=lambda e: e.stat().st_atime)
+        return [Path(e.path) for e in entries[:limit]]
+
+    @synchronized
+    def evict(self, protect: Optional[Path] = None):
+        """
+        Evict photos until usage is below the low water mark.
+
+        Each batch removes the files, their database rows and category entries, their cached labels and any cached
+        renditions together.
+        """
+        exclude = {protect} if protect else set()
+        evicted = []
+        while self.used_bytes > self.low_water_bytes:
+            batch = self.candidates(self.batch_size, exclude)
+            if not batch:
+                self.log.warning('Nothing left to evict, but %d bytes are still in use', self.used_bytes)
+                break
+            exclude.update(batch)
+            selected = []
+            for file_path in batch:
+                if self.used_bytes <= self.low_water_bytes:
+                    break
+                for path in (file_path, self.label_file(file_path)):
+                    try:
+                        self.used_bytes -= path.stat().st_size
+                    except OSError:
+                        pass
+                selected.append(file_path)
+
+            self.category_service.remove_photos(selected)
+            for file_path in selected:
+                file_path.unlink(missing_ok=True)
+                self.label_file(file_path).unlink(missing_ok=True)
+                if self.rendition_cache:
+                    self.rendition_cache.discard(file_path)
+            evicted.extend(selected)
+
+        if evicted:
+            self.log.info('Evicted %d photos. Storage in use: %d of %d bytes',
+                          len(evicted), self.used_bytes, self.quota_bytes)
+            for listener in self.listeners:
+                listener(evicted)
+        return evicted
@@ -0,0 +1,10 @@
+import os
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).parent.parent
+
+# The modules live at the top level, and read their configuration on import. Tests use the template, so they do not
+# depend on, or change, a local config.ini.
+sys.path.insert(0, str(ROOT))
+os.environ.setdefault('FRAME_CONFIG', str(ROOT / 'configs' / 'config.ini.template'))
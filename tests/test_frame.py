@@ -0,0 +1,44 @@
+from PIL import Image
+
+from animation import AnimationCache
+from backends import OffscreenBackend
+from categories import SqlDbCategoryService
+from feeds import PhotoFeed
+from frame import SlideShowFrame
+
+
+def test_bad_files_are_skipped(tmp_path):
+    service = SqlDbCategoryService(tmp_path / 'tags.db')
+    for name in ('beach-1.jpg', 'missing-2.jpg', 'broken-3.jpg'):
+        path = tmp_path / name
+        Image.new('RGB', (64, 48)).save(path)
+        service.save_to_categories(path, ['beach'])
+    (tmp_path / 'missing-2.jpg').unlink()
+    (tmp_path / 'broken-3.jpg').write_bytes(b'not a jpeg')
+    feed = PhotoFeed(categories='all', category_service=service, record_metrics=False)
+    backend = OffscreenBackend(size=(64, 48), max_slides=5)
+    app = SlideShowFrame(feed, 0, 0, 0, backend=backend)
+    app.show_slides()
+    app.run()
+    assert backend.slides_shown == 5
+    feed.shutdown()
+    service.shutdown()
+
+
+def test_animations_with_no_delay_stop_at_the_slide_limit(tmp_path):
+    service = SqlDbCategoryService(tmp_path / 'tags.db')
+    for i in range(3):
+        path = tmp_path / f'spin-{i}.gif'
+        frames = [Image.new('RGB', (64, 48), colour) for colour in ('red', 'green', 'blue')]
+        frames[0].save(path, save_all=True, append_images=frames[1:], duration=20, loop=0)
+        service.save_to_categories(path, ['spin'])
+    feed = PhotoFeed(categories='all', category_service=service, record_metrics=False)
+    backend = OffscreenBackend(size=(64, 48), max_slides=50)
+    animations = AnimationCache()
+    app = SlideShowFrame(feed, 0, 0, 0, backend=backend, animations=animations)
+    app.show_slides()
+    app.run()
+    assert backend.slides_shown == 50
+    animations.shutdown()
+    feed.shutdown()
+    service.shutdown()
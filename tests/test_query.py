@@ -0,0 +1,52 @@
+import re
+
+import pytest
+
+from categories import SqlDbCategoryService
+from query import QuerySyntaxError, explain, is_query, parse
+
+
+@pytest.fixture
+def service(tmp_path):
+    service = SqlDbCategoryService(tmp_path / 'tags.db')
+    yield service
+    service.shutdown()
+
+
+@pytest.mark.parametrize('text', [
+    'beach AND sunset AND NOT people AND shown < 3 AND score >= 5',
+    '(tulip, daisy) AND days_since_shown > 7',
+    'match("flower*") OR "sea life"',
+])
+def test_query_plans_use_indexes(service, text):
+    plan = explain(service.db, text)
+    # Virtual table scans are FTS index lookups, and p itself is bounded by the since_id range.
+    scans = [p for p in plan if re.match(r'SCAN (?!p\b)', p) and 'VIRTUAL TABLE' not in p]
+    assert not scans, f'Unexpected table scans for {text!r}: {plan}'
+
+
+@pytest.mark.parametrize('bad', ['beach AND', 'score >= high', '(beach'])
+def test_parse_rejects_invalid_queries(bad):
+    with pytest.raises(QuerySyntaxError):
+        parse(bad)
+
+
+@pytest.mark.parametrize('categories', ['all', 'beach', 'beach, sunset', 'forget-me-not', 'rock-and-roll, sand',
+                                        'black and white', 'rock or roll, not today'])
+def test_tag_lists_are_not_queries(categories):
+    assert not is_query(categories)
+
+
+@pytest.mark.parametrize('categories', ['beach AND sunset', 'NOT people', 'shown < 3', '(tulip, daisy)',
+                                        'match("flower*")', 'beach AND NOT forget-me-not'])
+def test_queries(categories):
+    assert is_query(categories)
+
+
+def test_lower_case_words_are_tags():
+    assert repr(parse('"black and white" AND sunset')) == "BoolOp('AND', [Tag('black and white'), Tag('sunset')])"
+    assert repr(parse('beach AND and')) == "BoolOp('AND', [Tag('beach'), Tag('and')])"
+
+
+def test_invalid_match_loads_nothing(service):
+    assert list(service.load_from_categories('match("flower AND")')) == []
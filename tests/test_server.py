@@ -0,0 +1,156 @@
+import io
+
+import pytest
+import requests
+from PIL import Image
+
+from categories import SqlDbCategoryService
+from server import ClientProfile, RenderServer
+from storage import StorageManager
+
+
+@pytest.fixture
+def server(tmp_path):
+    service = SqlDbCategoryService(tmp_path / 'tags.db')
+    for name, tag in (('beach-1.jpg', 'beach'), ('forest-2.jpg', 'forest')):
+        path = tmp_path / name
+        Image.new('RGB', (64, 48), 'blue').save(path)
+        service.save_to_categories(path, [tag])
+    # Port 0 binds an ephemeral port, so tests never clash with a running server.
+    server = RenderServer(service, profiles={'kitchen': ClientProfile('kitchen', 32, 24, 'beach')}, port=0)
+    server.start()
+    yield f'http://127.0.0.1:{server.port}'
+    server.stop()
+    service.shutdown()
+
+
+def get(url, **params):
+    return requests.get(url, params=params, timeout=10)
+
+
+def test_slide_for_client_profile(server):
+    resp = get(f'{server}/slide', client='kitchen')
+    assert resp.status_code == 200
+    assert resp.headers['Content-Type'] == 'image/jpeg'
+    assert Image.open(io.BytesIO(resp.content)).size == (32, 24)
+    assert resp.headers['X-Photo-Title']
+
+
+def test_slide_with_size_override(server):
+    resp = get(f'{server}/slide', width=16, height=16)
+    assert resp.status_code == 200
+    assert max(Image.open(io.BytesIO(resp.content)).size) == 16
+
+
+@pytest.mark.parametrize('size', [{'width': 0}, {'height': -5}, {'width': 'wide'}, {'width': 100000}])
+def test_invalid_size_is_bad_request(server, size):
+    assert get(f'{server}/slide', **size).status_code == 400
+
+
+def test_mosaic_of_sample(server):
+    resp = get(f'{server}/mosaic', count=4, tile_width=20, tile_height=10)
+    assert resp.status_code == 200
+    # Both photos in a grid of two columns.
+    assert Image.open(io.BytesIO(resp.content)).size == (40, 10)
+    assert len(resp.headers['X-Photo-Titles'].split(',')) == 2
+
+
+@pytest.mark.parametrize('params', [{'count': 0}, {'count': 1000}, {'tile_width': 'wide'}, {'tile_height': 5000}])
+def test_invalid_mosaic_is_bad_request(server, params):
+    assert get(f'{server}/mosaic', **params).status_code == 400
+
+
+def test_empty_mosaic_is_unavailable(server):
+    assert get(f'{server}/mosaic', categories='mountains').status_code == 503
+
+
+def test_unknown_client_is_not_found(server):
+    assert get(f'{server}/slide', client='garage').status_code == 404
+
+
+def test_unknown_path_is_not_found(server):
+    assert get(f'{server}/nothing').status_code == 404
+
+
+def test_no_photos_is_unavailable(server):
+    assert get(f'{server}/slide', categories='mountains').status_code == 503
+
+
+def test_feeds_are_capped(server):
+    for i in range(12):
+        get(f'{server}/slide', categories=f'tag{i}')
+    health = get(f'{server}/health').json()
+    assert len(health['feeds']) == 8
+
+
+def test_render_failure_is_server_error(server, tmp_path):
+    broken = tmp_path / 'broken-3.jpg'
+    Image.new('RGB', (64, 48)).save(broken)
+    service = SqlDbCategoryService(tmp_path / 'tags.db')
+    service.save_to_categories(broken, ['broken'])
+    service.shutdown()
+    broken.write_bytes(b'not a jpeg')
+    assert get(f'{server}/slide', categories='broken').status_code == 500
+    assert get(f'{server}/slide', client='kitchen').status_code == 200
+
+
+def test_feeds_share_one_decoder(tmp_path):
+    service = SqlDbCategoryService(tmp_path / 'tags.db')
+    server = RenderServer(service, profiles={}, port=0)
+    beach, forest = server.feed_for('beach'), server.feed_for('forest')
+    assert beach.decoder is forest.decoder is server.decoder
+    # Stopping a server that never served must not wait for it.
+    server.stop()
+    service.shutdown()
+
+
+def test_evicted_photos_leave_server_feeds(tmp_path):
+    service = SqlDbCategoryService(tmp_path / 'tags.db')
+    photos = tmp_path / 'photos'
+    photos.mkdir()
+    for name in ('beach-1.jpg', 'beach-2.jpg'):
+        Image.new('RGB', (64, 48), 'blue').save(photos / name)
+        service.save_to_categories(photos / name, ['beach'])
+    storage = StorageManager(10 ** 9, service, photo_path=photos, label_path=tmp_path / 'labels')
+    server = RenderServer(service, profiles={}, port=0, max_feeds=2, storage_manager=storage)
+    server.start()
+    url = f'http://127.0.0.1:{server.port}'
+    assert get(f'{url}/slide', categories='beach').status_code == 200
+
+    storage.low_water_bytes = 0
+    storage.evict()
+    assert get(f'{url}/slide', categories='beach').status_code == 503
+
+    for categories in ('a', 'b', 'c'):
+        server.feed_for(categories)
+    assert len(storage.listeners) == 2
+    server.stop()
+    service.shutdown()
+
+
+def test_loading_a_feed_does_not_block_others(tmp_path, monkeypatch):
+    import threading
+
+    import server as server_module
+
+    service = SqlDbCategoryService(tmp_path / 'tags.db')
+    server = RenderServer(service, profiles={}, port=0)
+    server.feed_for('beach')
+    loading, release = threading.Event(), threading.Event()
+
+    class SlowFeed(server_module.PhotoFeed):
+        def refresh(self):
+            loading.set()
+            release.wait(10)
+            super().refresh()
+
+    monkeypatch.setattr(server_module, 'PhotoFeed', SlowFeed)
+    thread = threading.Thread(target=server.feed_for, args=('forest',))
+    thread.start()
+    assert loading.wait(10)
+    assert server.feed_counts() == {'beach': 0}
+    release.set()
+    thread.join()
+    assert set(server.feed_counts()) == {'beach', 'forest'}
+    server.stop()
+    service.shutdown()
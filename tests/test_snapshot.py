@@ -0,0 +1,84 @@
+from PIL import Image
+
+from categories import SqlDbCategoryService
+from feeds import PhotoFeed
+from snapshot import read_change_counter, write_snapshot
+
+
+def add(service, tmp_path, name, tags):
+    path = tmp_path / name
+    Image.new('RGB', (64, 48)).save(path)
+    service.save_to_categories(path, tags)
+    return path
+
+
+def names(feed):
+    return sorted(p.file_path.name for p in feed.photo_list)
+
+
+def test_catch_up_applies_changes_since_snapshot(tmp_path):
+    service = SqlDbCategoryService(tmp_path / 'tags.db')
+    add(service, tmp_path, 'beach-1.jpg', ['beach'])
+    add(service, tmp_path, 'forest-2.jpg', ['forest'])
+    hidden = add(service, tmp_path, 'beach-3.jpg', ['beach'])
+    gone = add(service, tmp_path, 'beach-4.jpg', ['beach'])
+    service.db.execute('UPDATE photos SET disabled = 1 WHERE img_path = ?', [str(hidden)])
+    service.db.commit()
+    write_snapshot(service.data_path, tmp_path / 'catalog.snapshot')
+    feed = PhotoFeed(categories='beach', category_service=service, snapshot_path=tmp_path / 'catalog.snapshot',
+                     record_metrics=False)
+    assert names(feed) == ['beach-1.jpg', 'beach-4.jpg']
+
+    service.db.execute('UPDATE photos SET disabled = 0 WHERE img_path = ?', [str(hidden)])
+    service.db.commit()
+    service.save_to_categories(tmp_path / 'forest-2.jpg', ['beach'])
+    service.remove_photos([gone])
+    add(service, tmp_path, 'beach-5.jpg', ['beach'])
+    feed.refresh()
+    assert names(feed) == ['beach-1.jpg', 'beach-3.jpg', 'beach-5.jpg', 'forest-2.jpg']
+    feed.shutdown()
+    service.shutdown()
+
+
+def test_display_metrics_are_not_catalog_changes(tmp_path):
+    service = SqlDbCategoryService(tmp_path / 'tags.db')
+    add(service, tmp_path, 'beach-1.jpg', ['beach'])
+    before = read_change_counter(service.data_path)
+    service.db.execute('UPDATE photos SET times_displayed = 3, date_last_displayed = datetime()')
+    service.db.commit()
+    assert read_change_counter(service.data_path) == before
+    service.shutdown()
+
+
+def test_refresh_for_old_categories_does_not_finish_last(tmp_path):
+    import threading
+
+    loading, release = threading.Event(), threading.Event()
+
+    class SlowBeachService(SqlDbCategoryService):
+        def load_from_categories(self, categories, since_id=0, ids=None):
+            if categories == 'beach' and not loading.is_set():
+                loading.set()
+                release.wait(10)
+            return super().load_from_categories(categories, since_id, ids)
+
+    service = SlowBeachService(tmp_path / 'tags.db')
+    add(service, tmp_path, 'beach-1.jpg', ['beach'])
+    add(service, tmp_path, 'forest-2.jpg', ['forest'])
+    # Only the refresh on the timer thread is slowed down.
+    loading.set()
+    feed = PhotoFeed(categories='beach', category_service=service, record_metrics=False)
+    loading.clear()
+    timer = threading.Thread(target=feed.refresh)
+    timer.start()
+    assert loading.wait(10)
+    change = threading.Thread(target=feed.set_categories, args=('forest',))
+    change.start()
+    # Without the refresh lock, the new categories are loaded while the old refresh is still running.
+    change.join(0.5)
+    release.set()
+    timer.join()
+    change.join()
+    assert names(feed) == ['forest-2.jpg']
+    feed.shutdown()
+    service.shutdown()
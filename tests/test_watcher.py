@@ -0,0 +1,47 @@
+from PIL import Image
+
+from categories import SqlDbCategoryService
+from feeds import PhotoFeed
+from watcher import ADDED, REMOVED, LibraryWatcher
+
+
+def test_added_and_removed_photos_survive_refresh(tmp_path):
+    service = SqlDbCategoryService(tmp_path / 'tags.db')
+    kept = tmp_path / 'beach-1.jpg'
+    Image.new('RGB', (64, 48)).save(kept)
+    service.save_to_categories(kept, ['beach'])
+    feed = PhotoFeed(categories='all', category_service=service, record_metrics=False)
+    watcher = LibraryWatcher(service, feed, watch_path=tmp_path)
+
+    added = tmp_path / 'forest-2.jpg'
+    Image.new('RGB', (64, 48)).save(added)
+    watcher._record(ADDED, added.name)
+    watcher._flush()
+    feed.refresh()
+    assert feed.photo_count == 2
+
+    added.unlink()
+    watcher._record(REMOVED, added.name)
+    watcher._flush()
+    assert feed.photo_count == 1
+    feed.refresh()
+    assert feed.photo_count == 1
+    assert feed.next_image()[0].size == (64, 48)
+    feed.shutdown()
+    service.shutdown()
+
+
+def test_bad_file_is_skipped(tmp_path):
+    service = SqlDbCategoryService(tmp_path / 'tags.db')
+    feed = PhotoFeed(categories='all', category_service=service, record_metrics=False)
+    watcher = LibraryWatcher(service, feed, watch_path=tmp_path)
+    Image.new('RGB', (64, 48)).save(tmp_path / 'beach-1.jpg')
+    (tmp_path / 'broken-2.jpg').write_bytes(b'not a jpeg')
+    for name in ('beach-1.jpg', 'broken-2.jpg'):
+        watcher._record(ADDED, name)
+    watcher._flush()
+    assert [p.file_path.name for p in feed.photo_list] == ['beach-1.jpg']
+    feed.refresh()
+    assert feed.photo_count == 1
+    feed.shutdown()
+    service.shutdown()
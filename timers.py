@@ -13,20 +13,39 @@ class RepeatedTimer:
         self.kwargs = kwargs
         self.is_running = False
         self.next_call = time.time()
+        # Guards the timer, so a reschedule and a tick cannot both start one and leave the other uncancellable.
+        self._lock = threading.RLock()
+        self._generation = 0
         self.start()
 
-    def _run(self):
-        self.is_running = False
-        self.start()
+    def _run(self, generation):
+        with self._lock:
+            if generation != self._generation:
+                # The timer fired while it was being stopped or rescheduled, and has been replaced.
+                return
+            self.is_running = False
+            self.start()
         self.function(*self.args, **self.kwargs)
 
     def start(self):
-        if not self.is_running:
-            self.next_call += self.interval
-            self._timer = threading.Timer(self.next_call - time.time(), self._run)
-            self._timer.start()
-            self.is_running = True
+        with self._lock:
+            if not self.is_running:
+                self.next_call += self.interval
+                self._generation += 1
+                self._timer = threading.Timer(self.next_call - time.time(), self._run, args=(self._generation,))
+                self._timer.start()
+                self.is_running = True
 
     def stop(self):
-        self._timer.cancel()
-        self.is_running = False
+        with self._lock:
+            self._timer.cancel()
+            self._generation += 1
+            self.is_running = False
+
+    def reschedule(self, interval):
+        """ Change the interval, with the next call one new interval from now. """
+        with self._lock:
+            self.stop()
+            self.interval = interval
+            self.next_call = time.time()
+            self.start()
@@ -0,0 +1,102 @@
+import logging
+import math
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+
+class CrossfadeRenderer:
+    """
+    Precomputes the intermediate frames of a crossfade between two slides on a worker thread.
+
+    All frames are rendered at the display size (the screen size if not provided), so the Tk thread only has to hand
+    ready buffers to the label. The number of frames drops when the display thread cannot keep up with the frame time
+    budget, and recovers slowly once it can.
+    """
+    def __init__(self, size: Optional[Tuple[int, int]] = None, steps: int = 12, duration_ms: int = 800,
+                 min_steps: int = 2):
+        self.log = logging.getLogger('frame.CrossfadeRenderer')
+        self.size = size
+        self.max_steps = steps
+        self.min_steps = min(min_steps, steps)
+        self.steps = steps
+        self.duration_ms = duration_ms
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='CrossfadeRenderer')
+
+    @property
+    def frame_budget_ms(self) -> float:
+        return self.duration_ms / max(self.steps, 1)
+
+    def fit(self, image: Image.Image) -> Image.Image:
+        """ Letterbox an image onto a black canvas of the display size, so that consecutive slides can be blended. """
+        if image.size == self.size and image.mode == 'RGB':
+            return image
+        image = image.convert('RGB')
+        if image.width > self.size[0] or image.height > self.size[1]:
+            image.thumbnail(self.size)
+        canvas = Image.new('RGB', self.size)
+        canvas.paste(image, ((self.size[0] - image.width) // 2, (self.size[1] - image.height) // 2))
+        return canvas
+
+    def blend(self, current: Image.Image, upcoming: Image.Image, steps: int):
+        """
+        Compute the intermediate frames between two display sized images.
+
+        Blends use 8-bit fixed point weights in uint16, which keeps each step a single vectorised pass over the pixels
+        without the memory cost of float intermediates.
+        """
+        a = np.asarray(current, dtype=np.uint16)
+        b = np.asarray(upcoming, dtype=np.uint16)
+        frames = []
+        for i in range(1, steps + 1):
+            weight = round(256 * i / (steps + 1))
+            blended = (a * (256 - weight) + b * weight) >> 8
+            frames.append(Image.fromarray(blended.astype(np.uint8), 'RGB'))
+        return frames
+
+    def prepare(self, feed, current: Image.Image) -> Future:
+        """
+        Load the next slide from the feed and compute the transition to it, on the worker thread.
+
+        :return: a Future of (frames, upcoming image, title).
+        """
+        steps = self.steps
+
+        def render():
+            image, title = feed.next_image(size=self.size)
+            upcoming = self.fit(image)
+            return self.blend(current, upcoming, steps), upcoming, title
+
+        return self.executor.submit(render)
+
+    def report(self, frames_shown: int, frames_rendered: int):
+        """ Adjust the number of steps for the next transition based on how many frames the display managed. """
+        if frames_shown < frames_rendered:
+            new_steps = max(self.min_steps, min(self.steps - 1, frames_shown))
+            if new_steps != self.steps:
+                self.log.info('Display fell behind (%d of %d frames). Reducing steps to %d',
+                              frames_shown, frames_rendered, new_steps)
+            self.steps = new_steps
+        elif self.steps < self.max_steps:
+            self.steps += 1
+
+    def shrink(self, level):
+        """
+        A MemoryGovernor hook. Drops to the fewest steps, so the next transitions buffer fewer display sized frames.
+        The steps recover one at a time afterwards, as they do after the display falls behind.
+        """
+        if not self.size or self.steps <= self.min_steps:
+            return 0
+        freed = (self.steps - self.min_steps) * self.size[0] * self.size[1] * 3
+        self.log.info('Reducing steps from %d to %d to save memory', self.steps, self.min_steps)
+        self.steps = self.min_steps
+        return freed
+
+    def frames_to_skip(self, elapsed_ms: float) -> int:
+        """ The number of frames to drop after a frame that was shown elapsed_ms after it was due. """
+        return max(math.ceil(elapsed_ms / self.frame_budget_ms) - 1, 0)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,229 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+from categories import CategoryService, is_image_file
+from common import PHOTO_PATH, tags_from_file_name
+from photo import Photo
+
+ADDED = 'added'
+REMOVED = 'removed'
+RESCAN = 'rescan'
+
+# Values from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class InotifyEventSource:
+    """
+    Reads create/delete/move events for a single directory from Linux inotify.
+
+    IN_CLOSE_WRITE is used rather than IN_CREATE so that files are only reported once they have been fully written.
+    """
+    def __init__(self, watch_path: Path):
+        self.log = logging.getLogger('frame.InotifyEventSource')
+        libc_name = ctypes.util.find_library('c') or 'libc.so.6'
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(watch_path), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, f'inotify_add_watch failed for {watch_path}')
+        self.log.info('Watching %s with inotify', watch_path)
+
+    def read(self, timeout: float):
+        """
+        Wait up to timeout seconds for events.
+
+        :return: a list of (kind, file name) tuples.
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            _, mask, _, name_len = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + name_len].rstrip(b'\0').decode(errors='surrogateescape')
+            offset += name_len
+            if mask & IN_Q_OVERFLOW:
+                self.log.warning('inotify queue overflowed. Requesting a rescan.')
+                events.append((RESCAN, None))
+            elif mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                self.log.warning('Watched directory was removed or moved. Requesting a rescan.')
+                events.append((RESCAN, None))
+            elif mask & IN_ISDIR or not name:
+                continue
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                events.append((ADDED, name))
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                events.append((REMOVED, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingEventSource:
+    """ Fallback for platforms without inotify. Simply asks the watcher to rescan every poll_interval seconds. """
+    def __init__(self, poll_interval: float = 5.0):
+        self.poll_interval = poll_interval
+        self.next_poll = time.monotonic() + poll_interval
+
+    def read(self, timeout: float):
+        remaining = self.next_poll - time.monotonic()
+        if remaining > timeout:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(remaining, 0))
+        self.next_poll = time.monotonic() + self.poll_interval
+        return [(RESCAN, None)]
+
+    def close(self):
+        pass
+
+
+class LibraryWatcher:
+    """
+    Watches the photo directory and turns filesystem events into debounced, batched catalog updates.
+
+    New files are saved to the category service in bulk and added to the feed, removed files are dropped from the feed.
+    """
+    def __init__(self, category_service: CategoryService, feed=None, watch_path: Optional[Path] = None,
+                 debounce_ms: int = 1500, max_batch: int = 200, poll_interval: float = 5.0,
+                 use_inotify: bool = True):
+        if not watch_path:
+            watch_path = PHOTO_PATH
+        self.log = logging.getLogger('frame.LibraryWatcher')
+        self.watch_path = watch_path
+        self.category_service = category_service
+        self.feed = feed
+        self.debounce = debounce_ms / 1000
+        self.max_batch = max_batch
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify
+        self.known = set()
+        self.pending = {}
+        self.last_event = 0.0
+        self.source = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _create_source(self):
+        if self.use_inotify:
+            try:
+                return InotifyEventSource(self.watch_path)
+            except (OSError, AttributeError) as e:
+                self.log.warning('inotify is unavailable (%s). Falling back to polling.', e)
+        self.log.info('Polling %s every %.1f seconds', self.watch_path, self.poll_interval)
+        return PollingEventSource(self.poll_interval)
+
+    def _scan(self):
+        with os.scandir(self.watch_path) as it:
+            return {entry.name for entry in it if entry.is_file()}
+
+    def start(self):
+        self.known = self._scan()
+        self.source = self._create_source()
+        self._thread = threading.Thread(target=self._run, name='LibraryWatcher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        if self.source:
+            self.source.close()
+
+    def _run(self):
+        while not self._stop.is_set():
+            timeout = self.debounce if self.pending else 1.0
+            try:
+                events = self.source.read(timeout)
+            except OSError:
+                self.log.exception('Error reading filesystem events')
+                events = []
+            for kind, name in events:
+                self._record(kind, name)
+            if self.pending and (len(self.pending) >= self.max_batch
+                                 or time.monotonic() - self.last_event >= self.debounce):
+                self._flush()
+
+    def _record(self, kind, name):
+        if kind == RESCAN:
+            current = self._scan()
+            for added in current - self.known:
+                self._record(ADDED, added)
+            for removed in self.known - current:
+                self._record(REMOVED, removed)
+            return
+        # Later events for the same file win, e.g. a file copied in and then deleted within the debounce window.
+        self.pending[name] = kind
+        if kind == ADDED:
+            self.known.add(name)
+        else:
+            self.known.discard(name)
+        self.last_event = time.monotonic()
+
+    def _flush(self):
+        batch, self.pending = self.pending, {}
+        added = [self.watch_path / name for name, kind in batch.items() if kind == ADDED]
+        removed = [self.watch_path / name for name, kind in batch.items() if kind == REMOVED]
+        added = [p for p in added if is_image_file(p)]
+        self.log.info('Applying library changes: %d added, %d removed', len(added), len(removed))
+
+        if added:
+            entries = [(p, tags_from_file_name(p)) for p in added]
+            try:
+                # Files that cannot be saved are skipped, so only the saved entries are returned.
+                saved = self.category_service.save_all_to_categories(entries)
+            except Exception:
+                self.log.exception('Could not save %d new photos to the category service', len(entries))
+                saved = []
+            if self.feed and saved:
+                photos = []
+                for p, tags in saved:
+                    if not self.feed.accepts(tags):
+                        continue
+                    try:
+                        photos.append(Photo(p))
+                    except Exception as e:
+                        self.log.error('Could not load %s: %s', p, e)
+                self.feed.add_photos(photos)
+
+        if removed:
+            # Removed from the catalog first, so the next refresh of the feed does not load them again.
+            try:
+                self.category_service.remove_photos(removed)
+            except Exception:
+                self.log.exception('Could not remove %d photos from the category service', len(removed))
+            if self.feed:
+                self.feed.remove_photos(removed)
+